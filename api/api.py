@@ -1,21 +1,29 @@
 import logging
 
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, func, insert, update
 from sqlalchemy.future import select
-from typing import List
-from slowapi import Limiter
-from slowapi.util import get_remote_address
+from typing import List, Optional
 
-from models import Note
+from models import Note, TagStat
 from schemas import Note as NoteSchema
-from schemas import NoteCreate, UserCreate, User, Token
-from database import SessionLocal
-from auth import (get_current_user, get_user, create_user, 
-                  create_access_token, verify_password)
-
-app = FastAPI()
+from schemas import (NoteCreate, NoteUpdate, UserCreate, User, Token,
+                     RefreshRequest, TagCount, NotesDigest)
+from database import get_db, read_only, shard_for
+from events import events_config, stream_events
+from reads import NOTE_COLUMNS, use_core, notes_response, note_response
+from batching import note_batcher
+from bloom import user_filter
+from metrics import metrics
+from ratelimit import LazyLimiter
+from startup import lifespan, check_database
+from auth import (get_current_user, get_user, user_exists, create_user, issue_tokens,
+                  rotate_refresh_token, revoke_refresh_token, verify_password)
+
+app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger(__name__)
 
@@ -25,13 +33,63 @@ logging.basicConfig(
            '[%(asctime)s] - %(name)s - %(message)s')
 
 
-limiter = Limiter(key_func=get_current_user)
+limiter = LazyLimiter(key_func=get_current_user)
+
+
+def parse_etag(etag: str) -> Optional[int]:
+    """
+    Parses the note version from an ETag, e.g. `"3"` or `W/"3"`.
+
+    Returns:
+        Optional[int]: The version, or None if the ETag is not a note version.
+    """
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    try:
+        return int(etag.strip('"'))
+    except ValueError:
+        return None
+
+
+def make_etag(version: int) -> str:
+    """
+    Makes the ETag of a note version.
+    """
+    return f'"{version}"'
+
 
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: the process is up and serving requests.
+    """
+    return {"status": "ok"}
 
-async def get_db() -> AsyncSession:
-    logger.info(f'get_db')
-    async with SessionLocal() as session:
-        yield session
+
+@app.get("/readyz")
+async def readyz(request: Request):
+    """
+    Readiness probe: the pool is warm and the database is reachable.
+
+    Returns 503 until startup is complete or while the database is down.
+    """
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if not await check_database():
+        return JSONResponse(status_code=503, content={"status": "database unavailable"})
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def read_metrics():
+    """
+    Get the in-process metrics of this API worker.
+
+    Returns:
+        dict: Counters, summaries and gauges.
+    """
+    return metrics.snapshot()
 
 
 @app.post("/users/", response_model=User)
@@ -52,10 +110,40 @@ async def register_user(request: Request,
     """
     logger.info(f'Logging user: {user.username}')
 
-    existing_user = await get_user(db, user.username)
-    if existing_user:
+    db.info["shard"] = shard_for(user.username)
+    db_user = await create_user(db, user)
+    if db_user is None:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return await create_user(db, user)
+    user_filter.add(db_user["username"])
+    return db_user
+
+
+@app.head("/users/{username}", dependencies=[Depends(read_only)])
+async def check_user(username: str,
+                     db: AsyncSession = Depends(get_db)):
+    """
+    Checks whether a username is registered: 200 if it is, 404 otherwise.
+
+    With `users.bloom_filter` (single API process only), most unknown
+    usernames are answered from the in-memory Bloom filter of registered
+    usernames without touching the database. The remaining ones are
+    confirmed on the user's shard, as the filter may be wrong about a
+    username existing, but never about it not existing. Without the
+    filter every check is one id lookup on the user's shard.
+
+    Args:
+        username (str): The username to look up.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+    """
+    if not user_filter.might_exist(username):
+        metrics.incr('users.exists.filtered')
+        return Response(status_code=404)
+
+    metrics.incr('users.exists.lookup')
+    db.info["shard"] = shard_for(username)
+    if not await user_exists(db, username):
+        return Response(status_code=404)
+    return Response(status_code=200)
 
 
 @app.post("/token/", response_model=Token)
@@ -76,14 +164,64 @@ async def login(request: Request,
     """
     logger.info(f'Create token for user: {form_data.username}')
 
+    db.info["shard"] = shard_for(form_data.username)
     user = await get_user(db, username=form_data.username)
 
     if not user or not verify_password(form_data.password, user.password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    return {"password": create_access_token(data={"sub": user.username})}
+    return await issue_tokens(db, user.id, user.username)
 
 
-@app.get("/notes/", response_model=List[NoteSchema])
+@app.post("/token/refresh", response_model=Token)
+@limiter.limit("5/second")
+async def refresh_token(request: Request,
+                        body: RefreshRequest,
+                        db: AsyncSession = Depends(get_db)):
+    """
+    Exchanges a refresh token for a new token pair.
+
+    The presented refresh token is revoked, so every refresh token
+    can be used only once.
+
+    Args:
+        request (Request): The incoming request object.
+        body (RefreshRequest): The refresh token.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+
+    Returns:
+        Token: The new tokens.
+    """
+    user = await rotate_refresh_token(db, body.refresh_token)
+    if user is None:
+        raise HTTPException(status_code=401,
+                            detail="Invalid refresh token",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+    user_id, username = user
+    logger.info(f'Refresh token for user: {username}')
+
+    return await issue_tokens(db, user_id, username)
+
+
+@app.post("/token/revoke", status_code=204)
+@limiter.limit("5/second")
+async def revoke_token(request: Request,
+                       body: RefreshRequest,
+                       db: AsyncSession = Depends(get_db)):
+    """
+    Revokes a refresh token, ending the session it belongs to.
+
+    Args:
+        request (Request): The incoming request object.
+        body (RefreshRequest): The refresh token.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+    """
+    await revoke_refresh_token(db, body.refresh_token)
+    return Response(status_code=204)
+
+
+@app.get("/notes/", response_model=List[NoteSchema],
+         dependencies=[Depends(read_only)])
 @limiter.limit("5/second")
 async def read_notes(request: Request,
                      skip: int = 0,
@@ -93,6 +231,9 @@ async def read_notes(request: Request,
     """
     Get all notes for the current user.
 
+    With `reads.engine: core` the notes are read with SQLAlchemy Core
+    and serialized without building ORM objects.
+
     Args:
         request (Request): The incoming request object.
         skip (int): The number of records to skip. Defaults to 0.
@@ -103,8 +244,17 @@ async def read_notes(request: Request,
     Returns:
         List[NoteSchema]: The list of notes for the current user.
     """
+    if use_core():
+        result = await db.execute(select(*NOTE_COLUMNS)
+                                  .where(Note.owner_id == current_user.id)
+                                  .order_by(Note.id)
+                                  .offset(skip)
+                                  .limit(limit))
+        return notes_response(result)
+
     result = await db.execute(select(Note)
                               .where(Note.owner_id == current_user.id)
+                              .order_by(Note.id)
                               .offset(skip)
                               .limit(limit))
     notes = result.unique().scalars().all()
@@ -114,6 +264,74 @@ async def read_notes(request: Request,
     return notes
 
 
+@app.get("/notes/stream")
+async def stream_notes(request: Request,
+                       last_event_id: Optional[str] = Header(None),
+                       db: AsyncSession = Depends(get_db),
+                       current_user: User = Depends(get_current_user)):
+    """
+    Stream the note changes of the current user as server-sent events.
+
+    Every create, update and delete is sent as an event named after it,
+    with the note ID and version as data. A client reconnecting with
+    `Last-Event-ID` gets the events it missed, or a `reset` event if they
+    are no longer known, after which it should refetch its notes.
+
+    Args:
+        request (Request): The incoming request object.
+        last_event_id (Optional[str]): The ID of the last received event.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
+
+    Returns:
+        StreamingResponse: The endless event stream.
+
+    Raises:
+        HTTPException: If note events are disabled (404).
+    """
+    if not events_config.enabled:
+        raise HTTPException(status_code=404, detail="Note events are disabled")
+
+    logger.info(f'User {current_user.username} streaming note events')
+
+    # The stream may stay open for hours, do not hold a connection
+    await db.close()
+
+    return StreamingResponse(stream_events(current_user.shard, current_user.id, last_event_id),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache",
+                                      "X-Accel-Buffering": "no"})
+
+
+@app.get("/notes/digest", response_model=NotesDigest,
+         dependencies=[Depends(read_only)])
+@limiter.limit("5/second")
+async def read_notes_digest(request: Request,
+                            db: AsyncSession = Depends(get_db),
+                            current_user: User = Depends(get_current_user)):
+    """
+    Get a digest of the notes of the current user.
+
+    The digest changes whenever a note is created, updated or deleted,
+    so clients keeping copies of the notes can check them with one
+    aggregate instead of fetching every note again.
+
+    Args:
+        request (Request): The incoming request object.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
+
+    Returns:
+        NotesDigest: The digest.
+    """
+    result = await db.execute(select(func.count(),
+                                     func.coalesce(func.max(Note.id), 0),
+                                     func.coalesce(func.sum(Note.version), 0))
+                              .where(Note.owner_id == current_user.id))
+    count, max_id, versions = result.one()
+    return {"digest": f"{count}:{max_id}:{versions}"}
+
+
 @app.post("/notes/", response_model=NoteSchema)
 @limiter.limit("5/second")
 async def create_note(request: Request,
@@ -135,67 +353,105 @@ async def create_note(request: Request,
     """
     logger.info(f'User {current_user.username} create new note: {note.dict()}')
 
-    # Create a new note
-    db_note = Note(title=note.title,
-                   content=note.content,
-                   tags=note.tags,
-                   owner_id=current_user.id)
-
-    logger.info(f'Creating note: {db_note}')
-    logger.info(f'{db_note}')
-
-    # Add the note to the database
-    db.add(db_note)
+    # Let the batcher write the note together with concurrent ones
+    if note_batcher is not None:
+        # The batcher uses its own connection, give back the one of the
+        # authentication instead of holding it idle in a transaction
+        await db.close()
+        db_note = await note_batcher.create({"title": note.title,
+                                             "content": note.content,
+                                             "tags": note.tags,
+                                             "owner_id": current_user.id},
+                                            shard=current_user.shard)
+        return db_note
+
+    # Create a new note and get it back in the same statement
+    table = Note.__table__
+    result = await db.execute(insert(table)
+                              .values(title=note.title,
+                                      content=note.content,
+                                      tags=note.tags,
+                                      owner_id=current_user.id)
+                              .returning(*table.c))
+    db_note = dict(result.one()._mapping)
     await db.commit()
 
-    # Refresh the database entry
-    await db.refresh(db_note)
+    logger.info(f'Created note: {db_note}')
 
     # Return the created note
     return db_note
 
 
-@app.get("/notes/{note_id}", response_model=NoteSchema)
+@app.get("/notes/{note_id}", response_model=NoteSchema,
+         dependencies=[Depends(read_only)])
 @limiter.limit("5/second")
 async def read_note(request: Request,
+                    response: Response,
                     note_id: int,
-                    db: AsyncSession = Depends(get_db)):
+                    db: AsyncSession = Depends(get_db),
+                    current_user: User = Depends(get_current_user)):
     """
     Get a note by its ID.
 
+    With `reads.engine: core` the note is read with SQLAlchemy Core
+    and serialized without building ORM objects.
+
     Args:
         request (Request): The incoming request object.
+        response (Response): The outgoing response, used to set the ETag.
         note_id (int): The ID of the note to retrieve.
         db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
 
     Returns:
         NoteSchema: The retrieved note.
     """
     logger.info(f'Getting note with id {note_id}')
 
-    note = await db.get(Note, note_id)
+    if use_core():
+        result = await db.execute(select(*NOTE_COLUMNS)
+                                  .where(Note.id == note_id,
+                                         Note.owner_id == current_user.id))
+        row = result.first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Note not found")
+        return note_response(row, headers={"ETag": make_etag(row.version)})
+
+    result = await db.execute(select(Note)
+                              .where(Note.id == note_id,
+                                     Note.owner_id == current_user.id))
+    note = result.unique().scalar()
     if note is None:
         raise HTTPException(status_code=404, detail="Note not found")
 
     logger.info(f'Note with id {note_id} found: {note}')
 
+    response.headers["ETag"] = make_etag(note.version)
     return note
 
 
 @app.put("/notes/{note_id}", response_model=NoteSchema)
 @limiter.limit("5/second")
 async def update_note(request: Request,
+                      response: Response,
                       note_id: int,
-                      note: NoteCreate,
+                      note: NoteUpdate,
+                      if_match: Optional[str] = Header(None),
                       db: AsyncSession = Depends(get_db),
                       current_user: User = Depends(get_current_user)):
     """
     Update a note.
 
+    The expected version of the note can be given either in the `If-Match`
+    header (412 on mismatch) or as `version` in the body (409 on mismatch).
+    Without it, the note is overwritten unconditionally.
+
     Args:
         request (Request): The incoming request object.
+        response (Response): The outgoing response, used to set the ETag.
         note_id (int): The ID of the note to update.
-        note (NoteCreate): The note data to update.
+        note (NoteUpdate): The note data to update.
+        if_match (Optional[str]): The ETag of the expected note version.
         db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
         current_user (User): The current user. Defaults to Depends(get_current_user).
 
@@ -204,24 +460,53 @@ async def update_note(request: Request,
     """
     logger.info(f'User {current_user} edit note {note_id}: {note}')
 
-    db_note = await db.get(Note, note_id)
-    if not db_note or db_note.owner_id != current_user.id:
-        raise HTTPException(status_code=404, detail="Note not found")
+    table = Note.__table__
+
+    # The expected version comes from the If-Match header or from the body
+    expected_version, conflict_status = note.version, 409
+    if if_match is not None and if_match.strip() != "*":
+        expected_version, conflict_status = parse_etag(if_match), 412
+        if expected_version is None:
+            raise HTTPException(status_code=412, detail="Invalid If-Match header")
+
+    # Update the note in one statement, checking the version if given
+    statement = (update(table)
+                 .where(table.c.id == note_id,
+                        table.c.owner_id == current_user.id)
+                 .values(title=note.title,
+                         content=note.content,
+                         tags=note.tags,
+                         version=table.c.version + 1)
+                 .returning(*table.c))
+    if expected_version is not None:
+        statement = statement.where(table.c.version == expected_version)
+
+    result = await db.execute(statement)
+    row = result.first()
+
+    if row is None:
+        # Find out whether the note is missing or was changed meanwhile
+        result = await db.execute(select(table.c.version)
+                                  .where(table.c.id == note_id,
+                                         table.c.owner_id == current_user.id))
+        if result.scalar() is None:
+            raise HTTPException(status_code=404, detail="Note not found")
+        raise HTTPException(status_code=conflict_status,
+                            detail="Note was changed by another request")
 
-    # Update the note
-    for key, value in note.dict().items():
-        setattr(db_note, key, value)
-    db_note.tags = note.tags
     await db.commit()
-    await db.refresh(db_note)
+
+    db_note = dict(row._mapping)
+    response.headers["ETag"] = make_etag(db_note["version"])
     return db_note
 
 
 @app.delete("/notes/{note_id}", response_model=NoteSchema)
 @limiter.limit("5/second")
 async def delete_note(request: Request,
-                      note_id: int, db:
-                      AsyncSession = Depends(get_db)):
+                      note_id: int,
+                      db: AsyncSession = Depends(get_db),
+                      current_user: User = Depends(get_current_user)):
     """
     Delete a note.
 
@@ -229,42 +514,132 @@ async def delete_note(request: Request,
         request (Request): The incoming request object.
         note_id (int): The ID of the note to delete.
         db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
 
     Returns:
         NoteSchema: The deleted note.
     """
-    logger.info(f'Deleting note {note_id}')
-
-    db_note = await db.get(Note, note_id)
-    if not db_note:
+    logger.info(f'User {current_user.username} deleting note {note_id}')
+
+    # Delete the note and get it back in the same statement
+    table = Note.__table__
+    result = await db.execute(delete(table)
+                              .where(table.c.id == note_id,
+                                     table.c.owner_id == current_user.id)
+                              .returning(*table.c))
+    row = result.first()
+    if row is None:
         raise HTTPException(status_code=404, detail="Note not found")
-
-    await db.delete(db_note)
     await db.commit()
+
+    db_note = dict(row._mapping)
     return db_note
 
 
-@app.get("/notes/tags/{tag_name}", response_model=List[NoteSchema])
+@app.get("/notes/tags/{tag_name}", response_model=List[NoteSchema],
+         dependencies=[Depends(read_only)])
 @limiter.limit("5/second")
 async def read_notes_by_tag(request: Request,
-                            tag_name: str, db:
-                            AsyncSession = Depends(get_db)):
+                            tag_name: str,
+                            skip: int = 0,
+                            limit: Optional[int] = None,
+                            db: AsyncSession = Depends(get_db),
+                            current_user: User = Depends(get_current_user)):
     """
-    Get all notes containing the specified tag.
+    Get all notes of the current user containing the specified tag.
+
+    With `reads.engine: core` the notes are read with SQLAlchemy Core
+    and serialized without building ORM objects.
 
     Args:
         request (Request): The incoming request object.
         tag_name (str): The tag to search for.
+        skip (int): The number of records to skip. Defaults to 0.
+        limit (Optional[int]): The number of records to return. Defaults to all.
         db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
 
     Returns:
         List[NoteSchema]: The list of notes containing the specified tag.
     """
-    logger.info(f'Getting notes by tag: {tag_name}')
+    logger.info(f'User {current_user.username} getting notes by tag: {tag_name}')
 
     # Search for notes containing the specified tag
+    if use_core():
+        result = await db.execute(select(*NOTE_COLUMNS)
+                                  .where(Note.owner_id == current_user.id,
+                                         Note.tags.contains(tag_name))
+                                  .order_by(Note.id)
+                                  .offset(skip)
+                                  .limit(limit))
+        return notes_response(result)
+
     result = await db.execute(select(Note)
-                              .where(Note.tags.contains(tag_name)))
+                              .where(Note.owner_id == current_user.id,
+                                     Note.tags.contains(tag_name))
+                              .order_by(Note.id)
+                              .offset(skip)
+                              .limit(limit))
     notes = result.unique().scalars().all()
     return notes
 
+
+@app.get("/tags/suggest", response_model=List[TagCount],
+         dependencies=[Depends(read_only)])
+@limiter.limit("5/second")
+async def suggest_tags(request: Request,
+                       prefix: str = "",
+                       limit: int = 10,
+                       db: AsyncSession = Depends(get_db),
+                       current_user: User = Depends(get_current_user)):
+    """
+    Get the most used tags of the current user starting with a prefix.
+
+    Args:
+        request (Request): The incoming request object.
+        prefix (str): The beginning of the tag. Defaults to "".
+        limit (int): The number of tags to return. Defaults to 10.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
+
+    Returns:
+        List[TagCount]: The matching tags, the most used first.
+    """
+    logger.info(f'User {current_user.username} suggest tags by prefix: {prefix}')
+
+    # One range scan of the user's tags in `ix_tag_stats_owner_id_tag_prefix`,
+    # every API process and worker sees the same counts
+    result = await db.execute(select(TagStat.tag, TagStat.count)
+                              .where(TagStat.owner_id == current_user.id,
+                                     TagStat.tag.startswith(prefix, autoescape=True))
+                              .order_by(TagStat.count.desc(), TagStat.tag)
+                              .limit(limit))
+    return [{"tag": tag, "count": count} for tag, count in result.all()]
+
+
+@app.get("/tags/stats", response_model=List[TagCount],
+         dependencies=[Depends(read_only)])
+@limiter.limit("5/second")
+async def read_tag_stats(request: Request,
+                         db: AsyncSession = Depends(get_db),
+                         current_user: User = Depends(get_current_user)):
+    """
+    Get the notes count of every tag of the current user.
+
+    The counts are kept up to date by the database on every note write,
+    so this costs one row per distinct tag, not per note.
+
+    Args:
+        request (Request): The incoming request object.
+        db (AsyncSession): The asynchronous database session. Defaults to Depends(get_db).
+        current_user (User): The current user. Defaults to Depends(get_current_user).
+
+    Returns:
+        List[TagCount]: The tags of the current user, the most used first.
+    """
+    logger.info(f'User {current_user.username} getting tag stats')
+
+    result = await db.execute(select(TagStat.tag, TagStat.count)
+                              .where(TagStat.owner_id == current_user.id)
+                              .order_by(TagStat.count.desc(), TagStat.tag))
+    return [{"tag": tag, "count": count} for tag, count in result.all()]
@@ -1,17 +1,21 @@
+import hashlib
+import hmac
 import logging
+import secrets
 
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional, Tuple
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
-from models import User
+from models import RefreshToken, User
 from schemas import UserCreate
-from database import SessionLocal
+from database import engines, get_db, shard_for
 from config import get_config, Salt, JWT
 
 logger = logging.getLogger(__name__)
@@ -25,15 +29,27 @@ SALT = str(get_config(Salt, 'salt'))
 SECRET_KEY = str(get_config(JWT, 'jwt'))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+
+# A token rotated this recently is most likely sent again by a client
+# refreshing concurrently, not by a thief, so it is not treated as reuse
+REFRESH_REUSE_GRACE_SECONDS = 10
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-async def get_db() -> AsyncSession:
-    async with SessionLocal() as session:
-        yield session
+@lru_cache(maxsize=1)
+def get_pwd_context():
+    """
+    Returns the password hashing context.
+
+    passlib and its bcrypt backend are loaded on the first login
+    or registration instead of at startup.
+    """
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 def verify_password(plain_password: str,
@@ -50,7 +66,7 @@ def verify_password(plain_password: str,
     """
     logger.info(f'verify_password: {plain_password}, {hashed_password}')
 
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 
 def encrypt_password(password: str) -> str:
@@ -65,7 +81,7 @@ def encrypt_password(password: str) -> str:
     """
     logger.info(f'encrypt_password: {password}')
 
-    hashed_password = pwd_context.hash(password)
+    hashed_password = get_pwd_context().hash(password)
     return hashed_password
 
 
@@ -87,25 +103,46 @@ async def get_user(db: AsyncSession,
     return result.scalar()
 
 
-async def create_user(db: AsyncSession, user: UserCreate) -> User:
+async def user_exists(db: AsyncSession,
+                      username: str) -> bool:
+    """
+    Checks whether a user is registered, without loading the user.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        username (str): The username to look up.
+
+    Returns:
+        bool: Whether the user exists.
+    """
+    result = await db.execute(select(User.id).where(User.username == username))
+    return result.first() is not None
+
+
+async def create_user(db: AsyncSession, user: UserCreate) -> Optional[dict]:
     """
     Creates a user in the database.
 
+    The user is inserted and returned with a single statement.
+
     Args:
         db (AsyncSession): The database session to use.
         user (UserCreate): The user data to create.
 
     Returns:
-        User: The newly created user.
+        Optional[dict]: The newly created user, None if the username is taken.
     """
     logger.info(f'create user with username: {user.username}')
 
-    db_user = User(username=user.username, 
-                   password=encrypt_password(user.password))
-    db.add(db_user)
+    table = User.__table__
+    result = await db.execute(insert(table)
+                              .values(username=user.username,
+                                      password=encrypt_password(user.password))
+                              .on_conflict_do_nothing(index_elements=[table.c.username])
+                              .returning(table.c.id, table.c.username))
+    row = result.first()
     await db.commit()
-    await db.refresh(db_user)
-    return db_user
+    return dict(row._mapping) if row is not None else None
 
 
 def create_access_token(data: dict, 
@@ -117,11 +154,13 @@ def create_access_token(data: dict,
         data (dict): The data to encode in the token.
         expires_delta (Optional[timedelta], optional): 
             The time delta after which the token will expire. 
-            Defaults to 15 minutes.
+            Defaults to ACCESS_TOKEN_EXPIRE_MINUTES.
 
     Returns:
         str: The created access token.
     """
+    from jose import jwt
+
     logger.info(f'creating token {data}')
 
     # Create a copy of the data to encode
@@ -131,7 +170,7 @@ def create_access_token(data: dict,
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
 
     # Update the data with the expiration time
     to_encode.update({"exp": expire})
@@ -146,11 +185,161 @@ def create_access_token(data: dict,
     return encoded_jwt
 
 
+def hash_refresh_token(token: str) -> str:
+    """
+    Hashes a refresh token for storage.
+
+    Refresh tokens are long random strings, so a keyed HMAC is enough
+    and much cheaper than a password hash.
+
+    Args:
+        token (str): The refresh token.
+
+    Returns:
+        str: The hex HMAC-SHA256 of the token.
+    """
+    return hmac.new(SECRET_KEY.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
+async def create_refresh_token(db: AsyncSession, user_id: int) -> str:
+    """
+    Creates a refresh token for the user.
+
+    The token is added to the current transaction, the caller commits.
+    It starts with the shard of the session, so a refresh can be routed
+    without knowing the user.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        user_id (int): The ID of the token owner.
+
+    Returns:
+        str: The created refresh token.
+    """
+    token = f'{db.info.get("shard", 0)}.{secrets.token_urlsafe(32)}'
+    expire = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+
+    await db.execute(insert(RefreshToken.__table__)
+                     .values(user_id=user_id,
+                             token_hash=hash_refresh_token(token),
+                             expires_at=expire))
+    return token
+
+
+def refresh_token_shard(token: str) -> int:
+    """
+    Returns the shard a refresh token was issued on.
+
+    Args:
+        token (str): The refresh token.
+
+    Returns:
+        int: The shard from the token prefix, 0 for tokens without one.
+    """
+    prefix, _, _ = token.partition(".")
+    if prefix.isdigit() and int(prefix) < len(engines):
+        return int(prefix)
+    return 0
+
+
+async def issue_tokens(db: AsyncSession, user_id: int, username: str) -> dict:
+    """
+    Issues a new access and refresh token pair and commits it.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        user_id (int): The ID of the user.
+        username (str): The username of the user.
+
+    Returns:
+        dict: The tokens, as described by the `Token` schema.
+    """
+    refresh_token = await create_refresh_token(db, user_id)
+    await db.commit()
+
+    return {"password": create_access_token(data={"sub": username}),
+            "refresh_token": refresh_token,
+            "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60}
+
+
+async def rotate_refresh_token(db: AsyncSession,
+                               token: str) -> Optional[Tuple[int, str]]:
+    """
+    Revokes a refresh token in exchange for the user it belongs to.
+
+    If an already revoked token is presented again, it has leaked,
+    so all refresh tokens of its user are revoked. A token rotated
+    less than `REFRESH_REUSE_GRACE_SECONDS` ago is only rejected.
+    The session is routed to the shard of the token.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        token (str): The refresh token to rotate.
+
+    Returns:
+        Optional[Tuple[int, str]]: The ID and username of the user,
+            None if the token is unknown, expired or revoked.
+    """
+    table = RefreshToken.__table__
+    users = User.__table__
+    token_hash = hash_refresh_token(token)
+    db.info["shard"] = refresh_token_shard(token)
+
+    result = await db.execute(update(table)
+                              .where(table.c.token_hash == token_hash,
+                                     table.c.revoked_at.is_(None),
+                                     table.c.expires_at > func.now(),
+                                     users.c.id == table.c.user_id)
+                              .values(revoked_at=func.now())
+                              .returning(users.c.id, users.c.username))
+    row = result.first()
+    if row is not None:
+        return row.id, row.username
+
+    logger.info('Refresh token rejected')
+
+    # Revoke every session of the user if a rotated token is reused
+    grace = timedelta(seconds=REFRESH_REUSE_GRACE_SECONDS)
+    reused = (select(table.c.user_id)
+              .where(table.c.token_hash == token_hash,
+                     table.c.revoked_at < func.now() - grace)
+              .scalar_subquery())
+    await db.execute(update(table)
+                     .where(table.c.user_id == reused,
+                            table.c.revoked_at.is_(None))
+                     .values(revoked_at=func.now()))
+    await db.commit()
+    return None
+
+
+async def revoke_refresh_token(db: AsyncSession, token: str):
+    """
+    Revokes a refresh token, e.g. on logout.
+
+    The session is routed to the shard of the token.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        token (str): The refresh token to revoke.
+    """
+    table = RefreshToken.__table__
+    db.info["shard"] = refresh_token_shard(token)
+    await db.execute(update(table)
+                     .where(table.c.token_hash == hash_refresh_token(token),
+                            table.c.revoked_at.is_(None))
+                     .values(revoked_at=func.now()))
+    await db.commit()
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme), 
                            db: AsyncSession = Depends(get_db)) -> User:
     """
     Retrieves the user based on the given token
 
+    The request session is routed to the user's shard, which is also
+    kept on the returned user as `shard`. Route handlers depending on
+    `get_db` get the same session.
+
     Args:
         token (str): The token to use for authentication.
         db (AsyncSession): The database session to use for the query.
@@ -161,6 +350,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme),
     Raises:
         HTTPException: If the token is invalid or the user is not found.
     """
+    from jose import JWTError, jwt
+
     logger.info(f'getting user by token: {token}')
 
     # Define the exception to raise if the credentials are invalid
@@ -182,7 +373,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme),
         # Raise the exception if there is an error decoding the token
         raise credentials_exception
 
-    # Get the user from the database
+    # Get the user from the database of their shard
+    db.info["shard"] = shard_for(username)
     user = await get_user(db, username=username)
 
     logger.info(f'Getted user: {user}')
@@ -191,6 +383,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme),
     if user is None:
         raise credentials_exception
 
+    user.shard = db.info["shard"]
+
     # Return the user
     return user
 
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from models import Note
+from database import SessionLocal
+from config import get_optional_config, BatchingConfig
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+
+class NoteWriteBatcher:
+    """
+    Coalesces concurrent note creations into multi-row inserts.
+
+    Requests are collected for up to `max_delay_ms` after the first one
+    (or until `max_batch` are waiting) and written with a single
+    `INSERT ... RETURNING` in one transaction. If a batch fails, its notes
+    are retried one by one, so only the failing requests get the error.
+    A batch is written with one insert per shard of its notes.
+    """
+    def __init__(self,
+                 max_batch: int = 64,
+                 max_delay_ms: float = 5.0):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def create(self, values: dict, shard: int = 0) -> dict:
+        """
+        Queues a note for creation and waits until it is committed.
+
+        Args:
+            values (dict): The column values of the new note.
+            shard (int): The shard of the note owner.
+
+        Returns:
+            dict: The created note row.
+        """
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((values, shard, future))
+        return await future
+
+    async def stop(self):
+        """
+        Writes the queued notes and stops the worker.
+        """
+        if self._worker is None or self._worker.done():
+            return
+        self._queue.put_nowait(None)
+        await self._worker
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+
+            # Collect more requests until the batch is full or the delay is over
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    await self._flush(batch)
+                    return
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, int, asyncio.Future]]):
+        shards: Dict[int, List[Tuple[dict, asyncio.Future]]] = {}
+        for values, shard, future in batch:
+            shards.setdefault(shard, []).append((values, future))
+        for shard, items in shards.items():
+            await self._flush_shard(shard, items)
+
+    async def _flush_shard(self, shard: int, batch: List[Tuple[dict, asyncio.Future]]):
+        metrics.incr('notes.batch.count')
+        metrics.incr('notes.batch.items', len(batch))
+        metrics.observe('notes.batch.size', len(batch))
+        started = time.perf_counter()
+
+        try:
+            rows = await self._insert(shard, [values for values, _ in batch])
+        except Exception as e:
+            logger.warning(f'Batch of {len(batch)} notes failed: {e}')
+            metrics.incr('notes.batch.failed')
+
+            # Retry one by one to find out which requests are failing
+            for values, future in batch:
+                try:
+                    rows = await self._insert(shard, [values])
+                except Exception as e:
+                    metrics.incr('notes.batch.item_failed')
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(rows[0])
+            return
+
+        metrics.observe('notes.batch.flush_ms', (time.perf_counter() - started) * 1000)
+
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
+
+    async def _insert(self, shard: int, values: List[dict]) -> List[dict]:
+        table = Note.__table__
+        async with SessionLocal(info={"shard": shard}) as db:
+            result = await db.execute(insert(table)
+                                      .returning(*table.c, sort_by_parameter_order=True),
+                                      values)
+            rows = [dict(row._mapping) for row in result]
+            await db.commit()
+        return rows
+
+
+batching_config = get_optional_config(BatchingConfig, 'batching')
+
+note_batcher = (NoteWriteBatcher(max_batch=batching_config.max_batch,
+                                 max_delay_ms=batching_config.max_delay_ms)
+                if batching_config.enabled else None)
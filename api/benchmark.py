@@ -0,0 +1,349 @@
+"""
+Benchmarks of the API against the database from `config.yaml`.
+
+Run from the `api` directory:
+
+    python benchmark.py roundtrips [--requests N]
+    python benchmark.py imports [--budget-ms MS]
+    python benchmark.py reads [--notes N] [--requests N]
+    python benchmark.py drivers [--iterations N]
+
+`roundtrips` calls every endpoint in-process and counts the database
+round trips (BEGIN, statements, COMMIT/ROLLBACK) each request costs,
+next to the counts of the code before single-statement writes.
+
+`imports` reports the slowest imports of the API module and fails
+if the import takes longer than the budget or loads a lazy dependency.
+
+`reads` times the note list endpoints on a user with many notes,
+once with the ORM and once with the Core read path.
+
+`drivers` runs the queries of the hot endpoints with psycopg and asyncpg,
+using the prepared statement settings of `config.yaml`.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+from collections import Counter
+from typing import Dict, List
+
+import httpx
+from sqlalchemy import event, insert, select, update
+
+from database import SessionLocal, db_config, engines, make_engine, shard_for
+from models import Note, TagStat, User
+from reads import reads_config
+from api import app, limiter
+from startup import create_tables
+
+
+# Import time of the API module allowed by `imports`
+IMPORT_BUDGET_MS = 1000
+
+# Dependencies that must only be loaded on first use
+LAZY_MODULES = ("slowapi", "jose", "passlib")
+
+# Round trips per request before owner-scoped single-statement writes,
+# including the separate session of `get_current_user` (BEGIN, SELECT, ROLLBACK)
+BASELINE_ROUND_TRIPS = {
+    "register": 7,
+    "login": 3,
+    "create_note": 9,
+    "read_note": 3,
+    "update_note": 10,
+    "delete_note": 4,
+}
+
+
+class RoundTripCounter:
+    """
+    Counts the round trips made by the engines of all shards.
+    """
+    def __init__(self):
+        self.counts = Counter()
+        for engine in engines:
+            sync_engine = engine.sync_engine
+            event.listen(sync_engine, "begin", self._on("begin"))
+            event.listen(sync_engine, "before_cursor_execute", self._on("statement"))
+            event.listen(sync_engine, "commit", self._on("commit"))
+            event.listen(sync_engine, "rollback", self._on("rollback"))
+
+    def _on(self, name: str):
+        def listener(*args, **kwargs):
+            self.counts[name] += 1
+        return listener
+
+    def take(self) -> Counter:
+        counts, self.counts = self.counts, Counter()
+        return counts
+
+
+async def measure(counter: RoundTripCounter,
+                  results: Dict[str, List],
+                  name: str,
+                  request) -> httpx.Response:
+    """
+    Runs one request, recording its latency and round trips.
+    """
+    counter.take()
+    started = time.perf_counter()
+    response = await request
+    elapsed = (time.perf_counter() - started) * 1000
+    response.raise_for_status()
+    results.setdefault(name, []).append((elapsed, counter.take()))
+    return response
+
+
+async def roundtrips(requests: int):
+    """
+    Calls every endpoint `requests` times and prints the averages.
+    """
+    await create_tables()
+    limiter.enabled = False
+    counter = RoundTripCounter()
+    results: Dict[str, List] = {}
+    password = "Bench!" + uuid.uuid4().hex[:8]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+        for _ in range(requests):
+            username = f"bench_{uuid.uuid4().hex[:12]}"
+            await measure(counter, results, "register",
+                          client.post("/users/", json={"username": username,
+                                                        "password": password}))
+            response = await measure(counter, results, "login",
+                                     client.post("/token/", data={"grant_type": "password",
+                                                                  "username": username,
+                                                                  "password": password}))
+            response = await measure(counter, results, "refresh_token",
+                                     client.post("/token/refresh",
+                                                 json={"refresh_token": response.json()["refresh_token"]}))
+            headers = {"Authorization": f"Bearer {response.json()['password']}"}
+
+            response = await measure(counter, results, "create_note",
+                                     client.post("/notes/", headers=headers,
+                                                 json={"title": "bench",
+                                                       "content": "benchmark note",
+                                                       "tags": "bench load"}))
+            note_id = response.json()["id"]
+
+            await measure(counter, results, "read_notes",
+                          client.get("/notes/", headers=headers))
+            await measure(counter, results, "read_note",
+                          client.get(f"/notes/{note_id}", headers=headers))
+            await measure(counter, results, "read_notes_by_tag",
+                          client.get("/notes/tags/bench", headers=headers))
+            await measure(counter, results, "update_note",
+                          client.put(f"/notes/{note_id}", headers=headers,
+                                     json={"title": "bench",
+                                           "content": "updated",
+                                           "tags": "bench"}))
+            await measure(counter, results, "suggest_tags",
+                          client.get("/tags/suggest", params={"prefix": "b"}, headers=headers))
+            await measure(counter, results, "read_tag_stats",
+                          client.get("/tags/stats", headers=headers))
+            await measure(counter, results, "delete_note",
+                          client.delete(f"/notes/{note_id}", headers=headers))
+
+    print(f"{'endpoint':<20}{'before':>8}{'after':>8}{'stmts':>8}"
+          f"{'mean ms':>10}{'p95 ms':>10}")
+    for name, samples in results.items():
+        latencies = sorted(elapsed for elapsed, _ in samples)
+        trips = [sum(counts.values()) for _, counts in samples]
+        statements = [counts["statement"] for _, counts in samples]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"{name:<20}{BASELINE_ROUND_TRIPS.get(name, '-'):>8}"
+              f"{statistics.mean(trips):>8.1f}{statistics.mean(statements):>8.1f}"
+              f"{statistics.mean(latencies):>10.2f}{p95:>10.2f}")
+
+
+async def reads(notes: int, requests: int):
+    """
+    Times the note list endpoints with both read engines.
+    """
+    await create_tables()
+    limiter.enabled = False
+    username = f"bench_{uuid.uuid4().hex[:12]}"
+    password = "Bench!" + uuid.uuid4().hex[:8]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+        response = await client.post("/users/", json={"username": username,
+                                                       "password": password})
+        response.raise_for_status()
+        user_id = response.json()["id"]
+
+        # Insert the notes directly, the endpoint would take a while
+        async with SessionLocal(info={"shard": shard_for(username)}) as db:
+            await db.execute(insert(Note.__table__),
+                             [{"title": f"bench {i}",
+                               "content": "benchmark note " * 20,
+                               "tags": "bench load",
+                               "owner_id": user_id} for i in range(notes)])
+            await db.commit()
+
+        response = await client.post("/token/", data={"grant_type": "password",
+                                                      "username": username,
+                                                      "password": password})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['password']}"}
+
+        endpoints = {"read_notes": ("/notes/", {"limit": notes}),
+                     "read_notes_by_tag": ("/notes/tags/bench", {})}
+
+        print(f"{notes} notes per response\n")
+        print(f"{'endpoint':<20}{'engine':>8}{'mean ms':>10}{'p95 ms':>10}")
+        for name, (url, params) in endpoints.items():
+            for engine in ("orm", "core"):
+                reads_config.engine = engine
+                latencies = []
+                for _ in range(requests + 1):
+                    started = time.perf_counter()
+                    response = await client.get(url, params=params, headers=headers)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    response.raise_for_status()
+
+                # The first request warms up the caches
+                latencies = sorted(latencies[1:])
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"{name:<20}{engine:>8}"
+                      f"{statistics.mean(latencies):>10.2f}{p95:>10.2f}")
+
+
+def query_mix(username: str, user_id: int, note_id: int) -> dict:
+    """
+    The statements of the hot endpoints, by name.
+    """
+    users, notes, tag_stats = User.__table__, Note.__table__, TagStat.__table__
+    return {
+        "get_user": select(users).where(users.c.username == username),
+        "read_notes": select(notes).where(notes.c.owner_id == user_id).limit(10),
+        "read_note": select(notes).where(notes.c.id == note_id,
+                                         notes.c.owner_id == user_id),
+        "read_tag_stats": select(tag_stats).where(tag_stats.c.owner_id == user_id),
+        "update_note": (update(notes)
+                        .where(notes.c.id == note_id, notes.c.owner_id == user_id)
+                        .values(version=notes.c.version + 1)
+                        .returning(notes.c.version)),
+    }
+
+
+async def drivers(iterations: int):
+    """
+    Times the statements of the hot endpoints with every driver.
+    """
+    await create_tables()
+    username = f"bench_{uuid.uuid4().hex[:12]}"
+
+    async with SessionLocal(info={"shard": shard_for(username)}) as db:
+        result = await db.execute(insert(User.__table__)
+                                  .values(username=username, password="-")
+                                  .returning(User.__table__.c.id))
+        user_id = result.scalar()
+        result = await db.execute(insert(Note.__table__)
+                                  .returning(Note.__table__.c.id),
+                                  [{"title": f"bench {i}",
+                                    "content": "benchmark note",
+                                    "tags": "bench load",
+                                    "owner_id": user_id} for i in range(50)])
+        note_id = result.scalars().first()
+        await db.commit()
+
+    dsn = engines[shard_for(username)].url.render_as_string(hide_password=False)
+    mode = "pgbouncer" if db_config.pgbouncer else f"cache {db_config.statement_cache_size}"
+    print(f"{iterations} iterations, {mode}\n")
+    print(f"{'query':<16}{'driver':>10}{'mean us':>10}{'p95 us':>10}")
+
+    for driver in ("psycopg", "asyncpg"):
+        engine = make_engine(dsn, driver=driver)
+        async with engine.connect() as conn:
+            for name, statement in query_mix(username, user_id, note_id).items():
+                latencies = []
+                for _ in range(iterations + 1):
+                    started = time.perf_counter()
+                    await conn.execute(statement)
+                    latencies.append((time.perf_counter() - started) * 1e6)
+                    await conn.commit()
+
+                # The first execution fills the caches
+                latencies = sorted(latencies[1:])
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"{name:<16}{driver:>10}"
+                      f"{statistics.mean(latencies):>10.0f}{p95:>10.0f}")
+        await engine.dispose()
+
+
+def imports(budget_ms: float, top: int) -> int:
+    """
+    Imports the API in a fresh interpreter and reports the import times.
+
+    Returns:
+        int: The exit code, 1 if the budget is exceeded.
+    """
+    code = ("import sys, api; "
+            f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    # Lines look like "import time:  self [us] |  cumulative | imported package"
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        self_us, cumulative_us, name = int(fields[0]), int(fields[1]), fields[2].rstrip()
+        timings.append((cumulative_us, self_us, name))
+
+    total_ms = max(cumulative for cumulative, _, name in timings
+                   if name.strip() == "api") / 1000
+    loaded_lazy = result.stdout.strip()
+
+    print(f"{'cumulative ms':>14}{'self ms':>10}  module")
+    for cumulative, self_us, name in sorted(timings, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>14.1f}{self_us / 1000:>10.1f}  {name}")
+    print(f"\nimport api: {total_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+
+    if loaded_lazy:
+        print(f"lazy dependencies loaded at import: {loaded_lazy}")
+        return 1
+    return 0 if total_ms <= budget_ms else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_roundtrips = subparsers.add_parser("roundtrips",
+                                              help="database round trips per endpoint")
+    parser_roundtrips.add_argument("--requests", type=int, default=20)
+
+    parser_imports = subparsers.add_parser("imports",
+                                           help="import time of the API module")
+    parser_imports.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS)
+    parser_imports.add_argument("--top", type=int, default=15)
+
+    parser_reads = subparsers.add_parser("reads",
+                                         help="ORM and Core read paths on large lists")
+    parser_reads.add_argument("--notes", type=int, default=1000)
+    parser_reads.add_argument("--requests", type=int, default=20)
+
+    parser_drivers = subparsers.add_parser("drivers",
+                                           help="psycopg and asyncpg on the query mix")
+    parser_drivers.add_argument("--iterations", type=int, default=1000)
+
+    args = parser.parse_args()
+    if args.command == "roundtrips":
+        asyncio.run(roundtrips(args.requests))
+    elif args.command == "imports":
+        sys.exit(imports(args.budget_ms, args.top))
+    elif args.command == "reads":
+        asyncio.run(reads(args.notes, args.requests))
+    elif args.command == "drivers":
+        asyncio.run(drivers(args.iterations))
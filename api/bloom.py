@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import math
+
+from sqlalchemy.future import select
+
+from config import get_optional_config, UsersConfig
+from database import engines
+from models import User
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+users_config = get_optional_config(UsersConfig, 'users')
+
+# Usernames the filter is sized for and its false positive rate at that size
+USERS_CAPACITY = 1_000_000
+FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    """
+    Set of strings answering "surely not in" or "maybe in".
+
+    Args:
+        capacity (int): The number of items the filter is sized for.
+        error_rate (float): The false positive rate with `capacity` items.
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing: the k positions are h1 + i * h2
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class UserFilter:
+    """
+    Bloom filter of the registered usernames of all shards.
+
+    Until it is loaded on startup every username may exist,
+    so lookups fall through to the database.
+
+    The filter only learns about registrations in its own process, so it
+    is loaded only with `users.bloom_filter` set, for an API running as a
+    single process. With several replicas a user registered on another
+    one would be reported missing, so every lookup goes to the database.
+    """
+    def __init__(self):
+        self.filter = BloomFilter(USERS_CAPACITY, FALSE_POSITIVE_RATE)
+        self.loaded = False
+
+    async def load(self):
+        """
+        Adds the usernames of all shards to the filter, if it is enabled.
+        """
+        if not users_config.bloom_filter:
+            logger.info('User filter disabled, existence checks go to the database')
+            return
+
+        for engine in engines:
+            async with engine.connect() as conn:
+                result = await conn.stream(select(User.username))
+                async for username, in result:
+                    self.filter.add(username)
+        self.loaded = True
+        logger.info(f'User filter loaded with {self.filter.count} usernames')
+
+    def add(self, username: str):
+        self.filter.add(username)
+
+    def might_exist(self, username: str) -> bool:
+        return not self.loaded or username in self.filter
+
+
+user_filter = UserFilter()
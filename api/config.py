@@ -1,7 +1,7 @@
 from functools import lru_cache
-from typing import TypeVar, Type
+from typing import Dict, List, Literal, Optional, TypeVar, Type
 
-from pydantic import BaseModel, PostgresDsn
+from pydantic import BaseModel, PostgresDsn, model_validator
 from yaml import load
 
 try:
@@ -15,6 +15,37 @@ ConfigType = TypeVar("ConfigType", bound=BaseModel)
 class DbConfig(BaseModel):
     dsn: PostgresDsn
     is_echo: bool
+    pool_size: int = 5
+    max_overflow: int = 10
+    driver: Literal["psycopg", "asyncpg"] = "psycopg"
+    statement_cache_size: int = 100
+    prepare_threshold: int = 5
+    pgbouncer: bool = False
+    listen_dsns: List[PostgresDsn] = []
+
+
+class ShardConfig(BaseModel):
+    dsns: List[PostgresDsn] = []
+    # Users are hashed into a fixed number of buckets, which are spread
+    # over the first `spread_over` shards and moved with `bucket_moves`
+    buckets: int = 1024
+    spread_over: Optional[int] = None
+    bucket_moves: Dict[int, int] = {}
+    overrides: Dict[str, int] = {}
+
+    @model_validator(mode="after")
+    def check_spread_over(self) -> "ShardConfig":
+        # Without it, adding a shard would reroute most users
+        if len(self.dsns) > 1 and self.spread_over is None:
+            raise ValueError("shards.spread_over must be set when shards.dsns is")
+        shards = max(len(self.dsns), 1)
+        if self.spread_over is not None and not 1 <= self.spread_over <= shards:
+            raise ValueError(f"shards.spread_over must be between 1 and {shards}, "
+                             f"the number of shards.dsns")
+        for shard in [*self.bucket_moves.values(), *self.overrides.values()]:
+            if not 0 <= shard < shards:
+                raise ValueError(f"There is no shard {shard}")
+        return self
 
 
 class Salt(BaseModel):
@@ -25,6 +56,30 @@ class JWT(BaseModel):
     key: str
 
 
+class PartitionConfig(BaseModel):
+    notes: int = 8
+
+
+class BatchingConfig(BaseModel):
+    enabled: bool = False
+    max_batch: int = 64
+    max_delay_ms: float = 5.0
+
+
+class EventsConfig(BaseModel):
+    # Every note write notifies, see `events.install_note_events`
+    enabled: bool = False
+
+
+class UsersConfig(BaseModel):
+    # Only for a single API process, see `bloom.UserFilter`
+    bloom_filter: bool = False
+
+
+class ReadsConfig(BaseModel):
+    engine: Literal["orm", "core"] = "orm"
+
+
 @lru_cache(maxsize=1)
 def parse_config_file() -> dict:
     """
@@ -71,3 +126,24 @@ def get_config(model: Type[ConfigType],
         error = f"Key {root_key} not found"
         raise ValueError(error)
     return model.model_validate(config_dict[root_key])
+
+
+
+@lru_cache
+def get_optional_config(model: Type[ConfigType],
+                        root_key: str) -> ConfigType:
+    """
+    Get an optional configuration from the YAML file.
+
+    Works like `get_config`, but a missing root key gives
+    the model with its default values.
+
+    Args:
+        model (Type[ConfigType]): The model that the data should be parsed into.
+        root_key (str): The root key in the YAML file to parse from.
+
+    Returns:
+        ConfigType: The parsed data as the given model type.
+    """
+    config_dict = parse_config_file()
+    return model.model_validate(config_dict.get(root_key) or {})
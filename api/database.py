@@ -1,17 +1,217 @@
+import uuid
+import zlib
+
+from typing import Optional
+
+from fastapi import Depends
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
-from config import get_config, DbConfig
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection, AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from config import get_config, get_optional_config, DbConfig, ShardConfig
+from metrics import metrics
 
 
 db_config = get_config(DbConfig, "db")
+shard_config = get_optional_config(ShardConfig, "shards")
+
+
+def driver_connect_args(driver: str) -> dict:
+    """
+    Returns the prepared statement settings of a driver.
+
+    In PgBouncer mode server-side prepared statements are disabled,
+    since consecutive transactions may run on different server connections.
+
+    Args:
+        driver (str): "psycopg" or "asyncpg".
+
+    Returns:
+        dict: The `connect_args` of the engine.
+    """
+    if driver == "asyncpg":
+        if db_config.pgbouncer:
+            return {"statement_cache_size": 0,
+                    "prepared_statement_cache_size": 0,
+                    "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__"}
+        return {"statement_cache_size": db_config.statement_cache_size,
+                "prepared_statement_cache_size": db_config.statement_cache_size}
+
+    if db_config.pgbouncer:
+        return {"prepare_threshold": None}
+    return {"prepare_threshold": db_config.prepare_threshold}
+
+
+def make_engine(dsn: str, driver: Optional[str] = None) -> AsyncEngine:
+    """
+    Creates the engine of one database.
+
+    Args:
+        dsn (str): The DSN of the database, its driver is replaced.
+        driver (Optional[str]): The driver to use. Defaults to `db.driver`.
+
+    Returns:
+        AsyncEngine: The engine.
+    """
+    driver = driver or db_config.driver
+    url = make_url(str(dsn)).set(drivername=f"postgresql+{driver}")
+    engine = create_async_engine(url=url,
+                                 echo=False,
+                                 pool_size=db_config.pool_size,
+                                 max_overflow=db_config.max_overflow,
+                                 connect_args=driver_connect_args(driver))
+
+    if driver == "psycopg" and not db_config.pgbouncer:
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_prepared_max(dbapi_connection, connection_record):
+            dbapi_connection.driver_connection.prepared_max = db_config.statement_cache_size
+
+    return engine
+
+
+def watch_pool(shard: int, engine: AsyncEngine):
+    """
+    Publishes the pool checkouts of a shard in `metrics`.
+    """
+    pool = engine.sync_engine.pool
+
+    @event.listens_for(pool, "checkout")
+    def on_checkout(*args):
+        metrics.incr(f'db.pool.{shard}.checkout')
+
+    @event.listens_for(pool, "checkin")
+    def on_checkin(*args):
+        metrics.incr(f'db.pool.{shard}.checkin')
+
+    metrics.gauge(f'db.pool.{shard}.checked_out', pool.checkedout)
+
+
+# One engine per shard, `db.dsn` alone when no shards are configured
+engines = [make_engine(dsn) for dsn in shard_config.dsns or [db_config.dsn]]
+engine = engines[0]
+
+# Direct connections for LISTEN, which does not work through PgBouncer
+listen_dsns = [str(dsn) for dsn in db_config.listen_dsns] or [
+    engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    for engine in engines]
+
+# The same pools in autocommit mode, for requests that only read
+read_only_engines = [engine.execution_options(isolation_level="AUTOCOMMIT")
+                     for engine in engines]
+
+for shard, shard_engine in enumerate(engines):
+    watch_pool(shard, shard_engine)
+
 
-engine = create_async_engine(url=str(db_config.dsn), 
-                             echo=False)
+def bucket_for(username: str) -> int:
+    """
+    Returns the bucket of a user, by a stable hash of the username.
+    """
+    return zlib.crc32(username.encode()) % shard_config.buckets
 
+
+def shard_of_bucket(bucket: int) -> int:
+    """
+    Returns the shard holding the users of a bucket.
+
+    Buckets are spread over the first `shards.spread_over` shards,
+    unless `shards.bucket_moves` moved them (e.g. to a new shard).
+    Adding a shard therefore only moves the buckets reassigned to it.
+    """
+    if bucket in shard_config.bucket_moves:
+        return shard_config.bucket_moves[bucket]
+    return bucket % (shard_config.spread_over or len(engines))
+
+
+def shard_for(username: str) -> int:
+    """
+    Returns the shard holding the user and all of their data.
+
+    Users are routed by the shard of their bucket, unless
+    `shards.overrides` pins the user to a shard (e.g. after rebalancing).
+
+    Args:
+        username (str): The username of the user.
+
+    Returns:
+        int: The index of the shard in `engines`.
+    """
+    if username in shard_config.overrides:
+        return shard_config.overrides[username]
+    return shard_of_bucket(bucket_for(username))
+
+
+class ShardSession(Session):
+    """
+    Session bound to the engine of the shard in `info["shard"]`.
+
+    The shard can be chosen after the session is created,
+    as long as it is before the first query. With `info["read_only"]`
+    the connection runs in autocommit mode, so no transaction is opened.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        shard = self.info.get("shard", 0)
+        if self.info.get("read_only"):
+            return read_only_engines[shard].sync_engine
+        return engines[shard].sync_engine
+
+
+# Objects stay usable after a commit: route handlers commit their write and
+# then still read the current user, which shares the request session
 SessionLocal = sessionmaker(autocommit=False, 
                             autoflush=False, 
-                            bind=engine, 
-                            class_=AsyncSession)
+                            expire_on_commit=False,
+                            class_=AsyncSession,
+                            sync_session_class=ShardSession)
 
 Base = declarative_base()
+
+
+async def column_exists(conn: AsyncConnection, table: str, column: str) -> bool:
+    """
+    Checks the catalog for a column, so schema changes run only once.
+    """
+    result = await conn.execute(text("SELECT 1 FROM information_schema.columns "
+                                     "WHERE table_schema = current_schema() "
+                                     "AND table_name = :table AND column_name = :column"),
+                                {"table": table, "column": column})
+    return result.first() is not None
+
+
+async def trigger_exists(conn: AsyncConnection, table: str, trigger: str) -> bool:
+    """
+    Checks the catalog for a trigger, so it is not recreated under a table lock.
+    """
+    result = await conn.execute(text("SELECT 1 FROM pg_trigger "
+                                     "WHERE tgrelid = to_regclass(:table) AND tgname = :trigger"),
+                                {"table": table, "trigger": trigger})
+    return result.first() is not None
+
+
+async def index_exists(conn: AsyncConnection, index: str) -> bool:
+    """
+    Checks the catalog for an index, so it is not rebuilt under a table lock.
+    """
+    result = await conn.execute(text("SELECT to_regclass(:index)"), {"index": index})
+    return result.scalar() is not None
+
+
+async def get_db() -> AsyncSession:
+    """
+    Yields the session of the current request.
+
+    Authentication and the route handler depend on it alike, so FastAPI
+    gives them the same session and a request checks out one connection.
+    """
+    async with SessionLocal() as session:
+        yield session
+
+
+async def read_only(db: AsyncSession = Depends(get_db)):
+    """
+    Marks the session of the current request as read-only.
+
+    Use as a route dependency, it runs before the first query.
+    """
+    db.info["read_only"] = True
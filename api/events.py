@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from config import get_optional_config, EventsConfig
+from database import db_config, engines, listen_dsns, trigger_exists
+from metrics import metrics
+
+events_config = get_optional_config(EventsConfig, "events")
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+CHANNEL = "note_events"
+
+# Events kept per user for clients resuming with Last-Event-ID
+HISTORY_SIZE = 100
+
+# How many users keep their event history in memory
+MAX_HISTORY_USERS = 10000
+
+# Events a slow client may fall behind before it is told to refetch
+QUEUE_SIZE = 100
+
+# Comment sent to idle streams, so proxies keep the connection open
+HEARTBEAT_SECONDS = 15
+
+# Delay before listening again after the connection was lost
+RECONNECT_SECONDS = 1
+
+# Sent instead of the missed events when they are no longer known
+RESET = {"type": "reset"}
+
+# Notifies the writes on `notes` when their transaction commits.
+# The payload only identifies the note, it must stay under 8000 bytes.
+NOTE_EVENTS_DDL = (
+    'CREATE SEQUENCE IF NOT EXISTS note_events_seq',
+    f'''
+    CREATE OR REPLACE FUNCTION notes_notify() RETURNS trigger AS $$
+    DECLARE
+        note RECORD;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            note := OLD;
+        ELSE
+            note := NEW;
+        END IF;
+
+        PERFORM pg_notify('{CHANNEL}', json_build_object(
+            'id', nextval('note_events_seq'),
+            'type', lower(TG_OP),
+            'owner_id', note.owner_id,
+            'note_id', note.id,
+            'version', note.version)::text);
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+)
+
+NOTE_EVENTS_TRIGGER = '''
+    CREATE TRIGGER notes_notify
+    AFTER INSERT OR UPDATE OR DELETE ON notes
+    FOR EACH ROW EXECUTE FUNCTION notes_notify()
+'''
+
+
+async def install_note_events(conn: AsyncConnection):
+    """
+    Installs the trigger notifying note writes on the `notes` table,
+    or removes it when `events.enabled` is off.
+
+    A transaction sending a NOTIFY takes a database-wide lock at commit,
+    so with the trigger all note writes commit one at a time, which also
+    limits what `batching` can gain. The trigger is only created or
+    dropped when the catalog shows it is needed, see `install_tag_stats`.
+
+    Args:
+        conn (AsyncConnection): The connection to install the trigger with.
+    """
+    if not events_config.enabled:
+        if await trigger_exists(conn, "notes", "notes_notify"):
+            logger.info('Dropping the notes_notify trigger, events are disabled')
+            await conn.execute(text("DROP TRIGGER notes_notify ON notes"))
+        return
+
+    for statement in NOTE_EVENTS_DDL:
+        await conn.execute(text(statement))
+    if not await trigger_exists(conn, "notes", "notes_notify"):
+        logger.info('Creating the notes_notify trigger')
+        await conn.execute(text(NOTE_EVENTS_TRIGGER))
+
+
+class NoteEventHub:
+    """
+    Fans the note events of every shard out to the streams of this worker.
+
+    Each shard is listened to with a single connection, whatever the
+    number of clients. The last events of every user are kept, so a client
+    reconnecting with Last-Event-ID gets what it missed.
+    """
+    def __init__(self,
+                 history_size: int = HISTORY_SIZE,
+                 max_users: int = MAX_HISTORY_USERS,
+                 queue_size: int = QUEUE_SIZE):
+        self.history_size = history_size
+        self.max_users = max_users
+        self.queue_size = queue_size
+        self._subscribers: Dict[Tuple[int, int], Set[asyncio.Queue]] = {}
+        self._history: OrderedDict[Tuple[int, int], deque] = OrderedDict()
+        self._listeners: List[asyncio.Task] = []
+        metrics.gauge('notes.stream.subscribers',
+                      lambda: sum(len(queues) for queues in self._subscribers.values()))
+
+    def start(self):
+        """
+        Starts listening to every shard.
+        """
+        self._listeners = [asyncio.create_task(self._listen(shard))
+                           for shard in range(len(engines))]
+
+    async def stop(self):
+        """
+        Stops listening.
+        """
+        for task in self._listeners:
+            task.cancel()
+        await asyncio.gather(*self._listeners, return_exceptions=True)
+        self._listeners = []
+
+    def subscribe(self, shard: int, owner_id: int) -> asyncio.Queue:
+        """
+        Returns a queue receiving the events of the user from now on.
+        """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault((shard, owner_id), set()).add(queue)
+        return queue
+
+    def unsubscribe(self, shard: int, owner_id: int, queue: asyncio.Queue):
+        """
+        Stops delivering events to the queue.
+        """
+        queues = self._subscribers.get((shard, owner_id))
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[(shard, owner_id)]
+
+    def since(self, shard: int, owner_id: int, last_id: int) -> Optional[List[dict]]:
+        """
+        Returns the events of the user after the one with `last_id`.
+
+        Returns:
+            Optional[List[dict]]: The missed events in the order they
+                were received, None if `last_id` is no longer known.
+        """
+        history = self._history.get((shard, owner_id), ())
+        for position, event in enumerate(history):
+            if event["id"] == last_id:
+                return list(history)[position + 1:]
+        return None
+
+    def publish(self, shard: int, event: dict):
+        """
+        Delivers an event to the streams of its owner.
+
+        Args:
+            shard (int): The shard the event comes from.
+            event (dict): The event, as notified by `notes_notify`.
+        """
+        key = (shard, event["owner_id"])
+
+        history = self._history.get(key)
+        if history is None:
+            history = self._history[key] = deque(maxlen=self.history_size)
+        history.append(event)
+        self._history.move_to_end(key)
+        while len(self._history) > self.max_users:
+            self._history.popitem(last=False)
+
+        for queue in self._subscribers.get(key, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client is too slow, drop its backlog and make it refetch
+                metrics.incr('notes.stream.overflow')
+                self._reset(queue)
+
+    async def _listen(self, shard: int):
+        listen = self._listen_asyncpg if db_config.driver == "asyncpg" else self._listen_psycopg
+
+        while True:
+            try:
+                await listen(shard, listen_dsns[shard])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'Note events of shard {shard} interrupted: {e}')
+
+            # Events sent while not listening are lost, make the shard's clients refetch
+            for key, queues in self._subscribers.items():
+                if key[0] == shard:
+                    for queue in queues:
+                        self._reset(queue)
+            for key in [key for key in self._history if key[0] == shard]:
+                del self._history[key]
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+    def _on_notify(self, shard: int, payload: str):
+        metrics.incr('notes.events.received')
+        self.publish(shard, json.loads(payload))
+
+    async def _listen_psycopg(self, shard: int, dsn: str):
+        from psycopg import AsyncConnection as PsycopgConnection
+
+        async with await PsycopgConnection.connect(dsn, autocommit=True) as conn:
+            await conn.execute(f"LISTEN {CHANNEL}")
+            logger.info(f'Listening to note events of shard {shard}')
+
+            async for notify in conn.notifies():
+                self._on_notify(shard, notify.payload)
+
+    async def _listen_asyncpg(self, shard: int, dsn: str):
+        import asyncpg
+
+        conn = await asyncpg.connect(dsn)
+        try:
+            closed = asyncio.get_running_loop().create_future()
+            conn.add_termination_listener(
+                lambda conn: closed.done() or closed.set_result(None))
+            await conn.add_listener(
+                CHANNEL, lambda conn, pid, channel, payload: self._on_notify(shard, payload))
+            logger.info(f'Listening to note events of shard {shard}')
+
+            await closed
+        finally:
+            await conn.close()
+
+    @staticmethod
+    def _reset(queue: asyncio.Queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RESET)
+
+
+def format_event(event: dict) -> str:
+    """
+    Formats an event as a server-sent event.
+    """
+    if event is RESET:
+        return "event: reset\ndata: {}\n\n"
+    data = {key: event[key] for key in ("type", "note_id", "version")}
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(shard: int,
+                        owner_id: int,
+                        last_event_id: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Yields the note events of a user as server-sent events.
+
+    Args:
+        shard (int): The shard of the user.
+        owner_id (int): The ID of the user.
+        last_event_id (Optional[str]): The Last-Event-ID sent by a reconnecting client.
+    """
+    queue = note_events.subscribe(shard, owner_id)
+    try:
+        yield f"retry: {RECONNECT_SECONDS * 1000}\n\n"
+
+        # Replay what the client missed, it subscribed first so nothing is lost
+        replayed = set()
+        if last_event_id is not None:
+            missed = (note_events.since(shard, owner_id, int(last_event_id))
+                      if last_event_id.isdigit() else None)
+            if missed is None:
+                yield format_event(RESET)
+            else:
+                for event in missed:
+                    replayed.add(event["id"])
+                    yield format_event(event)
+
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if event is not RESET and event["id"] in replayed:
+                continue
+            yield format_event(event)
+    finally:
+        note_events.unsubscribe(shard, owner_id, queue)
+
+
+note_events = NoteEventHub()
@@ -0,0 +1,66 @@
+from collections import defaultdict
+from typing import Callable, Dict
+
+
+class Summary:
+    """
+    Count, sum, min and max of observed values.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self) -> dict:
+        return {"count": self.count,
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max,
+                "avg": self.sum / self.count if self.count else None}
+
+
+class Metrics:
+    """
+    In-process counters, summaries and gauges of the API worker.
+    """
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.summaries: Dict[str, Summary] = defaultdict(Summary)
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def incr(self, name: str, value: int = 1):
+        """
+        Increments a counter.
+        """
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float):
+        """
+        Adds a value to a summary.
+        """
+        self.summaries[name].observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        """
+        Registers a gauge read from `func` on every snapshot.
+        """
+        self.gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """
+        Returns all metrics as a JSON serializable dictionary.
+        """
+        return {"counters": dict(self.counters),
+                "summaries": {name: summary.as_dict()
+                              for name, summary in self.summaries.items()},
+                "gauges": {name: func() for name, func in self.gauges.items()}}
+
+
+metrics = Metrics()
@@ -1,10 +1,14 @@
 from sqlalchemy import (Column, Integer, String, DateTime,
-                        ForeignKey, Text, func)
+                        ForeignKey, Index, Text, event, func, text)
 from sqlalchemy.orm import (relationship, DeclarativeBase,
                             Mapped, mapped_column)
 from datetime import datetime
 
 from database import Base
+from config import get_optional_config, PartitionConfig
+
+
+partition_config = get_optional_config(PartitionConfig, 'partitions')
 
 
 
@@ -42,12 +46,20 @@ class Note(Base):
         - `tags`: Tags for the note.
         - `created_at`: Timestamp of when the note was created.
         - `updated_at`: Timestamp of when the note was last updated.
+        - `version`: Incremented on every update, used for optimistic locking.
         - `owner_id`: Foreign key to the owner of the note.
         - `owner`: Relationship to the owner of the note.
+
+    The table is hash-partitioned by `owner_id` into `partitions.notes`
+    partitions, so the owner is a part of the primary key.
     """
     __tablename__ = "notes"
+    __table_args__ = (
+        Index("ix_notes_owner_id_id", "owner_id", "id"),
+        {"postgresql_partition_by": "HASH (owner_id)"},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     title = Column(String, index=True)
     content = Column(Text)
     tags = Column(String, index=True)
@@ -58,10 +70,80 @@ class Note(Base):
                  server_default=func.now()
                  )
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
     owner = relationship("User", back_populates="notes", lazy='joined')
 
 
+@event.listens_for(Note.__table__, "after_create")
+def create_note_partitions(target, connection, **kwargs):
+    """
+    Creates the hash partitions of a newly created `notes` table.
+
+    Indexes of the parent table are created on every partition as well.
+    """
+    partitions = partition_config.notes
+    for remainder in range(partitions):
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {target.name}_p{remainder} "
+            f"PARTITION OF {target.name} "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"))
+
+
+class TagStat(Base):
+    """
+    Tag statistics model.
+
+    Maintained by the `notes_tag_stats` trigger on the `notes` table.
+
+    Contains the following fields:
+        - `owner_id`: Foreign key to the owner of the tag.
+        - `tag`: The tag itself.
+        - `count`: Number of the owner's notes using the tag.
+    """
+    __tablename__ = "tag_stats"
+    __table_args__ = (
+        # Serves prefix searches whatever the collation of the database
+        Index("ix_tag_stats_owner_id_tag_prefix", "owner_id", "tag",
+              postgresql_ops={"tag": "text_pattern_ops"}),
+    )
+
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    tag = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class RefreshToken(Base):
+    """
+    Refresh token model.
+
+    Only the HMAC of the token is stored. A token is revoked when it is
+    rotated, revoked by the client or reused after rotation.
+
+    Contains the following fields:
+        - `id`: Unique identifier for the token.
+        - `user_id`: Foreign key to the owner of the token.
+        - `token_hash`: HMAC-SHA256 of the token.
+        - `expires_at`: Timestamp after which the token is not accepted.
+        - `revoked_at`: Timestamp of when the token was revoked.
+        - `created_at`: Timestamp of when the token was issued.
+    """
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"),
+                     nullable=False, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    revoked_at = Column(DateTime(timezone=True), nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+            DateTime(timezone=True),
+            nullable=False,
+            server_default=func.now()
+            )
+
+
 User.notes = relationship("Note", back_populates="owner", lazy='joined')
 
@@ -0,0 +1,242 @@
+"""
+Online migration of an existing plain `notes` table to hash partitions.
+
+Run from the `api` directory while the API keeps serving:
+
+    python partition_notes.py [--partitions N] [--batch-size N] [--shard N]
+
+1. `notes_partitioned` is created with the layout of `models.Note`.
+2. A trigger on `notes` mirrors every write into it.
+3. Existing rows are copied in short batches.
+4. Both tables are swapped by renaming, in one short locked transaction.
+
+The old table is kept as `notes_unpartitioned` and can be dropped
+once the result has been checked. With several shards, every shard
+is migrated in turn unless `--shard` is given.
+"""
+import argparse
+import asyncio
+import logging
+
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from database import engines
+from models import Note, partition_config
+from tags import install_tag_stats
+from events import install_note_events
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+NEW_TABLE = "notes_partitioned"
+OLD_TABLE = "notes_unpartitioned"
+
+MIRROR_DDL = (
+    f'''
+    CREATE OR REPLACE FUNCTION notes_mirror_partitioned() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM {NEW_TABLE}
+             WHERE id = OLD.id AND owner_id = OLD.owner_id;
+        END IF;
+
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.owner_id IS NOT NULL THEN
+            INSERT INTO {NEW_TABLE} SELECT (NEW).*;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS notes_mirror_partitioned ON notes',
+    '''
+    CREATE TRIGGER notes_mirror_partitioned
+    AFTER INSERT OR UPDATE OR DELETE ON notes
+    FOR EACH ROW EXECUTE FUNCTION notes_mirror_partitioned()
+    ''',
+)
+
+
+def new_index_name(name: str) -> str:
+    """
+    Name of a `models.Note` index while it is built on the new table.
+    """
+    return name.replace("notes", NEW_TABLE, 1)
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    """
+    Checks whether `notes` is already a partitioned table.
+    """
+    result = await conn.execute(text("SELECT relkind FROM pg_class "
+                                     "WHERE oid = 'notes'::regclass"))
+    return result.scalar() == "p"
+
+
+async def create_new_table(conn: AsyncConnection, partitions: int):
+    """
+    Creates the partitioned table with its partitions and indexes.
+    """
+    await conn.execute(text(f"CREATE TABLE {NEW_TABLE} "
+                            f"(LIKE notes INCLUDING DEFAULTS) "
+                            f"PARTITION BY HASH (owner_id)"))
+    await conn.execute(text(f"ALTER TABLE {NEW_TABLE} "
+                            f"ALTER COLUMN owner_id SET NOT NULL"))
+    await conn.execute(text(f"ALTER TABLE {NEW_TABLE} "
+                            f"ADD CONSTRAINT {NEW_TABLE}_pkey PRIMARY KEY (id, owner_id)"))
+    await conn.execute(text(f"ALTER TABLE {NEW_TABLE} "
+                            f"ADD CONSTRAINT {NEW_TABLE}_owner_id_fkey "
+                            f"FOREIGN KEY (owner_id) REFERENCES users (id)"))
+
+    for remainder in range(partitions):
+        await conn.execute(text(
+            f"CREATE TABLE {NEW_TABLE}_p{remainder} PARTITION OF {NEW_TABLE} "
+            f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})"))
+
+    for index in Note.__table__.indexes:
+        columns = ", ".join(column.name for column in index.columns)
+        await conn.execute(text(f"CREATE INDEX {new_index_name(index.name)} "
+                                f"ON {NEW_TABLE} ({columns})"))
+
+
+async def copy_rows(engine: AsyncEngine, batch_size: int):
+    """
+    Copies the existing rows in batches of ids, one transaction each.
+
+    Rows are locked while copied, so a concurrent update or delete
+    is applied by the mirror trigger after the copy, never before.
+    """
+    async with engine.connect() as conn:
+        result = await conn.execute(text("SELECT min(id), max(id) FROM notes"))
+        first, last = result.one()
+    if first is None:
+        return
+
+    skipped = 0
+    for start in range(first, last + 1, batch_size):
+        async with engine.begin() as conn:
+            await conn.execute(
+                text(f"INSERT INTO {NEW_TABLE} "
+                     f"SELECT * FROM notes "
+                     f"WHERE id >= :start AND id < :end AND owner_id IS NOT NULL "
+                     f"FOR SHARE "
+                     f"ON CONFLICT DO NOTHING"),
+                {"start": start, "end": start + batch_size})
+            orphans = await conn.execute(
+                text("SELECT count(*) FROM notes "
+                     "WHERE id >= :start AND id < :end AND owner_id IS NULL"),
+                {"start": start, "end": start + batch_size})
+            skipped += orphans.scalar()
+
+        logger.info(f'Copied notes up to id {start + batch_size - 1} of {last}')
+
+    if skipped:
+        logger.warning(f'Skipped {skipped} notes without owner, '
+                       f'they stay in {OLD_TABLE}')
+
+
+async def rename_constraints_and_indexes(conn: AsyncConnection,
+                                         table: str,
+                                         rename):
+    """
+    Renames the constraints and the other indexes of a table.
+    """
+    result = await conn.execute(text("SELECT conname FROM pg_constraint "
+                                     "WHERE conrelid = CAST(:table AS regclass)"),
+                                {"table": table})
+    constraints = list(result.scalars())
+    for name in constraints:
+        await conn.execute(text(f"ALTER TABLE {table} "
+                                f"RENAME CONSTRAINT {name} TO {rename(name)}"))
+
+    result = await conn.execute(text("SELECT indexname FROM pg_indexes "
+                                     "WHERE tablename = :table"),
+                                {"table": table})
+    for name in result.scalars():
+        if name in constraints:
+            continue
+        await conn.execute(text(f"ALTER INDEX {name} RENAME TO {rename(name)}"))
+
+
+async def swap_tables(conn: AsyncConnection, partitions: int):
+    """
+    Replaces `notes` with the partitioned table.
+
+    Runs in one transaction holding an exclusive lock on `notes`,
+    which only lasts for the renames.
+    """
+    await conn.execute(text("LOCK TABLE notes IN ACCESS EXCLUSIVE MODE"))
+    await conn.execute(text("DROP TRIGGER notes_mirror_partitioned ON notes"))
+    await conn.execute(text("DROP TRIGGER IF EXISTS notes_tag_stats ON notes"))
+    await conn.execute(text("DROP TRIGGER IF EXISTS notes_notify ON notes"))
+
+    # Move the old table out of the way
+    await rename_constraints_and_indexes(conn, "notes",
+                                         lambda name: f"{name}_unpartitioned")
+    await conn.execute(text(f"ALTER TABLE notes RENAME TO {OLD_TABLE}"))
+
+    # Give the new table the names of the model
+    await rename_constraints_and_indexes(conn, NEW_TABLE,
+                                         lambda name: name.replace(NEW_TABLE, "notes", 1))
+    await conn.execute(text(f"ALTER TABLE {NEW_TABLE} RENAME TO notes"))
+    for remainder in range(partitions):
+        await conn.execute(text(f"ALTER TABLE {NEW_TABLE}_p{remainder} "
+                                f"RENAME TO notes_p{remainder}"))
+
+    # The id sequence must outlive the old table
+    await conn.execute(text("ALTER SEQUENCE notes_id_seq OWNED BY notes.id"))
+    await conn.execute(text("DROP FUNCTION notes_mirror_partitioned()"))
+
+    await install_tag_stats(conn)
+    await install_note_events(conn)
+
+
+async def migrate(engine: AsyncEngine, partitions: int, batch_size: int):
+    """
+    Runs the whole migration on one shard.
+    """
+    async with engine.begin() as conn:
+        if await is_partitioned(conn):
+            logger.info('Table notes is already partitioned')
+            return
+
+        logger.info(f'Creating {NEW_TABLE} with {partitions} partitions')
+        await create_new_table(conn, partitions)
+
+        # Mirror new writes before copying, so nothing is missed
+        for statement in MIRROR_DDL:
+            await conn.execute(text(statement))
+
+    await copy_rows(engine, batch_size)
+
+    async with engine.begin() as conn:
+        await swap_tables(conn, partitions)
+
+    logger.info(f'Table notes is partitioned, the old table is {OLD_TABLE}')
+
+
+async def main(partitions: int, batch_size: int, shard: Optional[int] = None):
+    """
+    Runs the migration on the given shard or on all of them.
+    """
+    shards = range(len(engines)) if shard is None else [shard]
+    for shard in shards:
+        logger.info(f'Migrating shard {shard}')
+        await migrate(engines[shard], partitions, batch_size)
+        await engines[shard].dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition the notes table online")
+    parser.add_argument("--partitions", type=int, default=partition_config.notes)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--shard", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.partitions, args.batch_size, args.shard))
@@ -0,0 +1,50 @@
+import functools
+
+from typing import Callable, Optional
+
+
+class LazyLimiter:
+    """
+    Rate limiter that imports slowapi on the first limited request.
+
+    Routes are decorated at import time, but slowapi and its storage
+    backends are only loaded once traffic arrives, which keeps them out
+    of the API cold start.
+    """
+    def __init__(self, key_func: Callable):
+        self.key_func = key_func
+        self.enabled = True
+        self._limiter = None
+
+    @property
+    def limiter(self):
+        """
+        The underlying slowapi limiter, created on first use.
+        """
+        if self._limiter is None:
+            from slowapi import Limiter
+
+            self._limiter = Limiter(key_func=self.key_func, enabled=self.enabled)
+        return self._limiter
+
+    def limit(self, limit_value: str):
+        """
+        Decorator limiting a route, like `slowapi.Limiter.limit`.
+
+        Args:
+            limit_value (str): The rate limit, e.g. "5/second".
+        """
+        def decorator(func):
+            limited: Optional[Callable] = None
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                nonlocal limited
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                if limited is None:
+                    limited = self.limiter.limit(limit_value)(func)
+                return await limited(*args, **kwargs)
+
+            return wrapper
+        return decorator
@@ -0,0 +1,72 @@
+import json
+
+from datetime import date, datetime
+from typing import Dict, Optional
+
+from fastapi import Response
+from sqlalchemy.engine import Result, Row
+
+from models import Note
+from schemas import Note as NoteSchema
+from config import get_optional_config, ReadsConfig
+
+
+reads_config = get_optional_config(ReadsConfig, 'reads')
+
+# The columns of the `Note` schema, in its field order
+NOTE_COLUMNS = tuple(Note.__table__.c[name] for name in NoteSchema.model_fields)
+
+
+def json_default(value):
+    """
+    Encodes the values `json` does not know like pydantic does.
+    """
+    if isinstance(value, (datetime, date)):
+        text = value.isoformat()
+        return text[:-6] + "Z" if text.endswith("+00:00") else text
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(data) -> str:
+    return json.dumps(data, default=json_default, separators=(",", ":"))
+
+
+def use_core() -> bool:
+    """
+    Whether the hot read endpoints use the Core path (`reads.engine`).
+    """
+    return reads_config.engine == "core"
+
+
+def notes_response(result: Result) -> Response:
+    """
+    Serializes note rows straight to a JSON list.
+
+    The rows are plain tuples selected with `NOTE_COLUMNS`, so there is
+    no identity map, deduplication or model validation on the way.
+
+    Args:
+        result (Result): The result of a select of `NOTE_COLUMNS`.
+
+    Returns:
+        Response: The JSON list of notes.
+    """
+    keys = tuple(result.keys())
+    return Response(dumps([dict(zip(keys, row)) for row in result]),
+                    media_type="application/json")
+
+
+def note_response(row: Row, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Serializes a note row selected with `NOTE_COLUMNS` to JSON.
+
+    Args:
+        row (Row): The note row.
+        headers (Optional[Dict[str, str]]): Extra response headers.
+
+    Returns:
+        Response: The JSON note.
+    """
+    return Response(dumps(row._asdict()),
+                    media_type="application/json",
+                    headers=headers)
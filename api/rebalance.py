@@ -0,0 +1,185 @@
+"""
+Moves users and their notes to another shard.
+
+Run from the `api` directory, for one user or for a whole bucket of users:
+
+    python rebalance.py USERNAME TARGET
+    python rebalance.py USERNAME TARGET --delete-source --source N
+    python rebalance.py --bucket B TARGET
+    python rebalance.py --bucket B TARGET --delete-source --source N
+
+1. The first command copies the users and their notes from the shard
+   they are routed to now into the `TARGET` shard, and prints the
+   `shards.overrides` or `shards.bucket_moves` entry to add to `config.yaml`.
+2. After the entry is deployed, the second command deletes the users
+   from the old shard `N`. It refuses to run while they are still
+   routed there.
+
+To add a shard, keep `shards.spread_over`, list the new DSN and move
+some buckets to it this way. The other buckets stay where they are.
+
+Users pinned with `shards.overrides` are not moved with their bucket.
+Notes get new IDs on the target shard and keep their timestamps. Writes
+made between the copy and the deployment of the entry stay on the old
+shard and are lost, so move users while they are inactive. Refresh
+tokens are not moved, the users log in again once the old shard is
+cleaned up.
+"""
+import argparse
+import asyncio
+import logging
+
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, select
+
+from database import (SessionLocal, bucket_for, engines, shard_config,
+                      shard_for, shard_of_bucket)
+from models import Note, RefreshToken, User
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+
+async def copy_user(username: str, source: int, target: int) -> int:
+    """
+    Copies the user and their notes from one shard to another.
+
+    Args:
+        username (str): The username of the user to move.
+        source (int): The shard holding the user.
+        target (int): The shard to copy the user to.
+
+    Returns:
+        int: The number of copied notes.
+    """
+    users, notes = User.__table__, Note.__table__
+
+    async with SessionLocal(info={"shard": source}) as db:
+        result = await db.execute(select(users).where(users.c.username == username))
+        user = result.first()
+        if user is None:
+            raise SystemExit(f'User {username} is not on shard {source}')
+        result = await db.execute(select(notes.c.title, notes.c.content,
+                                         notes.c.tags, notes.c.version,
+                                         notes.c.created_at, notes.c.updated_at)
+                                  .where(notes.c.owner_id == user.id)
+                                  .order_by(notes.c.id))
+        rows = [dict(row._mapping) for row in result]
+
+    # One transaction, so a failed copy leaves nothing behind
+    async with SessionLocal(info={"shard": target}) as db:
+        result = await db.execute(insert(users)
+                                  .values(username=username,
+                                          password=user.password,
+                                          created_at=user.created_at)
+                                  .returning(users.c.id))
+        owner_id = result.scalar()
+        if rows:
+            await db.execute(insert(notes),
+                             [dict(row, owner_id=owner_id) for row in rows])
+        await db.commit()
+
+    return len(rows)
+
+
+async def delete_user(username: str, source: int):
+    """
+    Deletes the user and everything they own from a shard.
+
+    Args:
+        username (str): The username of the user.
+        source (int): The shard to delete the user from.
+    """
+    users = User.__table__
+    async with SessionLocal(info={"shard": source}) as db:
+        owner_id = (select(users.c.id)
+                    .where(users.c.username == username)
+                    .scalar_subquery())
+        await db.execute(delete(Note.__table__).where(Note.__table__.c.owner_id == owner_id))
+        await db.execute(delete(RefreshToken.__table__)
+                         .where(RefreshToken.__table__.c.user_id == owner_id))
+        await db.execute(delete(users).where(users.c.username == username))
+        await db.commit()
+
+
+async def bucket_users(bucket: int, source: int) -> List[str]:
+    """
+    Returns the users of a bucket stored on a shard, except the pinned ones.
+    """
+    async with SessionLocal(info={"shard": source}) as db:
+        result = await db.execute(select(User.__table__.c.username))
+        return [username for username, in result
+                if bucket_for(username) == bucket
+                and username not in shard_config.overrides]
+
+
+async def main(username: Optional[str],
+               target: int,
+               delete_source: bool = False,
+               source: Optional[int] = None,
+               bucket: Optional[int] = None):
+    """
+    Runs one step of moving a user or a bucket of users.
+    """
+    if not 0 <= target < len(engines):
+        raise SystemExit(f'There is no shard {target}')
+    if (username is None) == (bucket is None):
+        raise SystemExit('Give either a username or --bucket')
+    if bucket is not None and not 0 <= bucket < shard_config.buckets:
+        raise SystemExit(f'There is no bucket {bucket}')
+
+    routed_to = shard_for(username) if bucket is None else shard_of_bucket(bucket)
+    name = f'user {username}' if bucket is None else f'bucket {bucket}'
+
+    if delete_source:
+        if source is None:
+            raise SystemExit('--delete-source needs --source')
+        if routed_to != target:
+            raise SystemExit(f'The {name} is still routed to shard {routed_to}')
+        if source == target:
+            raise SystemExit('The source shard is the target shard')
+
+        usernames = [username] if bucket is None else await bucket_users(bucket, source)
+        for moved in usernames:
+            await delete_user(moved, source)
+        logger.info(f'Deleted {len(usernames)} users of the {name} from shard {source}')
+    else:
+        if source is None:
+            source = routed_to
+        if source == target:
+            raise SystemExit(f'The {name} is already on shard {target}')
+
+        usernames = [username] if bucket is None else await bucket_users(bucket, source)
+        count = 0
+        for moved in usernames:
+            count += await copy_user(moved, source, target)
+        logger.info(f'Copied {len(usernames)} users with {count} notes of the {name} '
+                    f'from shard {source} to shard {target}')
+
+        if bucket is None:
+            entry, argument = f'overrides:\n    {username}: {target}', username
+        else:
+            entry, argument = f'bucket_moves:\n    {bucket}: {target}', f'--bucket {bucket}'
+        print(f'Add to config.yaml and deploy:\n\n'
+              f'shards:\n  {entry}\n\n'
+              f'then run: python rebalance.py {argument} {target} '
+              f'--delete-source --source {source}')
+
+    for engine in engines:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move users to another shard")
+    parser.add_argument("username", nargs="?", default=None)
+    parser.add_argument("target", type=int)
+    parser.add_argument("--bucket", type=int, default=None)
+    parser.add_argument("--delete-source", action="store_true")
+    parser.add_argument("--source", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.username, args.target, args.delete_source, args.source, args.bucket))
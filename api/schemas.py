@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 
 
@@ -13,6 +13,12 @@ class UserCreate(UserBase):
 
 class Token(BaseModel):
     password: str
+    refresh_token: str
+    expires_in: int
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class User(UserBase):
@@ -33,12 +39,25 @@ class NoteCreate(NoteBase):
     pass
 
 
+class NoteUpdate(NoteBase):
+    version: Optional[int] = None
+
+
 class Note(NoteBase):
     id: int
     created_at: datetime
     updated_at: datetime
     owner_id: int
+    version: int
 
     class Config:
         orm_mode = True
 
+
+class NotesDigest(BaseModel):
+    digest: str
+
+
+class TagCount(BaseModel):
+    tag: str
+    count: int
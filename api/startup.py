@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from sqlalchemy import text
+
+from database import engines, db_config, column_exists, index_exists
+from models import Base
+from tags import install_tag_stats
+from events import events_config, install_note_events, note_events
+from batching import note_batcher
+from bloom import user_filter
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+
+async def create_tables():
+    """
+    Create tables in the database.
+
+    This function asynchronously creates tables in the database. It uses the `engine` object to create a connection
+    and then executes the `Base.metadata.create_all()` method.
+    The triggers maintaining tag statistics and notifying note
+    events are installed as well.
+    Every shard gets the same schema.
+
+    Schema changes are only made when the catalog shows they are missing,
+    so a restart takes no lock on `notes`. API processes starting together
+    take turns through an advisory lock.
+    """
+    for engine in engines:
+        async with engine.begin() as conn:
+            await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('create_tables'))"))
+            await conn.run_sync(Base.metadata.create_all)
+
+            # Columns added after the first release
+            if not await column_exists(conn, "notes", "version"):
+                logger.info('Adding notes.version')
+                await conn.execute(text("ALTER TABLE notes "
+                                        "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+            # Indexes added after the first release
+            if not await index_exists(conn, "ix_tag_stats_owner_id_tag_prefix"):
+                logger.info('Adding ix_tag_stats_owner_id_tag_prefix')
+                await conn.execute(text("CREATE INDEX ix_tag_stats_owner_id_tag_prefix "
+                                        "ON tag_stats (owner_id, tag text_pattern_ops)"))
+
+            await install_tag_stats(conn)
+            await install_note_events(conn)
+
+
+async def warm_pool(size: int):
+    """
+    Opens `size` pooled connections to every shard at once, so the first
+    requests do not pay for connecting to the database.
+
+    Args:
+        size (int): The number of connections to open per shard.
+    """
+    async def ping(engine):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping(engine) for engine in engines for _ in range(size)))
+
+
+async def check_database(timeout: float = 1.0) -> bool:
+    """
+    Checks that every shard answers within `timeout` seconds.
+    """
+    async def ping(engine):
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*(ping(engine) for engine in engines)),
+                               timeout)
+    except Exception as e:
+        logger.warning(f'Database check failed: {e}')
+        return False
+    return True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prepares the database before the API accepts traffic
+    and releases the resources on shutdown.
+
+    `app.state.ready` is set once the tables exist, the pool is warm
+    and the filter of registered usernames is loaded, if enabled.
+    """
+    started = time.perf_counter()
+    app.state.ready = False
+
+    await create_tables()
+    await warm_pool(db_config.pool_size)
+    await user_filter.load()
+    if events_config.enabled:
+        note_events.start()
+
+    app.state.ready = True
+
+    logger.info(f'API ready in {(time.perf_counter() - started) * 1000:.0f} ms')
+    process_started = getattr(app.state, 'process_started', None)
+    if process_started is not None:
+        logger.info(f'API cold start took {(time.perf_counter() - process_started) * 1000:.0f} ms')
+
+    yield
+
+    app.state.ready = False
+    await note_events.stop()
+
+    # Write the notes still waiting in the batcher
+    if note_batcher is not None:
+        await note_batcher.stop()
+
+    for engine in engines:
+        await engine.dispose()
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import logging
+
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.future import select
+
+from models import User
+from database import SessionLocal, engines, trigger_exists
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# Keeps `tag_stats` in sync with `notes` in the writing transaction itself,
+# so every note write pays for its own tags and reads never aggregate notes
+TAG_STATS_DDL = (
+    r'''
+    CREATE OR REPLACE FUNCTION notes_tag_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE'
+           AND OLD.tags IS NOT DISTINCT FROM NEW.tags
+           AND OLD.owner_id IS NOT DISTINCT FROM NEW.owner_id THEN
+            RETURN NULL;
+        END IF;
+
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE tag_stats AS s
+               SET count = s.count - 1
+              FROM (SELECT DISTINCT t.tag
+                      FROM regexp_split_to_table(OLD.tags, '\s+') AS t(tag)
+                     WHERE t.tag <> '') AS o
+             WHERE s.owner_id = OLD.owner_id AND s.tag = o.tag;
+
+            DELETE FROM tag_stats
+             WHERE owner_id = OLD.owner_id AND count <= 0;
+        END IF;
+
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.owner_id IS NOT NULL THEN
+            INSERT INTO tag_stats (owner_id, tag, count)
+            SELECT DISTINCT NEW.owner_id, t.tag, 1
+              FROM regexp_split_to_table(NEW.tags, '\s+') AS t(tag)
+             WHERE t.tag <> ''
+            ON CONFLICT (owner_id, tag)
+            DO UPDATE SET count = tag_stats.count + 1;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''',
+)
+
+TAG_STATS_TRIGGER = '''
+    CREATE TRIGGER notes_tag_stats
+    AFTER INSERT OR UPDATE OR DELETE ON notes
+    FOR EACH ROW EXECUTE FUNCTION notes_tag_stats()
+'''
+
+RECOUNT_SQL = (
+    'SELECT id FROM notes WHERE owner_id = :owner_id FOR SHARE',
+    'DELETE FROM tag_stats WHERE owner_id = :owner_id',
+    r'''
+    INSERT INTO tag_stats (owner_id, tag, count)
+    SELECT n.owner_id, t.tag, count(DISTINCT n.id)
+      FROM notes AS n
+     CROSS JOIN LATERAL regexp_split_to_table(n.tags, '\s+') AS t(tag)
+     WHERE n.owner_id = :owner_id AND t.tag <> ''
+     GROUP BY n.owner_id, t.tag
+    ''',
+)
+
+
+async def install_tag_stats(conn: AsyncConnection):
+    """
+    Installs the trigger maintaining `tag_stats` on the `notes` table.
+
+    The trigger function is replaced in place, which does not lock `notes`.
+    The trigger itself is only created if it is missing.
+
+    Args:
+        conn (AsyncConnection): The connection to install the trigger with.
+    """
+    for statement in TAG_STATS_DDL:
+        await conn.execute(text(statement))
+    if not await trigger_exists(conn, "notes", "notes_tag_stats"):
+        logger.info('Creating the notes_tag_stats trigger')
+        await conn.execute(text(TAG_STATS_TRIGGER))
+
+
+async def recount_tag_stats(db: AsyncSession,
+                            owner_id: Optional[int] = None) -> int:
+    """
+    Rebuilds `tag_stats` from the notes, repairing any drift.
+
+    Every user is recounted in a separate short transaction.
+
+    Args:
+        db (AsyncSession): The database session to use.
+        owner_id (Optional[int]): The user to recount. Defaults to all users.
+
+    Returns:
+        int: The number of recounted users.
+    """
+    if owner_id is None:
+        result = await db.execute(select(User.id))
+        owner_ids = list(result.scalars())
+    else:
+        owner_ids = [owner_id]
+
+    for owner_id in owner_ids:
+        logger.info(f'Recounting tags of user {owner_id}')
+
+        for statement in RECOUNT_SQL:
+            await db.execute(text(statement), {"owner_id": owner_id})
+        await db.commit()
+
+    return len(owner_ids)
+
+
+async def main(owner_id: Optional[int] = None,
+               shard: Optional[int] = None):
+    """
+    Recounts tag statistics from the command line.
+
+    Every shard is recounted unless one is given.
+    """
+    shards = range(len(engines)) if shard is None else [shard]
+    for shard in shards:
+        async with SessionLocal(info={"shard": shard}) as db:
+            count = await recount_tag_stats(db, owner_id)
+        logger.info(f'Recounted tags of {count} users on shard {shard}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recount tag statistics")
+    parser.add_argument("--owner-id", type=int, default=None)
+    parser.add_argument("--shard", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.owner_id, args.shard))
@@ -0,0 +1,56 @@
+import pytest
+
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+
+async def refresh(client, refresh_token: str):
+    return await client.post("/token/refresh", json={"refresh_token": refresh_token})
+
+
+async def test_refresh_rotates_token(client, user):
+    response = await refresh(client, user.tokens["refresh_token"])
+
+    assert response.status_code == 200
+    tokens = response.json()
+    assert tokens["refresh_token"] != user.tokens["refresh_token"]
+    response = await client.get("/notes/",
+                                headers={"Authorization": f"Bearer {tokens['password']}"})
+    assert response.status_code == 200
+
+
+async def test_reuse_within_grace_is_only_rejected(client, user):
+    # E.g. two bot workers refreshing the same session at once
+    rotated = await refresh(client, user.tokens["refresh_token"])
+    assert rotated.status_code == 200
+
+    response = await refresh(client, user.tokens["refresh_token"])
+
+    assert response.status_code == 401
+    response = await refresh(client, rotated.json()["refresh_token"])
+    assert response.status_code == 200
+
+
+async def test_reuse_after_grace_revokes_all_tokens(client, user, other_user, monkeypatch):
+    import auth
+
+    monkeypatch.setattr(auth, "REFRESH_REUSE_GRACE_SECONDS", 0)
+    rotated = await refresh(client, user.tokens["refresh_token"])
+    assert rotated.status_code == 200
+
+    response = await refresh(client, user.tokens["refresh_token"])
+
+    assert response.status_code == 401
+    response = await refresh(client, rotated.json()["refresh_token"])
+    assert response.status_code == 401
+    # Other users keep their sessions
+    response = await refresh(client, other_user.tokens["refresh_token"])
+    assert response.status_code == 200
+
+
+async def test_revoked_token_is_rejected(client, user):
+    response = await client.post("/token/revoke",
+                                 json={"refresh_token": user.tokens["refresh_token"]})
+    assert response.status_code == 204
+
+    response = await refresh(client, user.tokens["refresh_token"])
+    assert response.status_code == 401
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from sqlalchemy.exc import IntegrityError
+
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+
+async def owner_id_of(client, user) -> int:
+    response = await client.post("/notes/", headers=user.headers,
+                                 json={"title": "First", "content": "-", "tags": ""})
+    assert response.status_code == 200
+    return response.json()["owner_id"]
+
+
+async def test_batch_is_one_insert(client, user):
+    from batching import NoteWriteBatcher
+
+    owner_id = await owner_id_of(client, user)
+    batcher = NoteWriteBatcher(max_batch=8, max_delay_ms=50)
+
+    notes = await asyncio.gather(*(batcher.create({"title": f"Note {i}", "content": "-",
+                                                   "tags": "", "owner_id": owner_id})
+                                   for i in range(5)))
+    await batcher.stop()
+
+    # Every request gets its own row back, in order
+    assert [note["title"] for note in notes] == [f"Note {i}" for i in range(5)]
+    assert len({note["id"] for note in notes}) == 5
+
+
+async def test_failed_batch_fails_only_bad_notes(client, user):
+    from batching import NoteWriteBatcher
+
+    owner_id = await owner_id_of(client, user)
+    batcher = NoteWriteBatcher(max_batch=8, max_delay_ms=50)
+
+    # The unknown owner breaks the multi-row insert
+    results = await asyncio.gather(
+        batcher.create({"title": "Good 1", "content": "-", "tags": "", "owner_id": owner_id}),
+        batcher.create({"title": "Bad", "content": "-", "tags": "", "owner_id": -1}),
+        batcher.create({"title": "Good 2", "content": "-", "tags": "", "owner_id": owner_id}),
+        return_exceptions=True)
+    await batcher.stop()
+
+    assert results[0]["title"] == "Good 1"
+    assert isinstance(results[1], IntegrityError)
+    assert results[2]["title"] == "Good 2"
+
+    response = await client.get("/notes/", headers=user.headers, params={"limit": 10})
+    titles = {note["title"] for note in response.json()}
+    assert {"Good 1", "Good 2"} <= titles and "Bad" not in titles
@@ -0,0 +1,19 @@
+import pytest
+
+from pydantic import ValidationError
+
+from config import ShardConfig
+
+DSNS = ["postgresql://postgres@127.0.0.1/notes_0",
+        "postgresql://postgres@127.0.0.1/notes_1"]
+
+
+def test_spread_over_within_shards():
+    config = ShardConfig.model_validate({"dsns": DSNS, "spread_over": 2})
+    assert config.spread_over == 2
+
+
+@pytest.mark.parametrize("spread_over", [0, 3])
+def test_spread_over_outside_shards(spread_over):
+    with pytest.raises(ValidationError, match="spread_over"):
+        ShardConfig.model_validate({"dsns": DSNS, "spread_over": spread_over})
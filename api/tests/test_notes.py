@@ -0,0 +1,135 @@
+import pytest
+
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+NOTE = {"title": "Groceries", "content": "Milk and bread", "tags": "home shopping"}
+
+
+async def create(client, user, note: dict = NOTE) -> dict:
+    response = await client.post("/notes/", headers=user.headers, json=note)
+    assert response.status_code == 200
+    return response.json()
+
+
+async def suggest(client, user, prefix: str) -> list:
+    response = await client.get("/tags/suggest", params={"prefix": prefix},
+                                headers=user.headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+async def test_create_note(client, user):
+    assert await suggest(client, user, "ho") == []
+
+    note = await create(client, user)
+
+    assert note["title"] == "Groceries"
+    assert note["version"] == 1
+    assert await suggest(client, user, "ho") == [{"tag": "home", "count": 1}]
+
+    response = await client.get(f"/notes/{note['id']}", headers=user.headers)
+    assert response.status_code == 200
+    assert response.json()["content"] == "Milk and bread"
+
+
+async def test_create_note_batched(client, user, monkeypatch):
+    import api
+    from batching import NoteWriteBatcher
+
+    batcher = NoteWriteBatcher(max_batch=8, max_delay_ms=1)
+    monkeypatch.setattr(api, "note_batcher", batcher)
+    try:
+        note = await create(client, user)
+    finally:
+        await batcher.stop()
+
+    response = await client.get("/notes/", headers=user.headers)
+    assert [listed["id"] for listed in response.json()] == [note["id"]]
+    assert await suggest(client, user, "sh") == [{"tag": "shopping", "count": 1}]
+
+
+async def test_update_note(client, user):
+    note = await create(client, user)
+    assert await suggest(client, user, "wo") == []
+
+    response = await client.put(f"/notes/{note['id']}", headers={**user.headers, "If-Match": '"1"'},
+                                json={"title": "Plan", "content": "Call Bob", "tags": "work"})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"'
+    assert response.json()["version"] == 2
+    assert await suggest(client, user, "wo") == [{"tag": "work", "count": 1}]
+    assert await suggest(client, user, "ho") == []
+
+    # The same version again is a conflict
+    response = await client.put(f"/notes/{note['id']}", headers={**user.headers, "If-Match": '"1"'},
+                                json={"title": "Plan", "content": "Call Ann", "tags": "work"})
+    assert response.status_code == 412
+
+
+async def test_delete_note(client, user):
+    note = await create(client, user)
+    assert await suggest(client, user, "ho") == [{"tag": "home", "count": 1}]
+
+    response = await client.delete(f"/notes/{note['id']}", headers=user.headers)
+
+    assert response.status_code == 200
+    assert response.json()["id"] == note["id"]
+    assert await suggest(client, user, "ho") == []
+
+    response = await client.get(f"/notes/{note['id']}", headers=user.headers)
+    assert response.status_code == 404
+    response = await client.delete(f"/notes/{note['id']}", headers=user.headers)
+    assert response.status_code == 404
+
+
+async def test_suggest_tags(client, user, other_user):
+    await create(client, user, {**NOTE, "tags": "work_plan workout"})
+    await create(client, user, {**NOTE, "tags": "workout"})
+    await create(client, other_user, {**NOTE, "tags": "work"})
+
+    # Most used first, only the tags of the user
+    assert await suggest(client, user, "wor") == [{"tag": "workout", "count": 2},
+                                                  {"tag": "work_plan", "count": 1}]
+    # Wildcards of LIKE are matched literally
+    assert await suggest(client, user, "work_") == [{"tag": "work_plan", "count": 1}]
+    assert await suggest(client, user, "%") == []
+
+
+async def test_notes_digest(client, user):
+    async def digest() -> str:
+        response = await client.get("/notes/digest", headers=user.headers)
+        assert response.status_code == 200
+        return response.json()["digest"]
+
+    digests = [await digest()]
+    note = await create(client, user)
+    digests.append(await digest())
+    await client.put(f"/notes/{note['id']}", headers=user.headers,
+                     json={"title": "Plan", "content": "Call Bob", "tags": "work"})
+    digests.append(await digest())
+    await client.delete(f"/notes/{note['id']}", headers=user.headers)
+    digests.append(await digest())
+
+    # Every write changes the digest
+    assert len(set(digests)) == 4
+
+
+async def test_stream_off_by_default(client, user):
+    response = await client.get("/notes/stream", headers=user.headers)
+    assert response.status_code == 404
+
+
+async def test_notes_of_other_users_are_hidden(client, user, other_user):
+    note = await create(client, user)
+
+    response = await client.get(f"/notes/{note['id']}", headers=other_user.headers)
+    assert response.status_code == 404
+    response = await client.put(f"/notes/{note['id']}", headers=other_user.headers,
+                                json={"title": "Mine", "content": "-", "tags": ""})
+    assert response.status_code == 404
+    response = await client.delete(f"/notes/{note['id']}", headers=other_user.headers)
+    assert response.status_code == 404
+
+    response = await client.get(f"/notes/{note['id']}", headers=user.headers)
+    assert response.json()["title"] == "Groceries"
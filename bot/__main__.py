@@ -1,20 +1,21 @@
 import asyncio
 import logging
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
-from aiogram_dialog import setup_dialogs
-from fluentogram import TranslatorHub
 from redis.asyncio.client import Redis
 
 from config import Config, load_config
-from dialog import dialog
-from handler import router
-from unknown_router import unknown_router
-from i18n import TranslatorHub, create_translator_hub
-from middleware import TranslatorRunnerMiddleware
+from dispatcher import build_dispatcher
+from i18n import CachedTranslatorHub, create_translator_hub
+from scheduler import SendScheduler
+from webhook import run_webhook
+from streams import StreamRequestHandler, UpdateStream, run_worker
+from session import TokenStore
+from search import NoteIndex
+from request import api
 
 
 logger = logging.getLogger(__name__)
@@ -33,30 +34,57 @@ async def main():
     logger.info('Starting Bot')
 
     # Config
-    storage = RedisStorage(Redis(host='redis', port=6379, db=0),
+    config: Config = load_config()
+
+    # One Redis connection pool for the FSM storage and the handlers
+    redis = Redis(host=config.redis.host,
+                  port=config.redis.port,
+                  db=config.redis.db,
+                  max_connections=config.redis.max_connections)
+    storage = RedisStorage(redis,
                            key_builder=DefaultKeyBuilder(with_destiny=True))
 
     # Init Bot in Dispatcher
-    config: Config = load_config()
     bot = Bot(token=config.tg_bot.token,
               default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=storage)
+    dp = build_dispatcher(storage)
 
-    # i18n init
-    translator_hub: TranslatorHub = create_translator_hub()
+    # Pace every request to a chat within Telegram's limits
+    scheduler = SendScheduler()
+    bot.session.middleware(scheduler)
 
-    # Routers, dialogs, middlewares
-    dp.include_routers(dialog, router, unknown_router)
+    # i18n init
+    translator_hub: CachedTranslatorHub = create_translator_hub()
 
-    # Register middleware to the Dispatcher
-    dp.update.middleware(TranslatorRunnerMiddleware())
+    api.configure(config.api)
 
-    # Init Dialogs
-    setup_dialogs(dp)
+    # Passed to the handlers in their data
+    data = {'_translator_hub': translator_hub,
+            'redis': redis,
+            'sessions': TokenStore(redis),
+            'search': NoteIndex(redis)}
 
-    # Skipping old updates
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot, _translator_hub=translator_hub)
+    try:
+        if config.mode == 'webhook':
+            await run_webhook(dp, bot, config.webhook, **data)
+        elif config.mode == 'intake':
+            # Only store the updates, the workers handle them
+            stream = UpdateStream(redis, config.stream)
+            await run_webhook(dp, bot, config.webhook,
+                              handler=StreamRequestHandler(dp, bot, stream,
+                                                           secret_token=config.webhook.secret))
+        elif config.mode == 'worker':
+            stream = UpdateStream(redis, config.stream)
+            await run_worker(dp, bot, stream, config.stream,
+                             scheduler=scheduler, **data)
+        else:
+            # Skipping old updates
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot, **data)
+    finally:
+        logger.info(f'API client stats: {api.snapshot()}')
+        await api.close()
+        await redis.aclose()
     return bot
 
 
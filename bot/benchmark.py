@@ -0,0 +1,377 @@
+"""
+Offline benchmark of the bot: synthetic updates through the real dispatcher.
+
+Run from the `bot` directory, next to a Redis server for the tokens,
+the notes cache, the search index and the FSM data. The Redis database
+must be empty, the keys written by the bot are deleted at the end.
+With `--memory-storage` no server is needed: the FSM data is kept in
+aiogram's `MemoryStorage` and everything else in an in-process
+`fakeredis` (from `requirements-test.txt`):
+
+    python benchmark.py [--users N] [--notes N] [--api-latency-ms MS]
+                        [--paced] [--memory-storage]
+                        [--redis-host HOST] [--redis-port PORT] [--redis-db DB]
+
+Every simulated user starts the bot, registers, logs in, creates `--notes`
+notes and opens "My notes" twice, the second time from the cache. The users
+run concurrently, each one sending its next update once the previous one
+is handled.
+
+Telegram is replaced by a bot session recording the outgoing calls,
+and the notes API by a local stub answering after `--api-latency-ms`.
+`--paced` keeps the send scheduler, which holds every chat to Telegram's
+rate limits, so the numbers show what users would wait for.
+
+Reported are the updates handled per second and the latency of every step.
+"""
+import argparse
+import asyncio
+import itertools
+import socket
+import statistics
+import time
+
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+from aiogram.methods import EditMessageText, SendMessage, TelegramMethod
+from aiogram.types import InlineKeyboardMarkup, Message, Update
+from aiohttp import web
+from redis.asyncio.client import Redis
+
+from config import ApiConfig
+from dispatcher import build_dispatcher
+from i18n import create_translator_hub
+from request import api
+from scheduler import SendScheduler
+from session import TokenStore
+from search import NoteIndex
+
+
+BOT_ID = 42
+BOT_TOKEN = f'{BOT_ID}:BENCHMARK'
+
+PASSWORD = 'Bench@1234'
+
+# Lifetime of the stub access tokens
+TOKEN_EXPIRES_IN = 30 * 60
+
+# Keys of the FSM data, the sessions, the notes cache and the search index
+BOT_KEY_PATTERNS = ('fsm:*', 'session:*', 'refresh:*', 'notes:*', 'search:*')
+
+
+class RecordingSession(BaseSession):
+    """
+    Bot session answering every request locally and counting them.
+
+    Sent and edited messages are answered with a message like Telegram
+    would, and the last inline keyboard of every chat is kept, so the
+    simulated users can press its buttons.
+    """
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter = Counter()
+        self.message_ids: Dict[int, int] = defaultdict(int)
+        self.keyboards: Dict[int, Tuple[int, InlineKeyboardMarkup]] = {}
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if not isinstance(method, (SendMessage, EditMessageText)):
+            return True
+
+        chat_id = method.chat_id
+        if isinstance(method, SendMessage):
+            self.message_ids[chat_id] += 1
+            message_id = self.message_ids[chat_id]
+        else:
+            message_id = method.message_id
+
+        if isinstance(method.reply_markup, InlineKeyboardMarkup):
+            self.keyboards[chat_id] = (message_id, method.reply_markup)
+
+        return Message.model_validate({'message_id': message_id,
+                                       'date': int(time.time()),
+                                       'chat': {'id': chat_id, 'type': 'private'},
+                                       'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot'},
+                                       'text': method.text},
+                                      context={'bot': bot})
+
+    def button(self, chat_id: int, widget_id: str) -> Tuple[int, str]:
+        """
+        Returns the message and callback data of a button of the chat's last keyboard.
+        """
+        message_id, keyboard = self.keyboards[chat_id]
+        for row in keyboard.inline_keyboard:
+            for button in row:
+                if button.callback_data and button.callback_data.endswith(widget_id):
+                    return message_id, button.callback_data
+        raise RuntimeError(f'No button {widget_id} in chat {chat_id}')
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536,
+                             raise_for_status=True):
+        raise NotImplementedError('The benchmark does not simulate file downloads')
+        # Unreachable, makes this an async generator like in the real sessions
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class StubApi:
+    """
+    In-memory stand-in of the notes API, answering after `latency` seconds.
+    """
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.users: Dict[str, str] = {}
+        self.notes: Dict[str, List[dict]] = defaultdict(list)
+        self.ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self.delay])
+        app.add_routes([web.head('/users/{username}', self.check_user),
+                        web.post('/users/', self.register_user),
+                        web.post('/token/', self.login),
+                        web.post('/token/refresh', self.refresh),
+                        web.post('/notes/', self.create_note),
+                        web.get('/notes/', self.read_notes),
+                        web.get('/notes/tags/{tag}', self.read_notes_by_tag)])
+        return app
+
+    @web.middleware
+    async def delay(self, request: web.Request, handler):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def tokens(self, username: str) -> dict:
+        return {'password': f'token-{username}',
+                'refresh_token': f'refresh-{username}',
+                'expires_in': TOKEN_EXPIRES_IN,
+                'token_type': 'bearer'}
+
+    def owner(self, request: web.Request) -> str:
+        username = request.headers.get('Authorization', '').removeprefix('Bearer token-')
+        if username not in self.users:
+            raise web.HTTPUnauthorized()
+        return username
+
+    def page(self, request: web.Request, notes: List[dict]) -> web.Response:
+        skip = int(request.query.get('skip', 0))
+        limit = int(request.query.get('limit', len(notes)))
+        return web.json_response(notes[skip:skip + limit])
+
+    async def check_user(self, request: web.Request) -> web.Response:
+        return web.Response(status=200 if request.match_info['username'] in self.users else 404)
+
+    async def register_user(self, request: web.Request) -> web.Response:
+        user = await request.json()
+        if user['username'] in self.users:
+            return web.json_response({'detail': 'Username already registered'}, status=400)
+        self.users[user['username']] = user['password']
+        return web.json_response({'id': next(self.ids), 'username': user['username']})
+
+    async def login(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if self.users.get(form['username']) != form['password']:
+            return web.json_response({'detail': 'Incorrect username or password'}, status=400)
+        return web.json_response(self.tokens(form['username']))
+
+    async def refresh(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        username = body['refresh_token'].removeprefix('refresh-')
+        if username not in self.users:
+            return web.json_response({'detail': 'Invalid refresh token'}, status=401)
+        return web.json_response(self.tokens(username))
+
+    async def create_note(self, request: web.Request) -> web.Response:
+        username = self.owner(request)
+        note = {**await request.json(), 'id': next(self.ids), 'version': 1}
+        self.notes[username].append(note)
+        return web.json_response(note)
+
+    async def read_notes(self, request: web.Request) -> web.Response:
+        return self.page(request, self.notes[self.owner(request)])
+
+    async def read_notes_by_tag(self, request: web.Request) -> web.Response:
+        tag = request.match_info['tag']
+        return self.page(request, [note for note in self.notes[self.owner(request)]
+                                   if tag in note['tags'].split()])
+
+
+class SimulatedUser:
+    """
+    A Telegram user sending updates to the dispatcher and timing them.
+    """
+    update_ids = itertools.count(1)
+
+    def __init__(self,
+                 user_id: int,
+                 dp: Dispatcher,
+                 bot: Bot,
+                 session: RecordingSession,
+                 latencies: Dict[str, List[float]],
+                 data: Dict[str, Any]):
+        self.id = user_id
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': 'Bench',
+                     'username': f'bench_{user_id}', 'language_code': 'ru'}
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.latencies = latencies
+        self.data = data
+
+    async def feed(self, step: str, update: dict):
+        update = Update.model_validate({'update_id': next(self.update_ids), **update},
+                                       context={'bot': self.bot})
+        started = time.perf_counter()
+        await self.dp.feed_update(self.bot, update, **self.data)
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def send(self, step: str, text: str):
+        await self.feed(step, {'message': {'message_id': 0,
+                                           'date': int(time.time()),
+                                           'chat': {'id': self.id, 'type': 'private'},
+                                           'from': self.user,
+                                           'text': text}})
+
+    async def press(self, step: str, widget_id: str):
+        message_id, callback_data = self.session.button(self.id, widget_id)
+        await self.feed(step, {'callback_query': {
+            'id': str(next(self.update_ids)),
+            'from': self.user,
+            'chat_instance': str(self.id),
+            'message': {'message_id': message_id,
+                        'date': int(time.time()),
+                        'chat': {'id': self.id, 'type': 'private'},
+                        'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bot'},
+                        'text': '-'},
+            'data': callback_data}})
+
+    async def run(self, notes: int):
+        await self.send('start', '/start')
+        await self.send('register', PASSWORD)
+        await self.send('login', PASSWORD)
+
+        for i in range(notes):
+            await self.press('create_note', 'b_create_note')
+            await self.send('title', f'Note {i}')
+            await self.send('content', f'Benchmark note {i} of user {self.id}')
+            await self.send('tags', 'bench load')
+            await self.press('confirm', 'b_confirm')
+            await self.press('cancel', 'b_cancel')
+
+        await self.press('my_notes', 'b_my_notes')
+        if notes:
+            await self.press('back', 'b_back')
+        await self.press('my_notes_cached', 'b_my_notes')
+
+
+async def serve_stub(stub: StubApi) -> web.AppRunner:
+    """
+    Serves the stub API on a free local port and points the API client to it.
+    """
+    runner = web.AppRunner(stub.app(), access_log=None)
+    await runner.setup()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    await web.SockSite(runner, sock).start()
+
+    port = sock.getsockname()[1]
+    api.configure(ApiConfig(url=f'http://127.0.0.1:{port}',
+                            timeout=30, retries=0, backoff=0, hedge=False))
+    return runner
+
+
+async def delete_bot_keys(redis: Redis):
+    """
+    Deletes the keys the bot writes, leaving the rest of the database alone.
+    """
+    for pattern in BOT_KEY_PATTERNS:
+        keys = [key async for key in redis.scan_iter(match=pattern, count=1000)]
+        for i in range(0, len(keys), 1000):
+            await redis.delete(*keys[i:i + 1000])
+
+
+async def benchmark(args: argparse.Namespace):
+    if args.memory_storage:
+        from fakeredis import FakeAsyncRedis
+
+        redis = FakeAsyncRedis()
+        storage = MemoryStorage()
+    else:
+        redis = Redis(host=args.redis_host, port=args.redis_port, db=args.redis_db)
+        if await redis.dbsize():
+            await redis.aclose()
+            raise SystemExit(f'Redis database {args.redis_db} is not empty, '
+                             f'pick an unused one with --redis-db')
+        storage = RedisStorage(redis, key_builder=DefaultKeyBuilder(with_destiny=True))
+
+    session = RecordingSession()
+    if args.paced:
+        session.middleware(SendScheduler())
+    bot = Bot(token=BOT_TOKEN, session=session,
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = build_dispatcher(storage)
+
+    data = {'_translator_hub': create_translator_hub(),
+            'redis': redis,
+            'sessions': TokenStore(redis),
+            'search': NoteIndex(redis)}
+
+    runner = await serve_stub(StubApi(args.api_latency_ms / 1000))
+    workflow_data = {'dispatcher': dp, 'bot': bot, **dp.workflow_data, **data}
+    await dp.emit_startup(**workflow_data)
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    users = [SimulatedUser(user_id, dp, bot, session, latencies, data)
+             for user_id in range(1, args.users + 1)]
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(user.run(args.notes) for user in users))
+        elapsed = time.perf_counter() - started
+    finally:
+        await dp.emit_shutdown(**workflow_data)
+        await runner.cleanup()
+        await api.close()
+        if not args.memory_storage:
+            await delete_bot_keys(redis)
+        await redis.aclose()
+
+    updates = sum(len(values) for values in latencies.values())
+    print(f"{args.users} users, {args.notes} notes each, "
+          f"API latency {args.api_latency_ms:.0f} ms"
+          f"{', paced' if args.paced else ''}\n")
+    print(f"{'step':<18}{'updates':>8}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for step, values in latencies.items():
+        values = sorted(value * 1000 for value in values)
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{step:<18}{len(values):>8}"
+              f"{statistics.mean(values):>10.2f}{p95:>10.2f}{values[-1]:>10.2f}")
+
+    print(f"\n{updates} updates in {elapsed:.2f} s: {updates / elapsed:.0f} updates/s")
+    print(f"Bot API calls: {dict(session.calls)}")
+    print(f"API calls: { {endpoint: stats['requests'] for endpoint, stats in api.snapshot().items()} }")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bot benchmark with a stub API")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--notes", type=int, default=3)
+    parser.add_argument("--api-latency-ms", type=float, default=5)
+    parser.add_argument("--paced", action="store_true",
+                        help="pace the replies within Telegram's rate limits")
+    parser.add_argument("--memory-storage", action="store_true",
+                        help="keep all bot data in process, no Redis server needed")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=15)
+
+    asyncio.run(benchmark(parser.parse_args()))
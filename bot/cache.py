@@ -0,0 +1,71 @@
+import json
+import logging
+
+from redis import asyncio as aioredis
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# How long fetched notes are served without asking the API.
+# Notes written elsewhere than in the bot show up after at most this long.
+NOTES_CACHE_TTL = 300
+
+
+def notes_key(user_id: int) -> str:
+    return f'notes:{user_id}'
+
+
+def notes_field(tag: str | None, skip: int, limit: int) -> str:
+    return f'{tag or ""}:{skip}:{limit}'
+
+
+async def get_cached_notes(r: aioredis.Redis,
+                           user_id: int,
+                           tag: str | None,
+                           skip: int,
+                           limit: int) -> list[dict] | None:
+    """
+    Returns a cached chunk of the user's notes, None if it is not cached.
+
+    Args:
+        r (aioredis.Redis): The Redis client.
+        user_id (int): The Telegram ID of the user.
+        tag (str | None): The searched tag, None for all notes.
+        skip (int): The offset of the chunk.
+        limit (int): The size of the chunk.
+    """
+    cached = await r.hget(notes_key(user_id), notes_field(tag, skip, limit))
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+
+async def cache_notes(r: aioredis.Redis,
+                      user_id: int,
+                      tag: str | None,
+                      skip: int,
+                      limit: int,
+                      notes: list[dict]):
+    """
+    Caches a chunk of the user's notes as fetched from the API.
+
+    All chunks of a user live in one hash, which expires `NOTES_CACHE_TTL`
+    after its first chunk, so no chunk is older than that.
+    """
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.hset(notes_key(user_id), notes_field(tag, skip, limit), json.dumps(notes))
+        pipe.expire(notes_key(user_id), NOTES_CACHE_TTL, nx=True)
+        await pipe.execute()
+
+
+async def invalidate_notes(r: aioredis.Redis,
+                           user_id: int):
+    """
+    Drops the cached notes of the user, e.g. after creating a note.
+    """
+    await r.delete(notes_key(user_id))
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Dict
+
+import aiohttp
+
+from config import ApiConfig
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# Methods safe to send twice
+IDEMPOTENT_METHODS = {'GET', 'HEAD'}
+
+# Statuses of an API that is down or overloaded, worth another try
+RETRY_STATUSES = {502, 503, 504}
+
+# Latencies kept per endpoint for the percentiles
+LATENCY_WINDOW = 200
+
+# Responses needed before reads of an endpoint are hedged
+MIN_HEDGE_SAMPLES = 20
+
+# Consecutive failures opening the circuit, and how long it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 10
+
+
+class ApiError(Exception):
+    """
+    The API could not be reached or did not answer in time.
+    """
+
+
+class ApiResponse:
+    """
+    Status and body of an API response, read completely.
+    """
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+    def __repr__(self) -> str:
+        return f'<ApiResponse [{self.status_code}]>'
+
+
+class EndpointStats:
+    """
+    Request, error and latency counters of one endpoint.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.hedged = 0
+        self.rejected = 0
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, seconds: float, error: bool):
+        self.requests += 1
+        self.errors += error
+        if not error:
+            self.latencies.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def as_dict(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'hedged': self.hedged,
+                'rejected': self.rejected,
+                'p50_ms': p50 * 1000 if p50 is not None else None,
+                'p95_ms': p95 * 1000 if p95 is not None else None}
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast while the API is unhealthy.
+
+    After `threshold` failures in a row the circuit opens and requests
+    are refused for `reset_seconds`. Then one request is let through as
+    a probe, and its success closes the circuit again.
+    """
+    def __init__(self,
+                 threshold: int = BREAKER_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probe_started: float | None = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_seconds:
+            return False
+        # A probe that never reported back counts as lost after a while
+        if self.probe_started is not None and now - self.probe_started < self.reset_seconds:
+            return False
+        self.probe_started = now
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def failure(self):
+        self.failures += 1
+        self.probe_started = None
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f'API circuit opened after {self.failures} failures')
+            self.opened_at = time.monotonic()
+
+
+class ApiClient:
+    """
+    HTTP client of the notes API.
+
+    Reads (GET and HEAD) are retried on connection errors, timeouts and
+    502-504 with jittered exponential backoff. A read still running after
+    the p95 latency of its endpoint is hedged: a second request is sent
+    and the first answer wins. Writes are sent once. All requests go
+    through a circuit breaker.
+
+    Args:
+        config (ApiConfig): The API settings.
+    """
+    def __init__(self, config: ApiConfig):
+        self.config = config
+        self.breaker = CircuitBreaker()
+        self.stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created on first use, inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                base_url=self.config.url,
+                timeout=aiohttp.ClientTimeout(total=self.config.timeout))
+        return self._session
+
+    def configure(self, config: ApiConfig):
+        """
+        Replaces the settings, e.g. with the ones from the environment.
+        """
+        self.config = config
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters of every endpoint.
+        """
+        return {endpoint: stats.as_dict() for endpoint, stats in self.stats.items()}
+
+    async def request(self,
+                      method: str,
+                      path: str,
+                      endpoint: str | None = None,
+                      **kwargs: Any) -> ApiResponse:
+        """
+        Sends a request to the API.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The path of the URL.
+            endpoint (str | None): The name the counters are kept under,
+                e.g. for paths with parameters. Defaults to the method and path.
+            **kwargs: Passed to `aiohttp.ClientSession.request`.
+
+        Returns:
+            ApiResponse: The response, also for error statuses.
+
+        Raises:
+            ApiError: If the API did not answer or the circuit is open.
+        """
+        endpoint = endpoint or f'{method} {path}'
+        stats = self.stats[endpoint]
+        idempotent = method in IDEMPOTENT_METHODS
+        attempts = self.config.retries + 1 if idempotent else 1
+
+        async def send() -> ApiResponse:
+            started = time.perf_counter()
+            try:
+                async with self.session.request(method, path, **kwargs) as response:
+                    result = ApiResponse(response.status, await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                stats.observe(time.perf_counter() - started, error=True)
+                raise
+            stats.observe(time.perf_counter() - started,
+                          error=result.status_code >= 500)
+            return result
+
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                stats.rejected += 1
+                raise ApiError(f'{endpoint}: API unavailable')
+
+            try:
+                if idempotent and self.config.hedge:
+                    response = await self._hedged(stats, send)
+                else:
+                    response = await send()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.breaker.failure()
+                error = ApiError(f'{endpoint}: {e!r}')
+                response = None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.success()
+                    return response
+                self.breaker.failure()
+
+            if attempt + 1 < attempts:
+                delay = random.uniform(0, self.config.backoff * 2 ** attempt)
+                logger.info(f'{endpoint} failed, retrying in {delay * 1000:.0f} ms')
+                await asyncio.sleep(delay)
+
+        if response is not None:
+            return response
+        raise error
+
+    async def _hedged(self,
+                      stats: EndpointStats,
+                      send: Callable[[], Awaitable[ApiResponse]]) -> ApiResponse:
+        """
+        Sends a second request if the first one is slower than the p95
+        of the endpoint and returns the first successful answer.
+        """
+        delay = stats.percentile(0.95) if len(stats.latencies) >= MIN_HEDGE_SAMPLES else None
+        first = asyncio.create_task(send())
+        if delay is None:
+            return await first
+
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            stats.hedged += 1
+            pending.add(asyncio.create_task(send()))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # Both failed
+            return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
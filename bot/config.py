@@ -1,3 +1,6 @@
+import os
+import socket
+
 from dataclasses import dataclass
 from environs import Env
 
@@ -7,10 +10,52 @@ class TgBot:
     token: str
 
 
+@dataclass
+class RedisConfig:
+    host: str
+    port: int
+    db: int
+    max_connections: int
+
+
+@dataclass
+class WebhookConfig:
+    url: str
+    path: str
+    host: str
+    port: int
+    secret: str | None
+    max_concurrency: int
+    max_pending: int
+
+
+@dataclass
+class StreamConfig:
+    partitions: int
+    maxlen: int
+    batch_size: int
+    concurrency: int
+    lease_seconds: float
+    worker_id: str
+
+
+@dataclass
+class ApiConfig:
+    url: str
+    timeout: float
+    retries: int
+    backoff: float
+    hedge: bool
+
+
 @dataclass
 class Config:
     tg_bot: TgBot
-
+    redis: RedisConfig
+    mode: str
+    webhook: WebhookConfig
+    stream: StreamConfig
+    api: ApiConfig
 
 
 def load_config(path: str | None = None) -> Config:
@@ -34,4 +79,27 @@ def load_config(path: str | None = None) -> Config:
     """
     env = Env()
     env.read_env(path)
-    return Config(tg_bot=TgBot(token=env('BOT_TOKEN')))
+    return Config(tg_bot=TgBot(token=env('BOT_TOKEN')),
+                  redis=RedisConfig(host=env('REDIS_HOST', 'redis'),
+                                    port=env.int('REDIS_PORT', 6379),
+                                    db=env.int('REDIS_DB', 0),
+                                    max_connections=env.int('REDIS_MAX_CONNECTIONS', 50)),
+                  mode=env('BOT_MODE', 'polling'),
+                  webhook=WebhookConfig(url=env('WEBHOOK_URL', ''),
+                                        path=env('WEBHOOK_PATH', '/webhook'),
+                                        host=env('WEBHOOK_HOST', '0.0.0.0'),
+                                        port=env.int('WEBHOOK_PORT', 8080),
+                                        secret=env('WEBHOOK_SECRET', None),
+                                        max_concurrency=env.int('WEBHOOK_MAX_CONCURRENCY', 100),
+                                        max_pending=env.int('WEBHOOK_MAX_PENDING', 1000)),
+                  stream=StreamConfig(partitions=env.int('STREAM_PARTITIONS', 16),
+                                      maxlen=env.int('STREAM_MAXLEN', 100000),
+                                      batch_size=env.int('STREAM_BATCH_SIZE', 10),
+                                      concurrency=env.int('STREAM_CONCURRENCY', 100),
+                                      lease_seconds=env.float('STREAM_LEASE_SECONDS', 30),
+                                      worker_id=env('WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')),
+                  api=ApiConfig(url=env('API_URL', 'http://api:8000'),
+                                timeout=env.float('API_TIMEOUT', 1),
+                                retries=env.int('API_RETRIES', 2),
+                                backoff=env.float('API_BACKOFF', 0.05),
+                                hedge=env.bool('API_HEDGE', True)))
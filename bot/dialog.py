@@ -92,6 +92,16 @@ dialog = Dialog(
         Button(Format('{button_cancel}'), id='b_cancel', on_click=cancel),
         getter=complete_getter,
         state=MainSG.complete
+        ),
+    Window(
+        Format('{notes_page}'),
+        Row(
+            Button(Format('{button_prev}'), id='b_prev', on_click=prev_notes_page, when='has_prev'),
+            Button(Format('{button_next}'), id='b_next', on_click=next_notes_page, when='has_next')
+            ),
+        Button(Format('{button_back}'), id='b_back', on_click=back_to_main),
+        getter=notes_list_getter,
+        state=MainSG.notes_list
         )
     )
     
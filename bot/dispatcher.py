@@ -0,0 +1,34 @@
+from aiogram import Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram_dialog import setup_dialogs
+
+from dialog import dialog
+from handler import router
+from unknown_router import unknown_router
+from middleware import TranslatorRunnerMiddleware
+
+
+def build_dispatcher(storage: BaseStorage) -> Dispatcher:
+    """
+    Creates the dispatcher with the dialogs, routers and middlewares of the bot.
+
+    The routers can be attached to one dispatcher only,
+    so this is called once per process.
+
+    Args:
+        storage (BaseStorage): The FSM storage.
+
+    Returns:
+        Dispatcher: The dispatcher.
+    """
+    dp = Dispatcher(storage=storage)
+
+    # Routers, dialogs, middlewares
+    dp.include_routers(dialog, router, unknown_router)
+
+    # Register middleware to the Dispatcher
+    dp.update.middleware(TranslatorRunnerMiddleware())
+
+    # Init Dialogs
+    setup_dialogs(dp)
+    return dp
@@ -0,0 +1,41 @@
+import asyncio
+
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, concurrent callers of a key share its outcome.
+
+    If the running call is cancelled, e.g. with the update that started it,
+    the callers waiting for it make the call themselves instead of waiting forever.
+    """
+    def __init__(self):
+        self._running: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        while (running := self._running.get(key)) is not None:
+            try:
+                return await asyncio.shield(running)
+            except asyncio.CancelledError:
+                if not running.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = self._running[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await call()
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting, do not log the error as never retrieved
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._running[key]
@@ -6,6 +6,8 @@ from aiogram.fsm.context import FSMContext
 from aiogram_dialog import DialogManager
 from fluentogram import TranslatorRunner
 
+from handler import NOTES_SEPARATOR, pack_page
+
 
 logger = logging.getLogger(__name__)
 
@@ -168,3 +170,28 @@ async def complete_getter(dialog_manager: DialogManager,
             'button_cancel': i18n.button.cancel()}
 
 
+async def notes_list_getter(dialog_manager: DialogManager,
+                            i18n: TranslatorRunner,
+                            event_from_user: User,
+                            **kwargs
+                            ) -> dict:
+    """
+    Getter for the notes list.
+
+    Packs the notes of the current page into one message.
+
+    Returns:
+        dict: Dictionary with the notes of the page and the paging buttons.
+    """
+    data = dialog_manager.dialog_data
+    start = data['starts'][data['page']]
+    end = pack_page(data['notes'], start)
+
+    logger.info(f'User {event_from_user.username} on notes page {data["page"]}')
+
+    return {'notes_page': NOTES_SEPARATOR.join(data['notes'][start:end]),
+            'has_prev': data['page'] > 0,
+            'has_next': end < len(data['notes']),
+            'button_prev': i18n.button.prev(),
+            'button_next': i18n.button.next(),
+            'button_back': i18n.button.back()}
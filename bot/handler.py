@@ -1,9 +1,10 @@
+import html
 import logging
-import requests
 
 from aiogram import Router
 from aiogram.filters import CommandStart
-from aiogram.types import CallbackQuery, Message
+from aiogram.types import (CallbackQuery, InlineQuery, InlineQueryResultArticle,
+                           InlineQueryResultsButton, InputTextMessageContent, Message)
 from aiogram.fsm.context import FSMContext
 from aiogram_dialog import DialogManager, StartMode
 from aiogram_dialog.widgets.kbd import Button
@@ -11,6 +12,9 @@ from aiogram_dialog.widgets.input.text import ManagedTextInput
 from redis import asyncio as aioredis
 
 from fluentogram import TranslatorRunner
+from cache import cache_notes, get_cached_notes, invalidate_notes
+from session import TokenStore
+from search import NoteIndex
 from states import MainSG
 from request import *
 
@@ -24,7 +28,22 @@ logging.basicConfig(
     format='%(filename)s:%(lineno)d #%(levelname)-8s '
            '[%(asctime)s] - %(name)s - %(message)s')
 
-r = aioredis.Redis(host='redis', port=6379, db=0)
+# Telegram does not send longer messages
+MESSAGE_LIMIT = 4096
+
+# Notes fetched from the API at once while paging
+NOTES_FETCH_SIZE = 20
+
+NOTES_SEPARATOR = '\n\n'
+
+# Results per inline answer, Telegram shows at most 50
+INLINE_PAGE_SIZE = 50
+
+# Seconds Telegram may reuse an inline answer for the same user and query
+INLINE_CACHE_TIME = 10
+
+# Words of the content shown as the title of an inline result without one
+INLINE_TITLE_WORDS = 8
 
 
 @router.message(CommandStart())
@@ -41,11 +60,10 @@ async def command_start_getter(message: Message,
 
     logger.info(f'User {username} start Bot')
 
-    response = await login(username=username,
-                           password='')
-    logger.info(f'Is user {username} exists {response.status_code}?')
+    exists = await user_exists(username)
+    logger.info(f'Is user {username} exists {exists}?')
 
-    if response.status_code == 200:
+    if exists:
         # User exists, go to login menu
         await dialog_manager.start(state=MainSG.login)
     else:
@@ -99,7 +117,7 @@ async def login_result(message: Message,
     user_id = message.from_user.id
     username = message.from_user.username
     i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')
-    r = aioredis.Redis(host='redis', port=6379, db=0)
+    sessions: TokenStore = dialog_manager.middleware_data.get('sessions')
     
     logger.info(f'User {username} in login process')
 
@@ -110,7 +128,7 @@ async def login_result(message: Message,
     if response.status_code == 200:
         # Login is successful, save the token in Redis
         # and send the user to the main menu
-        await r.set(str(user_id), (response.json())['password'], ex=1800)
+        await sessions.save(user_id, response.json())
         await dialog_manager.switch_to(state=MainSG.main)
     else:
         # Login is not successful, go to login menu with error
@@ -234,12 +252,20 @@ async def confirm(callback: CallbackQuery,
     i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')
     state: FSMContext = dialog_manager.middleware_data.get('state')
     completed_note = await state.get_data()
-    r = aioredis.Redis(host='redis', port=6379, db=0)
+    r: aioredis.Redis = dialog_manager.middleware_data.get('redis')
+    sessions: TokenStore = dialog_manager.middleware_data.get('sessions')
+    search: NoteIndex = dialog_manager.middleware_data.get('search')
 
     logger.info(f'User {username} complete note: {completed_note}')
 
-    if await r.exists(user_id) != 0:
-        token = str(await r.get(user_id), encoding='utf-8')
+    try:
+        token = await sessions.get(user_id)
+    except ApiError as e:
+        logger.info(f'Refresh for {username} error {e}')
+        await callback.message.answer(text=i18n.server.error())
+        return
+
+    if token is not None:
 
         try:
             headers = {"Authorization": f"Bearer {token}"}
@@ -247,17 +273,22 @@ async def confirm(callback: CallbackQuery,
                                       headers=headers)
             if response.status_code == 200:
                 logger.info(f'Create note by {username} result code: 200')
+                # The cached listings miss the new note
+                await invalidate_notes(r, user_id)
+                await search.add(user_id, response.json())
                 await callback.message.answer(text=i18n.note.created())
             elif response.status_code == 401:
                 logger.info(f'Create note by {username} result code: 401')
                 await callback.message.answer(text=i18n.invalid.token())
-                await r.delete(user_id)
+                await sessions.drop(user_id)
+                await invalidate_notes(r, user_id)
+                await search.drop(user_id)
                 await dialog_manager.switch_to(state=MainSG.login)
             else:
                 logger.info(f'Create note by {username} result code: {response.status_code}')
                 await callback.message.answer(text=i18n.error())
 
-        except requests.exceptions.RequestException as e:
+        except ApiError as e:
             logger.info(f'Create note by {username} error {e}')
             await callback.message.answer(text=i18n.server.error())
     else:
@@ -291,59 +322,195 @@ async def cancel(callback: CallbackQuery,
                                mode=StartMode.RESET_STACK)
 
 
-async def my_notes(callback: CallbackQuery,
-                   button: Button,
-                   dialog_manager: DialogManager):
+def escape_within(text: str, limit: int) -> str:
     """
-    Handler for the my_notes button.
+    Escapes text for HTML, cut with an ellipsis to at most `limit` characters.
 
-    This handler is responsible for getting the list of notes for the current user.
-    It checks if the user is authenticated and if the user has any notes.
-    If the user is authenticated and has any notes, it shows the list of notes.
-    If the user is not authenticated or does not have any notes, it shows the appropriate error message.
+    The text is cut before escaping, so no entity like `&amp;` is split.
     """
-    user_id = callback.from_user.id
-    username = callback.from_user.username
-    logger.info(f'User {username} get notes list')
-    i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')    
-    r = aioredis.Redis(host='redis', port=6379, db=0)
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
 
-    if await r.exists(user_id) != 0:
-        token = str(await r.get(user_id), encoding='utf-8')
+    pieces, length = [], 0
+    for char in text:
+        piece = html.escape(char)
+        if length + len(piece) > limit - 1:
+            break
+        pieces.append(piece)
+        length += len(piece)
+    return ''.join(pieces) + '…'
 
-        try:
-            headers = {"Authorization": f"Bearer {token}"}
-            response = await notes(headers)
 
-            if response.status_code == 200:
+def render_note(i18n: TranslatorRunner, note: dict) -> str:
+    """
+    Renders a note from the API as HTML, at most one message long.
 
-                logger.info(f'Count of notes: {len(response.json())}')
-
-                if len(response.json()) != 0:
-                    logger.info(f'Getting my_notes by {username} result code: 200')
-                    for note in response.json():
-                        await callback.message.answer(text=i18n.shownote(title=note['title'],
-                                                                         content=note['content'],
-                                                                         tags=note['tags']
-                                                                         )
-                                                      )
-                else:
-                    await callback.message.answer(text=i18n.no.notes())
-            elif response.status_code == 401:
-                logger.info(f'Getting my_notes by {username} result code: 401')
-                await callback.message.answer(text=i18n.invalid.token())
-                await r.delete(user_id)
-                await dialog_manager.switch_to(state=MainSG.login)
+    A note too long for a message is shortened in its content first,
+    then in its tags and title, never in the markup around them.
+    """
+    fields = {key: html.escape(note[key]) for key in ('title', 'content', 'tags')}
+    text = i18n.shownote(**fields)
+
+    for key in ('content', 'tags', 'title'):
+        overflow = len(text) - MESSAGE_LIMIT
+        if overflow <= 0:
+            break
+        fields[key] = escape_within(note[key], max(len(fields[key]) - overflow, 1))
+        text = i18n.shownote(**fields)
+    return text
+
+
+def inline_title(i18n: TranslatorRunner, note: dict) -> str:
+    """
+    Returns the title of a note for an inline result, which must not be empty.
+
+    Notes without a title are shown with the beginning of their content.
+    """
+    title = note['title'].strip() or ' '.join(note['content'].split()[:INLINE_TITLE_WORDS])
+    return title or i18n.untitled()
+
+
+def pack_page(notes: list[str], start: int) -> int:
+    """
+    Returns the end of the page starting at `start`.
+
+    A page holds as many notes as fit into one message, at least one.
+    """
+    end, length = start, 0
+    while end < len(notes):
+        added = len(notes[end]) + (len(NOTES_SEPARATOR) if end > start else 0)
+        if end > start and length + added > MESSAGE_LIMIT:
+            break
+        length += added
+        end += 1
+    return end
+
+
+async def load_notes_page(dialog_manager: DialogManager,
+                          user_id: int,
+                          token: str) -> int:
+    """
+    Fetches notes until the current page is full.
+
+    The listing lives in the dialog data: the rendered `notes` fetched so
+    far, the `starts` of the pages seen so far, the current `page` and
+    whether the API has no more notes (`done`).
+    Chunks fetched recently are taken from the cache instead of the API.
+
+    Returns:
+        int: The status code of the last API response, 200 if nothing had to be fetched.
+    """
+    data = dialog_manager.dialog_data
+    i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')
+    r: aioredis.Redis = dialog_manager.middleware_data.get('redis')
+    headers = {"Authorization": f"Bearer {token}"}
+    start = data['starts'][data['page']]
+
+    # A page is complete once a note did not fit or there are no more notes
+    while pack_page(data['notes'], start) == len(data['notes']) and not data['done']:
+        skip = len(data['notes'])
+        fetched = await get_cached_notes(r, user_id, data['tag'], skip, NOTES_FETCH_SIZE)
+        if fetched is None:
+            if data['tag'] is None:
+                response = await notes(headers, skip=skip, limit=NOTES_FETCH_SIZE)
             else:
-                logger.info(f'Getting my_notes by {username} result code: {response.status_code}')
-                await callback.message.answer(text=i18n.error())
+                response = await notes_tag(data['tag'], headers, skip=skip, limit=NOTES_FETCH_SIZE)
+            if response.status_code != 200:
+                return response.status_code
 
-        except requests.exceptions.RequestException as e:
-            logger.info(f'Getting my_notes by {username} error {e}')
-            await callback.message.answer(text=i18n.server.error())
-    else:
-        await callback.message.answer(text=i18n.auth.error())
+            fetched = response.json()
+            await cache_notes(r, user_id, data['tag'], skip, NOTES_FETCH_SIZE, fetched)
+
+        data['notes'].extend(render_note(i18n, note) for note in fetched)
+        data['done'] = len(fetched) < NOTES_FETCH_SIZE
+
+    return 200
+
+
+async def show_notes_page(dialog_manager: DialogManager,
+                          user_id: int,
+                          username: str,
+                          answer) -> bool:
+    """
+    Shows the current page of the listing, fetching its notes if needed.
+
+    Args:
+        dialog_manager (DialogManager): The dialog manager holding the listing.
+        user_id (int): The Telegram ID of the user.
+        username (str): The username of the user, for logging.
+        answer: Sends an error message to the user.
+
+    Returns:
+        bool: Whether the page could be loaded.
+    """
+    i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')
+    r: aioredis.Redis = dialog_manager.middleware_data.get('redis')
+    sessions: TokenStore = dialog_manager.middleware_data.get('sessions')
+    search: NoteIndex = dialog_manager.middleware_data.get('search')
+
+    # Check if the user is authenticated, refreshing the token if needed
+    try:
+        token = await sessions.get(user_id)
+    except ApiError as e:
+        logger.info(f'Refresh for {username} error {e}')
+        await answer(text=i18n.server.error())
+        return False
+    if token is None:
+        await answer(text=i18n.auth.error())
+        await dialog_manager.switch_to(state=MainSG.login)
+        return False
+
+    try:
+        status_code = await load_notes_page(dialog_manager, user_id, token)
+    except ApiError as e:
+        logger.info(f'Getting notes by {username} error {e}')
+        await answer(text=i18n.server.error())
+        return False
+
+    logger.info(f'Getting notes by {username} result code: {status_code}')
+
+    if status_code == 401:
+        await answer(text=i18n.invalid.token())
+        await sessions.drop(user_id)
+        await invalidate_notes(r, user_id)
+        await search.drop(user_id)
         await dialog_manager.switch_to(state=MainSG.login)
+        return False
+    if status_code != 200:
+        await answer(text=i18n.error())
+        return False
+
+    if not dialog_manager.dialog_data['notes']:
+        await answer(text=i18n.no.notes())
+    else:
+        await dialog_manager.switch_to(state=MainSG.notes_list)
+    return True
+
+
+def start_listing(dialog_manager: DialogManager,
+                  tag: str | None = None):
+    """
+    Starts a new listing of the user's notes, optionally by tag.
+    """
+    dialog_manager.dialog_data.update(tag=tag, notes=[], starts=[0], page=0, done=False)
+
+
+async def my_notes(callback: CallbackQuery,
+                   button: Button,
+                   dialog_manager: DialogManager):
+    """
+    Handler for the my_notes button.
+
+    This handler is responsible for showing the notes of the current user,
+    several notes per message and page by page.
+    """
+    username = callback.from_user.username
+    logger.info(f'User {username} get notes list')
+
+    start_listing(dialog_manager)
+    await show_notes_page(dialog_manager, callback.from_user.id, username,
+                          callback.message.answer)
 
 
 async def tags_notes_list(message: Message,
@@ -353,63 +520,52 @@ async def tags_notes_list(message: Message,
     """
     Handler for the tags_notes_list button.
 
-    This handler is responsible for getting the list of notes for the current user
-    by specified tag.
-    It checks if the user is authenticated and if the user has any notes.
-    If the user is authenticated and has any notes, it shows the list of notes.
-    If the user is not authenticated or does not have any notes, it shows the appropriate error message.
+    This handler is responsible for showing the notes of the current user
+    with the specified tag, several notes per message and page by page.
     """
-    user_id = message.from_user.id
     username = message.from_user.username
     logger.info(f'User {username} get notes list by tag')
-    i18n: TranslatorRunner = dialog_manager.middleware_data.get('i18n')    
-    r = aioredis.Redis(host='redis', port=6379, db=0)
 
-    # Check if the user is authenticated
-    if await r.exists(user_id) != 0:
-        token = str(await r.get(user_id), encoding='utf-8')
+    start_listing(dialog_manager, tag=tag)
+    await show_notes_page(dialog_manager, message.from_user.id, username,
+                          message.answer)
 
-        # Try to get the list of notes for the user
-        try:
-            headers = {"Authorization": f"Bearer {token}"}
-            response = await notes_tag(tag, headers)
 
-            # Check if the response was successful
-            if response.status_code == 200:
+async def next_notes_page(callback: CallbackQuery,
+                          button: Button,
+                          dialog_manager: DialogManager):
+    """
+    Handler for the next page button of the notes list.
 
-                logger.info(f'Count of notes: {len(response.json())}')
-                
-                # If the user has any notes, show the list of notes
-                if len(response.json()) != 0:
-                    logger.info(f'Getting my_notes by {username} result code: 200')
-                    for note in response.json():
-                        await message.answer(text=i18n.shownote(title=note['title'],
-                                                                content=note['content'],
-                                                                tags=note['tags']
-                                                                )
-                                             )
-                # If the user does not have any notes, show an appropriate error message
-                else:
-                    await message.answer(text=i18n.no.notes())
-            # If the response was not successful, check if the user has a valid token
-            elif response.status_code == 401:
-                logger.info(f'Getting my_notes by {username} result code: 401')
-                await message.answer(text=i18n.invalid.token())
-                await r.delete(user_id)
-                await dialog_manager.switch_to(state=MainSG.login)
-            # If the response was not successful, show an appropriate error message
-            else:
-                logger.info(f'Getting my_notes by {username} result code: {response.status_code}')
-                await message.answer(text=i18n.error())
-
-        # If there was an error while getting the list of notes, show an appropriate error message
-        except requests.exceptions.RequestException as e:
-            logger.info(f'Getting my_notes by {username} error {e}')
-            await message.answer(text=i18n.server.error())
-    # If the user is not authenticated, show an appropriate error message
-    else:
-        await message.answer(text=i18n.auth.error())
-        await dialog_manager.switch_to(state=MainSG.login)
+    The notes of the next page are fetched when it is opened the first time.
+    """
+    data = dialog_manager.dialog_data
+    end = pack_page(data['notes'], data['starts'][data['page']])
+    data['page'] += 1
+    if data['page'] == len(data['starts']):
+        data['starts'].append(end)
+
+    if not await show_notes_page(dialog_manager, callback.from_user.id,
+                                 callback.from_user.username, callback.message.answer):
+        data['page'] -= 1
+
+
+async def prev_notes_page(callback: CallbackQuery,
+                          button: Button,
+                          dialog_manager: DialogManager):
+    """
+    Handler for the previous page button of the notes list.
+    """
+    dialog_manager.dialog_data['page'] -= 1
+
+
+async def back_to_main(callback: CallbackQuery,
+                       button: Button,
+                       dialog_manager: DialogManager):
+    """
+    Handler for the back button, returns to the main menu.
+    """
+    await dialog_manager.switch_to(state=MainSG.main)
 
 
 async def wrong_input(callback: CallbackQuery,
@@ -429,3 +585,61 @@ async def wrong_input(callback: CallbackQuery,
 
     # Send the user an error message
     await callback.answer(text=i18n.wrong.input())
+
+
+'''Inline search'''
+@router.inline_query()
+async def inline_search(query: InlineQuery,
+                        i18n: TranslatorRunner,
+                        sessions: TokenStore,
+                        search: NoteIndex):
+    """
+    Handler for inline queries, `@bot term`.
+
+    This handler answers with the user's notes that have words in the title
+    or tags starting with the words of the query. The notes come from the
+    search index, which is built from the API on the first query and then
+    only checked against the API every few seconds, so typing does not
+    call the API on every keystroke.
+    """
+    user_id = query.from_user.id
+    login_button = InlineQueryResultsButton(text=i18n.inline.login(),
+                                            start_parameter='login')
+
+    if not await search.is_fresh(user_id):
+        try:
+            token = await sessions.get(user_id)
+            if token is None:
+                await query.answer([], cache_time=0, is_personal=True, button=login_button)
+                return
+            status_code = await search.refresh(user_id, token)
+        except ApiError as e:
+            logger.info(f'Search index of user {user_id} error {e}')
+            await query.answer([], cache_time=0, is_personal=True)
+            return
+
+        if status_code == 401:
+            await sessions.drop(user_id)
+            await query.answer([], cache_time=0, is_personal=True, button=login_button)
+            return
+        if status_code != 200:
+            logger.info(f'Search index of user {user_id} result code: {status_code}')
+            await query.answer([], cache_time=0, is_personal=True)
+            return
+
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    found, more = await search.search(user_id, query.query, offset, INLINE_PAGE_SIZE)
+
+    results = [InlineQueryResultArticle(
+                   id=str(note['id']),
+                   title=inline_title(i18n, note),
+                   description=note['tags'],
+                   input_message_content=InputTextMessageContent(
+                       message_text=render_note(i18n, note),
+                       parse_mode='HTML'))
+               for note in found]
+
+    await query.answer(results,
+                       cache_time=INLINE_CACHE_TIME,
+                       is_personal=True,
+                       next_offset=str(offset + INLINE_PAGE_SIZE) if more else '')
@@ -1,37 +1,150 @@
+import logging
+import re
+
+from typing import Dict, Iterable, List
+
 from fluent_compiler.bundle import FluentBundle
-from fluentogram import FluentTranslator, TranslatorHub
+from fluentogram import FluentTranslator, TranslatorHub, TranslatorRunner
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# Locale of the translator and the Fluent files it is built from
+LOCALE_FILES = {
+    "ru": ("ru-RU", ["locales/ru/LC_MESSAGES/txt.ftl"]),
+    "en": ("en-US", ["locales/en/LC_MESSAGES/txt.ftl"]),
+}
+
+# Locales looked up in order for a message, per user locale
+LOCALES_MAP = {
+    "ru": ("ru", "en"),
+    "en": ("en", "ru"),
+}
+
+# Locale of users whose language has no translator
+ROOT_LOCALE = "en"
+
+# A message definition at the start of a line, e.g. `button-confirm = ...`
+MESSAGE_ID = re.compile(r'^([a-zA-Z][a-zA-Z0-9_-]*)\s*=', re.MULTILINE)
+
+
+def message_ids(filenames: Iterable[str]) -> List[str]:
+    """
+    Returns the IDs of the messages defined in the Fluent files.
+    """
+    ids = []
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as file:
+            ids.extend(MESSAGE_ID.findall(file.read()))
+    return ids
+
+
+class MessageKey:
+    """
+    Builds a message ID from attributes, e.g. `i18n.button.confirm()`,
+    like `TranslatorRunner` does, without keeping state in the translator.
+    """
+    __slots__ = ('_translator', '_key')
+
+    def __init__(self, translator: 'CachedTranslator', key: str):
+        self._translator = translator
+        self._key = key
+
+    def __getattr__(self, item: str) -> 'MessageKey':
+        return MessageKey(self._translator, f'{self._key}-{item}')
+
+    def __call__(self, **kwargs) -> str:
+        return self._translator.get(self._key, **kwargs)
 
 
-def create_translator_hub() -> TranslatorHub:
-    
+class CachedTranslator:
+    """
+    Translator of a locale with its messages without arguments formatted once.
+
+    Messages with arguments are formatted by the wrapped runner on every call.
+    """
+    def __init__(self, runner: TranslatorRunner, keys: Iterable[str]):
+        self._runner = runner
+        self._static: Dict[str, str] = {}
+        for key in keys:
+            try:
+                self._static[key] = runner.get(key)
+            except Exception:
+                # The message needs arguments
+                continue
+
+    def get(self, key: str, **kwargs) -> str:
+        if not kwargs:
+            text = self._static.get(key)
+            if text is not None:
+                return text
+        return self._runner.get(key, **kwargs)
+
+    def __getattr__(self, item: str) -> MessageKey:
+        return MessageKey(self, item)
+
+
+class CachedTranslatorHub:
+    """
+    Hands out the translator of a user's locale.
+
+    Translators are built once per locale, and the locale of every
+    Telegram `language_code` seen is resolved once: the language part
+    is used, e.g. `ru` for `ru-RU`, and unknown languages get the root locale.
+    """
+    def __init__(self,
+                 hub: TranslatorHub,
+                 keys: Iterable[str],
+                 root_locale: str = ROOT_LOCALE):
+        keys = list(keys)
+        self.translators = {locale: CachedTranslator(hub.get_translator_by_locale(locale), keys)
+                            for locale in LOCALES_MAP}
+        self.root_locale = root_locale
+        self._resolved: Dict[str | None, CachedTranslator] = {}
+
+    def get_translator_by_locale(self, locale: str | None) -> CachedTranslator:
+        translator = self._resolved.get(locale)
+        if translator is None:
+            language = (locale or '').split('-')[0].lower()
+            translator = self.translators.get(language, self.translators[self.root_locale])
+            self._resolved[locale] = translator
+        return translator
+
+
+def create_translator_hub() -> CachedTranslatorHub:
+
     """
     Creates a TranslatorHub object with multiple FluentTranslator objects.
 
+    The messages without arguments are formatted up front for every locale.
+
     Returns:
-        TranslatorHub: The created TranslatorHub object.
+        CachedTranslatorHub: The created hub.
     """
 
     translator_hub = TranslatorHub(
-        {
-            "ru": ("ru", "en"),
-            "en": ("en", "ru")
-        },
+        LOCALES_MAP,
         [
             FluentTranslator(
-                locale="ru",
+                locale=locale,
                 translator=FluentBundle.from_files(
-                    locale="ru-RU",
-                    filenames=["locales/ru/LC_MESSAGES/txt.ftl"]
-                )
-        ),
-            FluentTranslator(
-                locale="en",
-                translator=FluentBundle.from_files(
-                    locale="en-US",
-                    filenames=["locales/en/LC_MESSAGES/txt.ftl"]
+                    locale=bundle_locale,
+                    filenames=filenames
                 )
             )
-        ]
+            for locale, (bundle_locale, filenames) in LOCALE_FILES.items()
+        ],
+        root_locale=ROOT_LOCALE
     )
 
-    return translator_hub
+    keys = set(message_ids(filename
+                           for _, filenames in LOCALE_FILES.values()
+                           for filename in filenames))
+    logger.info(f'Translator hub with {len(keys)} messages')
+
+    return CachedTranslatorHub(translator_hub, keys)
@@ -6,6 +6,9 @@ button-create-note = Создать запись
 button-my-notes = Список моих записей
 button-confirm = Подтвердить
 button-cancel = Отменить
+button-prev = ◀️ Назад
+button-next = Далее ▶️
+button-back = В меню
 
 ############
 # MESSAGES #
@@ -111,6 +114,12 @@ invalid-token = Срок сессии окончен!
 no-notes = Нет записей!
 
 
+inline-login = Войди в Бот, чтобы искать записи
+
+
+untitled = Без названия
+
+
 error = Неизвестная ошибка!
 
 
@@ -4,7 +4,8 @@ from typing import Any, Awaitable, Callable, Dict
 
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, User
-from fluentogram import TranslatorHub
+
+from i18n import CachedTranslatorHub
 
 logger = logging.getLogger(__name__)
     
@@ -20,7 +21,8 @@ class TranslatorRunnerMiddleware(BaseMiddleware):
     """
     Middleware that sets the FluentTranslator for the current user to the event data.
     
-    The FluentTranslator is retrieved from the TranslatorHub by the user's locale.
+    The FluentTranslator is retrieved from the hub by the user's locale,
+    which resolves every locale once.
     If the user is not found, the FluentTranslator is not set.
     """
     async def __call__(
@@ -39,6 +41,6 @@ class TranslatorRunnerMiddleware(BaseMiddleware):
         if user is None:
             return await handler(event, data)
         
-        hub: TranslatorHub = data.get('_translator_hub')
+        hub: CachedTranslatorHub = data.get('_translator_hub')
         data['i18n'] = hub.get_translator_by_locale(locale=user.language_code)
         return await handler(event, data)
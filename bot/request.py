@@ -1,6 +1,9 @@
-import requests
 import logging
-import json
+
+from urllib.parse import quote
+
+from client import ApiClient, ApiError, ApiResponse
+from config import ApiConfig
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +15,9 @@ logging.basicConfig(
 
 URL = "http://api:8000"
 
+# Configured from the environment on startup, see `ApiClient.configure`
+api = ApiClient(ApiConfig(url=URL, timeout=1, retries=2, backoff=0.05, hedge=True))
+
 
 # Регистрация нового пользователя
 async def new_user(username: str,
@@ -23,18 +29,34 @@ async def new_user(username: str,
 
     logger.info(f'new_user {username}')
 
-    response = requests.post(f'{URL}/users/', 
-                             json=payload, 
-                             timeout=1)
+    response = await api.request('POST', '/users/',
+                                 json=payload)
 
     logger.info(f'result registration: {response.status_code}')
 
     return response.status_code
 
 
+# Проверка существования пользователя
+async def user_exists(username: str | None) -> bool:
+
+    logger.info(f'user_exists {username}')
+
+    # Users without a Telegram username are never registered
+    if username is None:
+        return False
+
+    response = await api.request('HEAD', f'/users/{quote(username, safe="")}',
+                                 endpoint='HEAD /users/{username}')
+
+    logger.info(f'user_exists status code: {response.status_code}')
+
+    return response.status_code == 200
+
+
 # Аутентификация
 async def login(username: str,
-                password: str):
+                password: str) -> ApiResponse:
     payload = {
        "grant_type": "password",
        "username": username,
@@ -43,25 +65,39 @@ async def login(username: str,
 
     logger.info(f'login {username}')
 
-    response = requests.post(f'{URL}/token/',
-                             data=payload, 
-                             timeout=1)
+    response = await api.request('POST', '/token/',
+                                 data=payload)
 
     logger.info(f'login status code: {response.status_code}')
 
     return response
 
 
+# Обновление токенов по refresh-токену
+async def refresh(refresh_token: str) -> ApiResponse:
+    payload = {
+        "refresh_token": refresh_token
+    }
+
+    logger.info('refresh token')
+
+    response = await api.request('POST', '/token/refresh',
+                                 json=payload)
+
+    logger.info(f'refresh status code: {response.status_code}')
+
+    return response
+
+
 # Создание новой записи
 async def new_note(data: dict, 
                    headers: dict):
     
     logger.info(f'create_note: {data}')
 
-    response = requests.post(f'{URL}/notes/',
-                             json=data,
-                             headers=headers,
-                             timeout=1)
+    response = await api.request('POST', '/notes/',
+                                 json=data,
+                                 headers=headers)
 
     logger.info(f'result create_note {response}')
 
@@ -69,25 +105,45 @@ async def new_note(data: dict,
 
 
 # Получение записей
-async def notes(headers: dict):
+async def notes(headers: dict,
+                skip: int = 0,
+                limit: int = 10):
 
     logger.info(f'getting notes headers: {headers}')
 
-    response = requests.get(f'{URL}/notes/', 
-                            headers=headers, 
-                            timeout=1)
+    response = await api.request('GET', '/notes/',
+                                 params={"skip": skip, "limit": limit},
+                                 headers=headers)
 
     logger.info(f'getting notes {response}')
     
     return response
 
 
+# Сводка записей, меняется при любом изменении записей
+async def notes_digest(headers: dict) -> ApiResponse:
+
+    response = await api.request('GET', '/notes/digest',
+                                 headers=headers)
+
+    logger.info(f'notes digest {response}')
+
+    return response
+
+
 # Поиск записей по тэгу
 async def notes_tag(tag: str,
-                    headers: dict):
-    response = requests.get(f'{URL}/notes/tags/{tag}',  
-                            headers=headers,   
-                            timeout=1)
+                    headers: dict,
+                    skip: int = 0,
+                    limit: int | None = None):
+    params = {"skip": skip}
+    if limit is not None:
+        params["limit"] = limit
+
+    response = await api.request('GET', f'/notes/tags/{quote(tag, safe="")}',
+                                 endpoint='GET /notes/tags/{tag}',
+                                 params=params,
+                                 headers=headers)
     
     logger.info(f'tags search {response}')
 
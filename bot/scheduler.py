@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (BaseRequestMiddleware,
+                                                     NextRequestMiddlewareType)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# Telegram limits: ~30 messages per second overall, ~1 per second
+# in a chat and 20 per minute in a group
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE_PER_MINUTE = 20
+
+# New messages a chat may get at once, e.g. a reply and the next dialog
+# window, before it is held to CHAT_RATE
+CHAT_BURST = 3
+
+# How many chats keep their send state in memory
+MAX_CHATS = 10000
+
+# Retries of a request answered with RetryAfter
+MAX_RETRIES = 5
+
+INTERACTIVE = 0
+BULK = 1
+
+# Priority of the requests sent from the current task
+send_priority: ContextVar[int] = ContextVar('send_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_sends():
+    """
+    Sends the messages of the block, and of the tasks it starts,
+    after the interactive replies.
+    """
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+def posts_message(method: TelegramMethod) -> bool:
+    """
+    Whether the method posts a new message, which the per-chat limits are about.
+
+    Edits, deletions and chat actions keep their order in the chat
+    but do not use up its budget.
+    """
+    name = method.__api_method__
+    return (name.startswith(('send', 'forward', 'copy'))
+            and name != 'sendChatAction')
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, bursts up to `capacity`.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """
+        Returns the seconds until a request is allowed.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class ChatQueue:
+    """
+    Send state of one chat: its buckets and the lock keeping its requests in order.
+    """
+    def __init__(self, chat_id: int | str):
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.buckets = [TokenBucket(CHAT_RATE, CHAT_BURST)]
+
+        # Negative IDs and usernames are groups and channels
+        if isinstance(chat_id, str) or chat_id < 0:
+            self.buckets.append(TokenBucket(GROUP_RATE_PER_MINUTE / 60, GROUP_RATE_PER_MINUTE))
+
+    async def pause(self):
+        """
+        Waits until a RetryAfter pause of the chat is over.
+        """
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def wait(self):
+        """
+        Waits until the chat may receive a new message.
+        """
+        while True:
+            delay = max(self.paused_until - time.monotonic(),
+                        *(bucket.delay() for bucket in self.buckets))
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def take(self):
+        for bucket in self.buckets:
+            bucket.take()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Bot session middleware pacing the requests sent to chats.
+
+    Requests to a chat are sent one after another in FIFO order. New
+    messages are held to the per-chat budget, which allows a short burst,
+    while edits of the dialog windows only wait for their turn (see
+    `posts_message`). All chats share the global budget, which is given to
+    interactive replies before bulk output (see `bulk_sends`). A request
+    answered with RetryAfter pauses its chat and is sent again. Requests
+    without a chat, like answering callbacks, are not paced.
+    """
+    def __init__(self, global_rate: float = GLOBAL_RATE):
+        self.global_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats: OrderedDict[int | str, ChatQueue] = OrderedDict()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._granter: asyncio.Task | None = None
+
+    async def __call__(self,
+                       make_request: NextRequestMiddlewareType[TelegramType],
+                       bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        chat = self._chat(chat_id)
+        paced = posts_message(method)
+        priority = send_priority.get()
+
+        async with chat.lock:
+            for attempt in range(MAX_RETRIES + 1):
+                if paced:
+                    await chat.wait()
+                else:
+                    await chat.pause()
+                await self._global_turn(priority)
+                if paced:
+                    chat.take()
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    logger.info(f'Chat {chat_id} flood limited for {e.retry_after} s')
+                    chat.paused_until = time.monotonic() + e.retry_after
+
+    def share_with(self, processes: int):
+        """
+        Splits the global budget evenly between the bot processes sending messages.
+
+        Every chat is handled by one process, so the per-chat budgets stay whole.
+        """
+        rate = self.global_rate / max(processes, 1)
+        if rate != self.global_bucket.rate:
+            logger.info(f'Global send rate {rate:.1f}/s shared by {processes} processes')
+            self.global_bucket.rate = rate
+            self.global_bucket.capacity = rate
+            self.global_bucket.tokens = min(self.global_bucket.tokens, rate)
+
+    def _chat(self, chat_id: int | str) -> ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatQueue(chat_id)
+        self._chats.move_to_end(chat_id)
+
+        # Forget idle chats, their budgets are full again anyway
+        while len(self._chats) > MAX_CHATS:
+            oldest_id, oldest = next(iter(self._chats.items()))
+            if oldest.lock.locked():
+                break
+            del self._chats[oldest_id]
+        return chat
+
+    async def _global_turn(self, priority: int):
+        """
+        Waits for a token of the global bucket, lower priority values first.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        await future
+
+    async def _grant(self):
+        while self._waiters:
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # The sender was cancelled meanwhile
+                continue
+            self.global_bucket.take()
+            future.set_result(None)
@@ -0,0 +1,191 @@
+import json
+import logging
+import re
+
+from typing import List, Tuple
+
+from redis import asyncio as aioredis
+
+from flight import SingleFlight
+from request import notes, notes_digest
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# How long an unused index is kept
+INDEX_TTL = 60 * 60
+
+# How long an index is used before it is checked against the API.
+# Notes written elsewhere than in the bot are found after at most this long.
+CHECK_INTERVAL = 30
+
+# Notes fetched from the API at once while building an index
+INDEX_FETCH_SIZE = 100
+
+# Words of a query that are matched, the rest is ignored
+MAX_QUERY_WORDS = 5
+
+WORD = re.compile(r'\w+')
+
+
+def words(text: str) -> List[str]:
+    return WORD.findall(text.lower())
+
+
+class NoteIndex:
+    """
+    Per-user prefix index of the notes in Redis, for inline queries.
+
+    For every user the notes are kept in a hash by ID, and the words of
+    their titles and tags in a sorted set as `word:id`, so the notes with
+    a word starting with a prefix are one ZRANGEBYLEX away. A search is
+    two round trips to Redis and never calls the API.
+
+    The index is built from the API on the first search and expires after
+    `INDEX_TTL`. Notes created in the bot are added right away. Every
+    `CHECK_INTERVAL` the digest of the user's notes is fetched from the API,
+    and the index is built again if the notes were changed elsewhere.
+    """
+    def __init__(self, r: aioredis.Redis):
+        self.redis = r
+        self._building = SingleFlight()
+
+    def _keys(self, user_id: int) -> Tuple[str, str, str]:
+        return (f'search:{user_id}:built',
+                f'search:{user_id}:notes',
+                f'search:{user_id}:words')
+
+    def _checked_key(self, user_id: int) -> str:
+        return f'search:{user_id}:checked'
+
+    def _index(self, pipe, user_id: int, notes: List[dict]):
+        _, notes_key, words_key = self._keys(user_id)
+        pipe.hset(notes_key, mapping={note['id']: json.dumps(note) for note in notes})
+        members = {f'{word}:{note["id"]}': 0
+                   for note in notes
+                   for word in words(f'{note["title"]} {note["tags"]}')}
+        # Notes without words, e.g. emoji only, are only found by an empty query
+        if members:
+            pipe.zadd(words_key, members)
+
+    async def is_fresh(self, user_id: int) -> bool:
+        """
+        Whether the index exists and was checked against the API recently.
+        """
+        return bool(await self.redis.exists(self._checked_key(user_id)))
+
+    async def refresh(self, user_id: int, token: str) -> int:
+        """
+        Builds the index of the user from the API, or checks the built one.
+
+        Concurrent refreshes of a user, e.g. from several keystrokes, share one.
+
+        Returns:
+            int: The status code of the last API response.
+        """
+        return await self._building.run(user_id, lambda: self._refresh(user_id, token))
+
+    async def _refresh(self, user_id: int, token: str) -> int:
+        headers = {"Authorization": f"Bearer {token}"}
+        response = await notes_digest(headers)
+        if response.status_code != 200:
+            return response.status_code
+        digest = response.json()['digest']
+
+        built_key, _, _ = self._keys(user_id)
+        if await self.redis.get(built_key) == digest.encode():
+            await self.redis.set(self._checked_key(user_id), 1, ex=CHECK_INTERVAL)
+            return 200
+
+        # The digest is taken before the notes, so changes made
+        # while they are fetched are noticed at the next check
+        return await self._build(user_id, headers, digest)
+
+    async def _build(self, user_id: int, headers: dict, digest: str) -> int:
+        fetched = []
+        while True:
+            response = await notes(headers, skip=len(fetched), limit=INDEX_FETCH_SIZE)
+            if response.status_code != 200:
+                return response.status_code
+            page = response.json()
+            fetched.extend(page)
+            if len(page) < INDEX_FETCH_SIZE:
+                break
+
+        keys = self._keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(*keys)
+            if fetched:
+                self._index(pipe, user_id, fetched)
+            pipe.set(keys[0], digest)
+            for key in keys:
+                pipe.expire(key, INDEX_TTL)
+            pipe.set(self._checked_key(user_id), 1, ex=CHECK_INTERVAL)
+            await pipe.execute()
+
+        logger.info(f'Search index of user {user_id} built with {len(fetched)} notes')
+        return 200
+
+    async def add(self, user_id: int, note: dict):
+        """
+        Adds a created note to the index of the user, if it has one.
+        """
+        built_key, _, _ = self._keys(user_id)
+        if not await self.redis.exists(built_key):
+            return
+        _, notes_key, words_key = self._keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._index(pipe, user_id, [note])
+            # Keys that expired meanwhile must not stay forever
+            pipe.expire(notes_key, INDEX_TTL, nx=True)
+            pipe.expire(words_key, INDEX_TTL, nx=True)
+            await pipe.execute()
+
+    async def search(self,
+                     user_id: int,
+                     query: str,
+                     offset: int,
+                     limit: int) -> Tuple[List[dict], bool]:
+        """
+        Finds the notes with words starting with every word of the query.
+
+        An empty query finds all notes. The newest notes come first.
+
+        Returns:
+            Tuple[List[dict], bool]: The notes from `offset` on and whether there are more.
+        """
+        _, notes_key, words_key = self._keys(user_id)
+        prefixes = words(query)[:MAX_QUERY_WORDS]
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if prefixes:
+                for prefix in prefixes:
+                    # Members starting with the prefix, \xff sorts after every UTF-8 byte
+                    pipe.zrangebylex(words_key, b'[' + prefix.encode(),
+                                     b'[' + prefix.encode() + b'\xff')
+            else:
+                pipe.hkeys(notes_key)
+            results = await pipe.execute()
+
+        if prefixes:
+            matches = [{int(member.rsplit(b':', 1)[1]) for member in members}
+                       for members in results]
+            ids = set.intersection(*matches)
+        else:
+            ids = {int(note_id) for note_id in results[0]}
+
+        ids = sorted(ids, reverse=True)
+        page = ids[offset:offset + limit]
+        if not page:
+            return [], False
+
+        found = await self.redis.hmget(notes_key, page)
+        return [json.loads(note) for note in found if note is not None], offset + limit < len(ids)
+
+    async def drop(self, user_id: int):
+        await self.redis.delete(*self._keys(user_id), self._checked_key(user_id))
@@ -0,0 +1,154 @@
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Tuple
+
+from redis import asyncio as aioredis
+
+from flight import SingleFlight
+from request import ApiError, refresh
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+# Refresh tokens live as long as on the API side
+REFRESH_TOKEN_TTL = 30 * 24 * 60 * 60
+
+# How long a token read from Redis is used without reading it again.
+# Tokens dropped by another bot process are used at most this long.
+LOCAL_TTL = 30
+
+# How many users keep their token in memory
+MAX_LOCAL_TOKENS = 10000
+
+
+def token_key(user_id: int) -> str:
+    return f'session:token:{user_id}'
+
+
+def refresh_key(user_id: int) -> str:
+    return f'session:refresh:{user_id}'
+
+
+def legacy_refresh_key(user_id: int) -> str:
+    # Refresh tokens saved before the keys were namespaced, gone after REFRESH_TOKEN_TTL
+    return f'refresh:{user_id}'
+
+
+class TokenStore:
+    """
+    The API tokens of the users, in Redis and cached in memory.
+
+    Keys are namespaced under `session:`, apart from the FSM data.
+    A token is read from Redis with one GET and then served from memory
+    for up to `LOCAL_TTL` seconds, never past its expiry.
+    """
+    def __init__(self,
+                 r: aioredis.Redis,
+                 local_ttl: float = LOCAL_TTL,
+                 max_local: int = MAX_LOCAL_TOKENS):
+        self.redis = r
+        self.local_ttl = local_ttl
+        self.max_local = max_local
+        self._local: OrderedDict[int, Tuple[str, float]] = OrderedDict()
+        self._refreshing = SingleFlight()
+
+    def _remember(self, user_id: int, token: str, ttl: float):
+        self._local[user_id] = (token, time.monotonic() + min(ttl, self.local_ttl))
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.max_local:
+            self._local.popitem(last=False)
+
+    async def save(self, user_id: int, tokens: dict):
+        """
+        Saves the tokens from a login or refresh response.
+
+        The access token expires a minute before the API stops accepting it,
+        so an expired token is refreshed instead of failing with 401.
+        """
+        ttl = max(tokens['expires_in'] - 60, 60)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(token_key(user_id), tokens['password'], ex=ttl)
+            pipe.set(refresh_key(user_id), tokens['refresh_token'], ex=REFRESH_TOKEN_TTL)
+            await pipe.execute()
+        self._remember(user_id, tokens['password'], ttl)
+
+    async def get(self, user_id: int) -> str | None:
+        """
+        Returns the access token of the user.
+
+        If the access token has expired, a new one is obtained with the
+        refresh token, without asking the user for the password again.
+        Concurrent refreshes of a user share one, as the API takes a
+        refresh token only once. Returns None if the user has to log in.
+
+        Raises:
+            ApiError: If the API could not refresh the token for now,
+                the refresh token is kept for the next try.
+        """
+        local = self._local.get(user_id)
+        if local is not None:
+            token, expires = local
+            if expires > time.monotonic():
+                return token
+            del self._local[user_id]
+
+        token, ttl = await self._fetch(token_key(user_id))
+        if token is not None:
+            self._remember(user_id, token, ttl)
+            return token
+
+        return await self._refreshing.run(user_id, lambda: self._refresh(user_id))
+
+    async def _refresh(self, user_id: int) -> str | None:
+        refresh_token = (await self.redis.get(refresh_key(user_id))
+                         or await self.redis.get(legacy_refresh_key(user_id)))
+        if refresh_token is None:
+            return None
+
+        # Not reaching the API is not a reason to log the user out
+        response = await refresh(str(refresh_token, encoding='utf-8'))
+        if response.status_code == 429 or response.status_code >= 500:
+            raise ApiError(f'Refresh for user {user_id}: {response.status_code}')
+
+        if response.status_code != 200:
+            logger.info(f'Refresh for user {user_id} failed: {response.status_code}')
+
+            # Another bot process may have rotated the token just before
+            token, ttl = await self._fetch(token_key(user_id))
+            if token is not None:
+                self._remember(user_id, token, ttl)
+                return token
+
+            await self.redis.delete(refresh_key(user_id), legacy_refresh_key(user_id))
+            return None
+
+        tokens = response.json()
+        await self.save(user_id, tokens)
+        return tokens['password']
+
+    async def _fetch(self, key: str) -> Tuple[str | None, float]:
+        """
+        Returns a token and its remaining lifetime in one round trip.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            token, pttl = await pipe.execute()
+        if token is None:
+            return None, 0
+        return str(token, encoding='utf-8'), max(pttl, 0) / 1000
+
+    async def drop(self, user_id: int):
+        """
+        Forgets the tokens of the user, e.g. after a 401, so the next action asks for login.
+        """
+        self._local.pop(user_id, None)
+        await self.redis.delete(token_key(user_id), refresh_key(user_id),
+                                legacy_refresh_key(user_id))
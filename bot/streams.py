@@ -0,0 +1,353 @@
+import asyncio
+import json
+import logging
+import math
+import time
+
+from typing import Any, Dict, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+from redis.asyncio.client import Redis
+
+from config import StreamConfig
+from scheduler import SendScheduler, bulk_sends
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+GROUP = 'workers'
+WORKERS_KEY = 'updates:workers'
+
+# Renews the lease of a partition only if this worker still holds it
+RENEW_SCRIPT = '''
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+# Releases the lease of a partition only if this worker still holds it
+RELEASE_SCRIPT = '''
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+'''
+
+
+def chat_id_of(update: Dict[str, Any]) -> int:
+    """
+    Returns the chat an update belongs to, the user for updates without a chat.
+    """
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat is not None:
+            return chat['id']
+        if 'from' in event:
+            return event['from']['id']
+    return 0
+
+
+class UpdateStream:
+    """
+    Telegram updates in Redis Streams, partitioned by chat.
+
+    All updates of a chat go to the same stream `updates:{partition}`,
+    so they are handled in order by the worker owning the partition.
+    """
+    def __init__(self, redis: Redis, config: StreamConfig):
+        self.redis = redis
+        self.config = config
+
+    def key(self, partition: int) -> str:
+        return f'updates:{partition}'
+
+    def partition_of(self, update: Dict[str, Any]) -> int:
+        return chat_id_of(update) % self.config.partitions
+
+    async def add(self, update: Dict[str, Any]):
+        """
+        Appends an update to the stream of its chat.
+        """
+        await self.redis.xadd(self.key(self.partition_of(update)),
+                              {'update': json.dumps(update)},
+                              maxlen=self.config.maxlen,
+                              approximate=True)
+
+
+class StreamRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler writing the updates to the update stream.
+
+    Telegram is answered as soon as the update is stored,
+    the workers handle it.
+    """
+    def __init__(self,
+                 dispatcher: Dispatcher,
+                 bot: Bot,
+                 stream: UpdateStream,
+                 **kwargs: Any):
+        super().__init__(dispatcher, bot, **kwargs)
+        self.stream = stream
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), bot):
+            return web.Response(body='Unauthorized', status=401)
+
+        await self.stream.add(await request.json())
+        return web.json_response({})
+
+
+class StreamWorker:
+    """
+    Handles the updates of the partitions this worker holds a lease on.
+
+    Workers announce themselves in Redis and every worker takes an equal
+    share of the partitions. A partition is handled by one worker at a time.
+    Within a partition the updates of a chat are handled one after another,
+    while different chats are handled concurrently, so a slow chat does
+    not hold up the others. A worker handles up to `concurrency` updates
+    at once and stops reading new ones while it is full.
+
+    Updates are acknowledged once handled. A worker taking over a partition
+    first handles what its previous owner left unacknowledged, so a crash
+    loses no updates but may handle the last ones twice.
+
+    The global send budget of the scheduler, if given, is divided
+    by the number of live workers.
+    """
+    def __init__(self,
+                 dp: Dispatcher,
+                 bot: Bot,
+                 stream: UpdateStream,
+                 config: StreamConfig,
+                 scheduler: SendScheduler | None = None,
+                 **data: Any):
+        self.dp = dp
+        self.scheduler = scheduler
+        self.bot = bot
+        self.stream = stream
+        self.redis = stream.redis
+        self.config = config
+        self.data = data
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.slots = asyncio.Semaphore(config.concurrency)
+        self.stopping: Set[int] = set()
+        self.renew = self.redis.register_script(RENEW_SCRIPT)
+        self.release = self.redis.register_script(RELEASE_SCRIPT)
+
+    def lease_key(self, partition: int) -> str:
+        return f'updates:lease:{partition}'
+
+    async def run(self):
+        """
+        Balances the partitions and handles their updates until cancelled.
+        """
+        for partition in range(self.config.partitions):
+            try:
+                await self.redis.xgroup_create(self.stream.key(partition), GROUP,
+                                               id='0', mkstream=True)
+            except Exception as e:
+                # The group exists already
+                logger.debug(f'Group of partition {partition}: {e}')
+
+        logger.info(f'Worker {self.config.worker_id} started')
+        try:
+            while True:
+                await self.balance()
+                await asyncio.sleep(self.config.lease_seconds / 3)
+        finally:
+            for partition in list(self.tasks):
+                await self.stop_partition(partition)
+            await self.redis.zrem(WORKERS_KEY, self.config.worker_id)
+
+    async def balance(self):
+        """
+        Renews the leases and takes or gives up partitions to get a fair share.
+        """
+        now = time.time()
+        lease_ms = int(self.config.lease_seconds * 1000)
+
+        await self.redis.zadd(WORKERS_KEY, {self.config.worker_id: now})
+        await self.redis.zremrangebyscore(WORKERS_KEY, 0, now - self.config.lease_seconds)
+        workers = max(await self.redis.zcard(WORKERS_KEY), 1)
+        share = math.ceil(self.config.partitions / workers)
+        if self.scheduler is not None:
+            self.scheduler.share_with(workers)
+
+        for partition, task in list(self.tasks.items()):
+            # Give up partitions whose handling failed, another worker retries
+            if task.done():
+                logger.warning(f'Partition {partition} failed: {task.exception()}')
+                await self.stop_partition(partition)
+
+            # Forget partitions whose lease was lost, e.g. after a long pause
+            elif not await self.renew(keys=[self.lease_key(partition)],
+                                      args=[self.config.worker_id, lease_ms]):
+                logger.warning(f'Lost partition {partition}')
+                self.tasks.pop(partition).cancel()
+
+        while len(self.tasks) > share:
+            await self.stop_partition(max(self.tasks))
+
+        for partition in range(self.config.partitions):
+            if len(self.tasks) >= share:
+                break
+            if partition in self.tasks:
+                continue
+            if await self.redis.set(self.lease_key(partition), self.config.worker_id,
+                                    px=lease_ms, nx=True):
+                logger.info(f'Took partition {partition}')
+                self.tasks[partition] = asyncio.create_task(self.handle_partition(partition))
+
+    async def stop_partition(self, partition: int):
+        """
+        Stops handling a partition after its current updates and releases it.
+        """
+        self.stopping.add(partition)
+        await asyncio.gather(self.tasks.pop(partition), return_exceptions=True)
+        self.stopping.discard(partition)
+        await self.release(keys=[self.lease_key(partition)], args=[self.config.worker_id])
+        logger.info(f'Released partition {partition}')
+
+    async def handle_partition(self, partition: int):
+        key = self.stream.key(partition)
+        consumer = self.config.worker_id
+        partition_tasks = PartitionTasks()
+
+        try:
+            # Take over what the previous owner did not acknowledge. The replies
+            # to this backlog go out after those to updates arriving now.
+            cursor = '0-0'
+            with bulk_sends():
+                while True:
+                    cursor, entries, *_ = await self.redis.xautoclaim(key, GROUP, consumer,
+                                                                       min_idle_time=0,
+                                                                       start_id=cursor)
+                    for entry_id, fields in entries:
+                        await self.schedule(partition_tasks, key, entry_id, fields)
+                    if cursor in ('0-0', b'0-0'):
+                        break
+
+            while partition not in self.stopping:
+                response = await self.redis.xreadgroup(GROUP, consumer, {key: '>'},
+                                                       count=self.config.batch_size,
+                                                       block=1000)
+                for _, entries in response:
+                    for entry_id, fields in entries:
+                        await self.schedule(partition_tasks, key, entry_id, fields)
+
+            # Finish the updates read so far before the partition is released
+            await partition_tasks.wait()
+        finally:
+            partition_tasks.cancel()
+
+    async def schedule(self, partition_tasks: 'PartitionTasks', key: str, entry_id,
+                       fields: dict | None):
+        """
+        Starts handling an entry after the updates of its chat read before it.
+
+        Waits while the worker is handling `concurrency` updates.
+        """
+        # Entries deleted by trimming are claimed without fields
+        if fields is None:
+            await self.redis.xack(key, GROUP, entry_id)
+            return
+
+        try:
+            update = json.loads(fields[b'update'])
+        except ValueError as e:
+            logger.error(f'Update {entry_id} is not valid JSON: {e}')
+            await self.redis.xack(key, GROUP, entry_id)
+            return
+
+        await self.slots.acquire()
+        chat_id = chat_id_of(update)
+        previous = partition_tasks.last_of_chat.get(chat_id)
+        partition_tasks.start(chat_id, self.handle_in_turn(previous, key, entry_id, update))
+
+    async def handle_in_turn(self, previous: Optional[asyncio.Task], key: str, entry_id,
+                             update: Dict[str, Any]):
+        try:
+            if previous is not None:
+                # Not awaited directly, its cancellation is not ours
+                await asyncio.wait([previous])
+            await self.handle_entry(key, entry_id, update)
+        finally:
+            self.slots.release()
+
+    async def handle_entry(self, key: str, entry_id, update: Dict[str, Any]):
+        try:
+            result = await self.dp.feed_raw_update(self.bot, update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dp.silent_call_request(self.bot, result)
+        except Exception as e:
+            logger.exception(f'Update {entry_id} failed: {e}')
+        await self.redis.xack(key, GROUP, entry_id)
+
+
+class PartitionTasks:
+    """
+    The updates of a partition being handled, with the last one of every chat.
+    """
+    def __init__(self):
+        self.running: Set[asyncio.Task] = set()
+        self.last_of_chat: Dict[int, asyncio.Task] = {}
+
+    def start(self, chat_id: int, coro):
+        task = asyncio.create_task(coro)
+        self.running.add(task)
+        self.last_of_chat[chat_id] = task
+
+        def done(task: asyncio.Task):
+            self.running.discard(task)
+            if self.last_of_chat.get(chat_id) is task:
+                del self.last_of_chat[chat_id]
+
+        task.add_done_callback(done)
+
+    async def wait(self):
+        if self.running:
+            await asyncio.wait(list(self.running))
+
+    def cancel(self):
+        for task in self.running:
+            task.cancel()
+
+
+async def run_worker(dp: Dispatcher,
+                     bot: Bot,
+                     stream: UpdateStream,
+                     config: StreamConfig,
+                     scheduler: SendScheduler | None = None,
+                     **data: Any):
+    """
+    Runs a stream worker until the process is stopped.
+
+    Args:
+        dp (Dispatcher): The dispatcher handling the updates.
+        bot (Bot): The bot the updates are for.
+        stream (UpdateStream): The update stream.
+        config (StreamConfig): The stream settings.
+        scheduler (SendScheduler | None): The send scheduler of the bot session,
+            its global budget is shared with the other workers.
+        **data: Passed to the handlers, like for `start_polling`.
+    """
+    workflow_data = {'dispatcher': dp, 'bot': bot, **dp.workflow_data, **data}
+    await dp.emit_startup(**workflow_data)
+    try:
+        await StreamWorker(dp, bot, stream, config, scheduler, **data).run()
+    finally:
+        await dp.emit_shutdown(**workflow_data)
+        await bot.session.close()
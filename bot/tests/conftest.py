@@ -0,0 +1,24 @@
+"""
+Fixtures of the bot tests, run from the `bot` directory:
+
+    pip install -r requirements-test.txt
+    python -m pytest
+
+Redis is replaced by fakeredis, the API by stubs of the request functions.
+"""
+import sys
+
+from pathlib import Path
+
+import pytest_asyncio
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest_asyncio.fixture
+async def redis():
+    from fakeredis import FakeAsyncRedis
+
+    redis = FakeAsyncRedis()
+    yield redis
+    await redis.aclose()
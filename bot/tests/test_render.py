@@ -0,0 +1,33 @@
+import html
+
+from handler import MESSAGE_LIMIT, escape_within, render_note
+
+
+class StubTranslator:
+    def shownote(self, title: str, content: str, tags: str) -> str:
+        return f'Title: <b>{title}</b>\n\n{content}\n\ntags:\n{tags}'
+
+
+def test_short_note_is_escaped():
+    text = render_note(StubTranslator(), {'title': 'A & B', 'content': '<x>', 'tags': 't'})
+
+    assert text == 'Title: <b>A &amp; B</b>\n\n&lt;x&gt;\n\ntags:\nt'
+
+
+def test_long_note_is_cut_in_the_content():
+    note = {'title': 'Long', 'content': 'a&' * MESSAGE_LIMIT, 'tags': 'big'}
+
+    text = render_note(StubTranslator(), note)
+
+    assert len(text) <= MESSAGE_LIMIT
+    assert text.startswith('Title: <b>Long</b>')
+    assert text.endswith('…\n\ntags:\nbig')
+    # Every entity is complete
+    content = text.split('\n\n')[1][:-1]
+    assert html.escape(html.unescape(content)) == content
+
+
+def test_escape_within():
+    assert escape_within('a&b', 5) == 'a…'
+    assert escape_within('a&bc', 7) == 'a&amp;…'
+    assert escape_within('a&b', 7) == 'a&amp;b'
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+from aiogram.methods import EditMessageText, SendMessage
+
+from scheduler import CHAT_BURST, SendScheduler, bulk_sends
+
+
+class RecordingRequests:
+    def __init__(self):
+        self.sent = []
+
+    async def __call__(self, bot, method):
+        self.sent.append((method.chat_id, time.monotonic()))
+
+
+async def test_burst_then_paced():
+    scheduler = SendScheduler()
+    requests = RecordingRequests()
+    started = time.monotonic()
+
+    for _ in range(CHAT_BURST):
+        await scheduler(requests, None, SendMessage(chat_id=1, text='-'))
+    # Edits keep their order but do not use up the chat budget
+    await scheduler(requests, None, EditMessageText(chat_id=1, message_id=1, text='-'))
+
+    assert all(sent - started < 0.1 for _, sent in requests.sent)
+
+    chat = scheduler._chat(1)
+    assert chat.buckets[0].delay() > 0.5
+
+
+async def test_interactive_before_bulk():
+    scheduler = SendScheduler(global_rate=20)
+    scheduler.global_bucket.tokens = 0
+    requests = RecordingRequests()
+
+    async def bulk():
+        with bulk_sends():
+            await scheduler(requests, None, SendMessage(chat_id=2, text='-'))
+
+    bulk_task = asyncio.create_task(bulk())
+    await asyncio.sleep(0)
+    await scheduler(requests, None, SendMessage(chat_id=3, text='-'))
+    await bulk_task
+
+    assert [chat_id for chat_id, _ in requests.sent] == [3, 2]
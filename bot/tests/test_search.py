@@ -0,0 +1,74 @@
+import json
+
+import search
+from client import ApiResponse
+from search import NoteIndex
+
+USER_ID = 7
+
+
+class StubApi:
+    """
+    Stands in for the note requests of `search`, serving `notes`.
+    """
+    def __init__(self, notes: list):
+        self.notes = notes
+        self.version = 0
+        self.listings = 0
+
+    async def notes_digest(self, headers: dict) -> ApiResponse:
+        return ApiResponse(200, json.dumps({'digest': str(self.version)}))
+
+    async def list_notes(self, headers: dict, skip: int = 0, limit: int = 10) -> ApiResponse:
+        self.listings += 1
+        return ApiResponse(200, json.dumps(self.notes[skip:skip + limit]))
+
+    def change(self, notes: list):
+        self.notes = notes
+        self.version += 1
+
+
+def note(note_id: int, title: str, tags: str = '') -> dict:
+    return {'id': note_id, 'title': title, 'content': '-', 'tags': tags}
+
+
+async def titles(index: NoteIndex, query: str) -> list:
+    found, _ = await index.search(USER_ID, query, 0, 10)
+    return [found_note['title'] for found_note in found]
+
+
+async def test_search_by_word_prefix(redis, monkeypatch):
+    api = StubApi([note(1, 'Shopping list', 'home'), note(2, 'Work plan', 'job'),
+                   note(3, '🎉🎉')])
+    monkeypatch.setattr(search, 'notes', api.list_notes)
+    monkeypatch.setattr(search, 'notes_digest', api.notes_digest)
+    index = NoteIndex(redis)
+
+    assert await index.refresh(USER_ID, 'token') == 200
+
+    assert await titles(index, 'sho') == ['Shopping list']
+    assert await titles(index, 'plan jo') == ['Work plan']
+    assert await titles(index, '') == ['🎉🎉', 'Work plan', 'Shopping list']
+
+
+async def test_changes_elsewhere_are_picked_up(redis, monkeypatch):
+    api = StubApi([note(1, 'Shopping list'), note(2, 'Work plan')])
+    monkeypatch.setattr(search, 'notes', api.list_notes)
+    monkeypatch.setattr(search, 'notes_digest', api.notes_digest)
+    index = NoteIndex(redis)
+    await index.refresh(USER_ID, 'token')
+    assert await index.is_fresh(USER_ID)
+
+    # Unchanged notes are not fetched again
+    await redis.delete(index._checked_key(USER_ID))
+    await index.refresh(USER_ID, 'token')
+    assert api.listings == 1
+
+    # A note deleted through the API disappears at the next check
+    api.change([note(2, 'Work plan')])
+    await redis.delete(index._checked_key(USER_ID))
+    assert not await index.is_fresh(USER_ID)
+    await index.refresh(USER_ID, 'token')
+
+    assert api.listings == 2
+    assert await titles(index, 'sho') == []
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import pytest
+
+import session
+from client import ApiError, ApiResponse
+from session import TokenStore, refresh_key, token_key
+
+USER_ID = 7
+
+
+class StubRefresh:
+    """
+    Stands in for `request.refresh`, answering after `delay` seconds.
+    """
+    def __init__(self, status_code: int = 200, delay: float = 0.01, error: Exception | None = None):
+        self.status_code = status_code
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self, refresh_token: str) -> ApiResponse:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return ApiResponse(self.status_code, json.dumps({'password': f'access-{self.calls}',
+                                                          'refresh_token': f'refresh-{self.calls}',
+                                                          'expires_in': 1800}))
+
+
+@pytest.fixture
+async def store(redis):
+    await redis.set(refresh_key(USER_ID), 'refresh-0')
+    return TokenStore(redis)
+
+
+async def test_cached_token(store, redis, monkeypatch):
+    stub = StubRefresh()
+    monkeypatch.setattr(session, 'refresh', stub)
+    await redis.set(token_key(USER_ID), 'access', ex=600)
+
+    assert await store.get(USER_ID) == 'access'
+    assert stub.calls == 0
+
+
+async def test_concurrent_refreshes_share_one(store, redis, monkeypatch):
+    stub = StubRefresh()
+    monkeypatch.setattr(session, 'refresh', stub)
+
+    tokens = await asyncio.gather(*(store.get(USER_ID) for _ in range(5)))
+
+    assert tokens == ['access-1'] * 5
+    assert stub.calls == 1
+    assert await redis.get(refresh_key(USER_ID)) == b'refresh-1'
+
+
+async def test_cancelled_refresh_does_not_hang_waiters(store, monkeypatch):
+    stub = StubRefresh(delay=0.05)
+    monkeypatch.setattr(session, 'refresh', stub)
+
+    first = asyncio.create_task(store.get(USER_ID))
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(store.get(USER_ID))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    # The waiter refreshes on its own instead of waiting forever
+    assert await asyncio.wait_for(second, 1) == 'access-2'
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+async def test_unreachable_api_keeps_the_session(store, redis, monkeypatch):
+    monkeypatch.setattr(session, 'refresh', StubRefresh(error=ApiError('timeout')))
+
+    with pytest.raises(ApiError):
+        await store.get(USER_ID)
+    assert await redis.get(refresh_key(USER_ID)) == b'refresh-0'
+
+    monkeypatch.setattr(session, 'refresh', StubRefresh(status_code=503))
+    with pytest.raises(ApiError):
+        await store.get(USER_ID)
+    assert await redis.get(refresh_key(USER_ID)) == b'refresh-0'
+
+
+async def test_rejected_refresh_logs_out(store, redis, monkeypatch):
+    monkeypatch.setattr(session, 'refresh', StubRefresh(status_code=401))
+
+    assert await store.get(USER_ID) is None
+    assert await redis.get(refresh_key(USER_ID)) is None
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from config import StreamConfig
+from streams import GROUP, PartitionTasks, StreamWorker, UpdateStream
+
+
+class RecordingDispatcher:
+    """
+    Handles updates by recording them, the ones of chat 1 slowly.
+    """
+    def __init__(self):
+        self.started = []
+        self.finished = []
+
+    async def feed_raw_update(self, bot, update, **kwargs):
+        chat_id = update['message']['chat']['id']
+        self.started.append(update['update_id'])
+        await asyncio.sleep(0.05 if chat_id == 1 else 0)
+        self.finished.append(update['update_id'])
+
+
+def message(update_id: int, chat_id: int) -> dict:
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': '-',
+                        'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+def worker(redis, dp, concurrency: int = 10) -> StreamWorker:
+    config = StreamConfig(partitions=1, maxlen=100, batch_size=10,
+                          concurrency=concurrency, lease_seconds=30, worker_id='test')
+    return StreamWorker(dp, None, UpdateStream(redis, config), config)
+
+
+async def handle(worker: StreamWorker, updates: list):
+    await worker.redis.xgroup_create('updates:0', GROUP, id='0', mkstream=True)
+    partition_tasks = PartitionTasks()
+    for update in updates:
+        fields = {b'update': json.dumps(update).encode()}
+        entry_id = await worker.redis.xadd('updates:0', fields)
+        await worker.schedule(partition_tasks, 'updates:0', entry_id, fields)
+    await partition_tasks.wait()
+
+
+async def test_chats_in_parallel_and_in_order(redis):
+    dp = RecordingDispatcher()
+
+    await handle(worker(redis, dp), [message(1, 1), message(2, 1), message(3, 2)])
+
+    # Chat 2 does not wait for the slow chat 1, whose updates keep their order
+    assert dp.finished == [3, 1, 2]
+    assert dp.started.index(2) > dp.finished.index(1)
+
+
+async def test_concurrency_is_bounded(redis):
+    dp = RecordingDispatcher()
+    stream_worker = worker(redis, dp, concurrency=1)
+
+    await handle(stream_worker, [message(1, 1), message(2, 2)])
+
+    assert dp.finished == [1, 2]
+    assert not stream_worker.slots.locked()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from typing import Any, Dict
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import WebhookConfig
+
+
+logger = logging.getLogger(__name__)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(filename)s:%(lineno)d #%(levelname)-8s '
+           '[%(asctime)s] - %(name)s - %(message)s')
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler answering Telegram at once and processing updates in the background.
+
+    At most `max_concurrency` updates are processed at the same time.
+    When `max_pending` updates are waiting, new ones are refused with 503,
+    and Telegram delivers them again later.
+    """
+    def __init__(self,
+                 dispatcher: Dispatcher,
+                 bot: Bot,
+                 max_concurrency: int,
+                 max_pending: int,
+                 **kwargs: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if len(self._background_feed_update_tasks) >= self.max_pending:
+            logger.warning(f'{self.max_pending} updates pending, refusing update')
+            return web.Response(status=503)
+        return await super()._handle_request_background(bot=bot, request=request)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self.semaphore:
+            await super()._background_feed_update(bot=bot, update=update)
+
+
+async def run_webhook(dp: Dispatcher,
+                      bot: Bot,
+                      config: WebhookConfig,
+                      handler: SimpleRequestHandler | None = None,
+                      **data: Any):
+    """
+    Serves the webhook until the process is stopped.
+
+    The webhook is registered at Telegram only if `config.url` is set,
+    so the server can be run locally and fed with fake updates.
+    A public webhook requires `config.secret`, otherwise anyone knowing
+    the URL could post updates on behalf of any user.
+
+    Args:
+        dp (Dispatcher): The dispatcher handling the updates.
+        bot (Bot): The bot receiving the updates.
+        config (WebhookConfig): The webhook settings.
+        handler (SimpleRequestHandler | None): Receives the updates.
+            Defaults to handling them in this process.
+        **data: Passed to the handlers, like for `start_polling`.
+
+    Raises:
+        ValueError: If `config.url` is set without `config.secret`.
+    """
+    if config.url and not config.secret:
+        raise ValueError('WEBHOOK_SECRET must be set when WEBHOOK_URL is')
+
+    app = web.Application()
+    if handler is None:
+        handler = BoundedRequestHandler(dp, bot,
+                                        max_concurrency=config.max_concurrency,
+                                        max_pending=config.max_pending,
+                                        secret_token=config.secret,
+                                        **data)
+    handler.register(app, path=config.path)
+    setup_application(app, dp, bot=bot, **data)
+
+    if config.url:
+        await bot.set_webhook(f'{config.url}{config.path}',
+                              secret_token=config.secret,
+                              allowed_updates=dp.resolve_used_update_types(),
+                              drop_pending_updates=True)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=config.host, port=config.port).start()
+        logger.info(f'Webhook listening on {config.host}:{config.port}{config.path}')
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()